@@ -0,0 +1,80 @@
+"""Benchmark of dense vs. checkerboard B multiplication
+
+Times B_l * M, M * B_l^-1 (one wrap) for the dense matrix exponential
+(DenseB) and the checkerboard engine (MatB) and reports the deviation of the
+checkerboard B from the exact exponential. The hopping matrices are built
+by GeometryWrapper from the .geom files, the sizes override their supercell.
+
+    python benchmarks/bench_checkerboard.py --lattices square honeycomb cubic
+"""
+
+import argparse
+import sys
+import time
+from pathlib import Path
+
+import torch
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1] / "src"))
+
+from checkerboard import CheckerBoard
+from geometry import GeometryWrapper
+from matb import DenseB
+
+GEOMETRIES = Path(__file__).resolve().parents[1] / "geometries"
+DEFAULT_SIZES = {"square": [8, 16, 24], "honeycomb": [6, 12, 16], "cubic": [4, 6, 8]}
+
+
+def hopping_matrix(name: str, size: int) -> torch.Tensor:
+    """Dense hopping matrix K of geometries/<name>.geom with a size^ndim supercell"""
+    geometry = GeometryWrapper({"device": torch.device("cpu"), "supercell": size})
+    geometry.init_from_file(GEOMETRIES / f"{name}.geom")
+    return -geometry.hamiltonian.t_up.to_dense().real
+
+
+def time_wrap(matb: DenseB, M: torch.Tensor, v: torch.Tensor, repeats: int) -> float:
+    """Seconds per wrap M -> B_l M B_l^-1"""
+    start = time.perf_counter()
+    for _ in range(repeats):
+        matb.mult_left(M, v)
+        matb.mult_right_inv(M, v)
+    return (time.perf_counter() - start) / repeats
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--lattices", nargs="+", default=list(DEFAULT_SIZES), choices=list(DEFAULT_SIZES))
+    parser.add_argument("--sizes", type=int, nargs="+", help="linear sizes (default depends on the lattice)")
+    parser.add_argument("--dtau", type=float, default=0.1)
+    parser.add_argument("--mu", type=float, default=0.0)
+    parser.add_argument("--repeats", type=int, default=20)
+    args = parser.parse_args()
+
+    torch.set_default_dtype(torch.float64)
+    torch.manual_seed(0)
+    ckb = CheckerBoard({"device": torch.device("cpu")})
+
+    print(f"{'lattice':>10} {'N':>6} {'dense ms':>10} {'ckb ms':>10} {'speedup':>8} {'|B_ckb - B|':>12}")
+    for name in args.lattices:
+        for size in args.sizes or DEFAULT_SIZES[name]:
+            K = hopping_matrix(name, size)
+            n = K.shape[0]
+            B = torch.matrix_exp(-args.dtau * (K - args.mu * torch.eye(n)))
+            dense = DenseB(n, B, torch.linalg.inv(B))
+            sparse = ckb.init_B_from_hopping(K, args.mu, args.dtau)
+
+            v = torch.exp(0.5 * (torch.randint(2, (n,)) * 2 - 1))
+            M = torch.linalg.inv(torch.eye(n) + torch.rand(n, n))
+            t_dense = time_wrap(dense, M.clone(), v, args.repeats)
+            t_ckb = time_wrap(sparse, M.clone(), v, args.repeats)
+
+            # Trotter error of the checkerboard B
+            E = torch.eye(n)
+            sparse.mult_left(E, torch.ones(n))
+            err = (E - B).abs().max().item()
+
+            print(f"{name:>10} {n:6d} {1e3 * t_dense:10.3f} {1e3 * t_ckb:10.3f} {t_dense / t_ckb:8.2f} {err:12.3e}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,110 @@
+"""Benchmark of the stabilized UDT chain behind DQMC._compute_greens
+
+Reports the time per stabilization step (pre-pivoted QR, DQMC_UDTD) and the
+maximal deviation of G = (I + B_{L-1} ... B_0)^-1 from an arbitrary precision
+reference computed with mpmath (optional, skipped if not installed). The
+hopping matrices are built by GeometryWrapper from the .geom files, the
+sizes override their supercell.
+
+    python benchmarks/bench_stabilization.py --lattice square --beta 20 --dtau 0.1 --n-orth 10
+"""
+
+import argparse
+import sys
+import time
+from pathlib import Path
+
+import torch
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1] / "src"))
+
+from bench_checkerboard import GEOMETRIES, hopping_matrix
+from kernels import scalerowadd, udtd
+from matb import DenseB
+from seqb import SeqB
+
+try:
+    import mpmath
+except ImportError:
+    mpmath = None
+
+
+def greens(seqb: SeqB, V: torch.Tensor) -> torch.Tensor:
+    """Green's function at the last slice from the stratified chain"""
+    n = seqb.n
+    U, D, T = torch.zeros((n, n)), torch.zeros(n), torch.zeros((n, n))
+    seqb.multiply(seqb.L - 1, V, U, D, T)
+    big = D.abs() > 1
+    Db = torch.where(big, D, torch.ones_like(D))
+    Ds = torch.where(big, torch.ones_like(D), D)
+    G, A = scalerowadd(Db, U, Ds, T)
+    return torch.linalg.solve(A, G)
+
+
+def reference_greens(B: torch.Tensor, V: torch.Tensor, dps: int) -> torch.Tensor:
+    """Green's function from the plain product in arbitrary precision"""
+    mpmath.mp.dps = dps
+    n = B.shape[0]
+    Bmp = mpmath.matrix(B.tolist())
+    M = mpmath.eye(n)
+    for v in V.tolist():
+        M = Bmp * M
+        for i in range(n):
+            for j in range(n):
+                M[i, j] *= v[i]
+    G = mpmath.inverse(mpmath.eye(n) + M)
+    return torch.tensor([[float(G[i, j]) for j in range(n)] for i in range(n)])
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    lattices = sorted(p.stem for p in GEOMETRIES.glob("*.geom"))
+    parser.add_argument("--lattice", default="square", choices=lattices, help="geometries/<lattice>.geom")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[4, 6, 8, 16], help="linear sizes of the supercell")
+    parser.add_argument("--beta", type=float, default=20.0)
+    parser.add_argument("--dtau", type=float, default=0.1)
+    parser.add_argument("--coupling", type=float, default=0.5, help="HSF coupling in V = exp(coupling * h)")
+    parser.add_argument("--n-orth", type=int, default=10)
+    parser.add_argument("--repeats", type=int, default=20)
+    parser.add_argument("--dps", type=int, default=150, help="decimal digits of the mpmath reference")
+    parser.add_argument("--max-ref-sites", type=int, default=64, help="largest lattice checked against mpmath")
+    args = parser.parse_args()
+
+    torch.set_default_dtype(torch.float64)
+    torch.manual_seed(0)
+    L = round(args.beta / args.dtau)
+
+    print(f"beta={args.beta} dtau={args.dtau} L={L} n_orth={args.n_orth}")
+    print(f"{'lattice':>10} {'N':>6} {'ms/stab':>10} {'ms/G':>10} {'max |dG|':>12}")
+
+    for size in args.sizes:
+        K = hopping_matrix(args.lattice, size)
+        n = K.shape[0]
+        B = torch.matrix_exp(-args.dtau * K)
+        V = torch.exp(args.coupling * (torch.randint(2, (L, n)) * 2 - 1))
+        seqb = SeqB(n, L, args.n_orth, DenseB(n, B, torch.linalg.inv(B)), device=torch.device("cpu"))
+
+        # Time per stabilization step
+        U, D, T = torch.linalg.qr(torch.randn(n, n))[0], torch.ones(n), torch.eye(n)
+        start = time.perf_counter()
+        for _ in range(args.repeats):
+            U, D, T, _ = udtd(torch.mm(B, U), D, T)
+        t_stab = (time.perf_counter() - start) / args.repeats
+
+        # Time per full Green's function
+        start = time.perf_counter()
+        for _ in range(args.repeats):
+            seqb.invalidate()
+            G = greens(seqb, V)
+        t_green = (time.perf_counter() - start) / args.repeats
+
+        if mpmath is not None and n <= args.max_ref_sites:
+            dev = f"{(G - reference_greens(B, V, args.dps)).abs().max().item():12.3e}"
+        else:
+            dev = f"{'-':>12}"
+
+        print(f"{f'{args.lattice} {size}':>10} {n:6d} {1e3 * t_stab:10.3f} {1e3 * t_green:10.3f} {dev}")
+
+
+if __name__ == "__main__":
+    main()
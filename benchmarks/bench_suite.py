@@ -0,0 +1,239 @@
+"""Throughput of full DQMC runs on the EXAMPLE/test inputs
+
+Parses the small, median and large .in files of the Fortran test driver
+into DQMCConfig, runs fixed-seed warmup and measured sweeps on the CPU and
+reports sweeps/s, Metropolis steps/s, Green's function recomputations/s,
+tensor allocations per sweep, peak RSS and, on CUDA, allocator statistics.
+--fraction scales the sweep counts of the files down to benchmark length.
+
+    python benchmarks/bench_suite.py --save baseline.json
+    python benchmarks/bench_suite.py --baseline baseline.json --tolerance 0.1
+
+With --baseline the rates are compared against a stored run and the exit
+status is 1 if any fell by more than the tolerance, or if a case allocates
+more than --max-allocs tensors per sweep outside the LAPACK work arrays.
+"""
+
+import argparse
+import json
+import platform
+import resource
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+import torch
+from torch.profiler import ProfilerActivity, profile
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1] / "src"))
+
+from config import DQMCConfig
+from dqmc import DQMC, PRECISIONS
+from profiler import PROFILER
+
+INPUTS = Path(__file__).resolve().parents[1] / "EXAMPLE" / "test"
+CASES = ("small", "median", "large")
+RATES = ("sweeps_per_s", "steps_per_s", "greens_per_s")
+LAPACK_OPS = ("aten::geqrf", "aten::linalg_householder_product", "aten::lu_unpack")  # allocate their work arrays
+
+
+def parse_in(path: Path) -> dict[str, str]:
+    """Key = value pairs of a QUEST .in file, # starts a comment"""
+    params = {}
+    for raw in path.read_text().splitlines():
+        line = raw.split("#", 1)[0]
+        if "=" in line:
+            key, value = line.split("=", 1)
+            params[key.strip()] = value.strip()
+    return params
+
+
+def config_from_in(params: dict[str, str], fraction: float, precision: str = "double") -> tuple[DQMCConfig, int, int]:
+    """DQMCConfig of a .in file with its seed and the scaled number of measured sweeps"""
+    nx, ny = int(params["nx"]), int(params["ny"])
+    config = DQMCConfig(
+        L_sites=nx * ny,
+        supercell=[[nx, 0], [0, ny]],
+        n_slices=int(params["L"]),
+        dt=float(params["dtau"]),
+        U=float(params["U"]),
+        mu=float(params.get("mu_up", 0.0)),
+        t=float(params.get("t_up", 1.0)),
+        n_warm=max(1, round(fraction * int(params["nwarm"]))),
+        n_bins=int(params.get("nbin", 10)),
+        n_delay=int(params.get("nwrap", 10)),
+        fix_wrap=int(params.get("fixwrap", 0)) == 1,
+        diff_lim=float(params.get("difflim", 1e-5)),
+        err_rate=float(params.get("errrate", 1e-3)),
+        measure_stride=max(1, int(params.get("tausk", 10))),
+        tdm=int(params.get("tdm", 0)) != 0,
+        n_orth=int(params.get("north", 10)),
+        precision=precision,
+        device=torch.device("cpu"),
+    )
+    n_sweeps = max(1, round(fraction * int(params["npass"])))
+    return config, int(params.get("seed", 0)), n_sweeps
+
+
+def peak_rss_mb() -> float:
+    """Peak resident set size of this process"""
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss / 2**20 if sys.platform == "darwin" else rss / 2**10
+
+
+def allocator_stats() -> dict[str, int] | None:
+    """Peak and current allocations of the CUDA caching allocator, None on CPU"""
+    if not torch.cuda.is_available():
+        return None
+    stats = torch.cuda.memory_stats()
+    keys = ("allocated_bytes.all.peak", "reserved_bytes.all.peak", "num_alloc_retries", "num_ooms")
+    return {key: stats.get(key, 0) for key in keys}
+
+
+def allocations_per_sweep(qmc: DQMC, n_sweeps: int = 2) -> tuple[float, float]:
+    """Tensor allocations per measured sweep of the engine and of the LAPACK calls
+
+    Every allocator call is a positive [memory] event of the trace. The
+    events of FunctionEvent only keep those made outside any op, the
+    allocations of an op are folded into its memory usage, so the trace is
+    counted instead. The work arrays of geqrf and householder_product and
+    the pivot permutation of lu_unpack are allocated inside the ops where
+    no out= reaches them, they are counted apart. A first sweep creates the
+    buffers that are made on first use.
+    """
+    qmc.sweep(measure=True)
+
+    activities = [ProfilerActivity.CPU] + ([ProfilerActivity.CUDA] if torch.cuda.is_available() else [])
+    with profile(activities=activities, profile_memory=True) as prof:
+        for _ in range(n_sweeps):
+            qmc.sweep(measure=True)
+
+    with tempfile.TemporaryDirectory() as tmp:
+        trace = Path(tmp) / "trace.json"
+        prof.export_chrome_trace(str(trace))
+        events = json.loads(trace.read_text())["traceEvents"]
+    allocs = [e["ts"] for e in events if e.get("name") == "[memory]" and e["args"].get("Bytes", 0) > 0]
+    spans = [(e["ts"], e["ts"] + e["dur"]) for e in events if e.get("ph") == "X" and e.get("name") in LAPACK_OPS]
+    lapack = sum(1 for ts in allocs if any(start <= ts <= end for start, end in spans))
+    return (len(allocs) - lapack) / n_sweeps, lapack / n_sweeps
+
+
+def run_case(name: str, fraction: float, precision: str = "double") -> dict:
+    """Warm up and time the measured sweeps of one input"""
+    config, seed, n_sweeps = config_from_in(parse_in(INPUTS / f"{name}.in"), fraction, precision)
+    torch.manual_seed(seed)
+    qmc = DQMC(config)
+
+    start = time.perf_counter()
+    qmc.warmup()
+    t_warm = time.perf_counter() - start
+
+    # The profiler counts the recomputations of G during the timed sweeps
+    PROFILER.reset()
+    PROFILER.enable(sync=False)
+    start = time.perf_counter()
+    for i in range(n_sweeps):
+        qmc.sweep(measure=(i + 1) % config.measure_stride == 0)
+    elapsed = time.perf_counter() - start
+    PROFILER.disable()
+    n_greens = sum(item.count for path, item in PROFILER.items.items() if path.endswith("compute_greens"))
+
+    allocs, lapack_allocs = allocations_per_sweep(qmc)
+    return {
+        "N": config.L_sites,
+        "L": config.n_slices,
+        "warm_sweeps": config.n_warm,
+        "sweeps": n_sweeps,
+        "warm_s": t_warm,
+        "sweeps_per_s": n_sweeps / elapsed,
+        "steps_per_s": n_sweeps * config.n_slices * config.L_sites / elapsed,
+        "greens_per_s": n_greens / elapsed,
+        "fell_back": config.precision == "mixed" and not qmc.mixed,
+        "allocs_per_sweep": allocs,
+        "lapack_allocs_per_sweep": lapack_allocs,
+        "peak_rss_mb": peak_rss_mb(),
+        "allocator": allocator_stats(),
+    }
+
+
+def compare(results: dict, baseline: dict, tolerance: float) -> bool:
+    """Print the rates relative to the baseline, returns whether none regressed"""
+    ok = True
+    print(f"{'case':>8} {'rate':>14} {'baseline':>12} {'current':>12} {'ratio':>7}")
+    for name, current in results["cases"].items():
+        base = baseline["cases"].get(name)
+        if base is None:
+            continue
+        for rate in RATES:
+            if base[rate] <= 0:
+                continue
+            ratio = current[rate] / base[rate]
+            flag = "" if ratio >= 1 - tolerance else "  REGRESSION"
+            ok &= not flag
+            print(f"{name:>8} {rate:>14} {base[rate]:12.3f} {current[rate]:12.3f} {ratio:7.3f}{flag}")
+    return ok
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--cases", nargs="+", default=list(CASES), choices=CASES)
+    parser.add_argument("--fraction", type=float, default=0.01, help="fraction of nwarm and npass to run")
+    parser.add_argument("--threads", type=int, default=None, help="torch intra-op threads")
+    parser.add_argument("--save", type=Path, default=None, help="write the results to this JSON file")
+    parser.add_argument("--baseline", type=Path, default=None, help="compare against a saved JSON file")
+    parser.add_argument("--precision", default="double", choices=PRECISIONS, help="precision policy of DQMCConfig")
+    parser.add_argument("--max-allocs", type=float, default=None, help="largest tolerated allocations per sweep")
+    parser.add_argument("--tolerance", type=float, default=0.1, help="largest tolerated relative slowdown")
+    args = parser.parse_args()
+
+    torch.set_default_dtype(torch.float64)
+    if args.threads is not None:
+        torch.set_num_threads(args.threads)
+
+    results = {
+        "torch": torch.__version__,
+        "python": platform.python_version(),
+        "machine": platform.machine(),
+        "threads": torch.get_num_threads(),
+        "fraction": args.fraction,
+        "precision": args.precision,
+        "cases": {},
+    }
+
+    print(
+        f"{'case':>8} {'N':>6} {'sweeps':>7} {'sweeps/s':>10} {'steps/s':>12} {'G/s':>9} {'allocs':>9} {'RSS MB':>9}",
+    )
+    for name in args.cases:
+        r = run_case(name, args.fraction, args.precision)
+        results["cases"][name] = r
+        print(
+            f"{name:>8} {r['N']:6d} {r['sweeps']:7d} {r['sweeps_per_s']:10.3f} {r['steps_per_s']:12.0f}"
+            f" {r['greens_per_s']:9.2f} {r['allocs_per_sweep']:9.1f} {r['peak_rss_mb']:9.1f}",
+        )
+
+    ok = True
+    if args.max_allocs is not None:
+        for name, r in results["cases"].items():
+            if r["allocs_per_sweep"] > args.max_allocs:
+                allocs = r["allocs_per_sweep"]
+                print(f" {name}: {allocs:.1f} allocations per sweep, at most {args.max_allocs:g} allowed")
+                ok = False
+
+    if args.save is not None:
+        with open(args.save, "w") as f:
+            json.dump(results, f, indent=2)
+
+    if args.baseline is not None:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        if any(baseline.get(key) != results[key] for key in ("fraction", "threads", "precision")):
+            print(" Baseline was run with other --fraction, thread or precision settings, rates may not compare")
+        ok &= compare(results, baseline, args.tolerance)
+
+    if not ok:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
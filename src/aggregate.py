@@ -0,0 +1,61 @@
+# src/aggregate.py
+from dataclasses import dataclass
+
+import torch
+import torch.distributed as dist
+
+from measurements import PhysicalMeasurements
+from parallel import Channel, ParallelQMC
+from tdm import TimeDependentMeasurements
+
+
+def pack(tensors: list[torch.Tensor], dtype: torch.dtype | None = None) -> torch.Tensor:
+    """Flatten tensors into one contiguous buffer"""
+    dtype = dtype if dtype is not None else tensors[0].dtype
+    return torch.cat([t.reshape(-1).to(dtype) for t in tensors])
+
+
+def unpack(buffer: torch.Tensor, tensors: list[torch.Tensor]) -> None:
+    """Copy a buffer made by pack back into tensors, views are written in place"""
+    offset = 0
+    for t in tensors:
+        t.copy_(buffer[offset : offset + t.numel()].view(t.shape))
+        offset += t.numel()
+
+
+@dataclass
+class BinAggregator:
+    """Combine the bins of all processes in a channel
+
+    The bin sums and sign sums of one measurement block are packed into a
+    single buffer and summed with one all-reduce, so every process ends up
+    with the bins of the whole run. The jackknife errors are then computed
+    on the root of the channel only, as DQMC_Phy0_GetErr.
+    """
+
+    pqmc: ParallelQMC
+    channel: Channel = Channel.AGGR  # Channel.MEAS for the time-dependent block
+    wire_dtype: torch.dtype | None = None  # dtype of the reduction buffer, None keeps the measurement dtype
+
+    @torch.no_grad()
+    def reduce(self, tensors: list[torch.Tensor]) -> None:
+        """Sum tensors over the channel in place with one packed all-reduce"""
+        group = self.pqmc.comm(self.channel)
+        if group is None:
+            return
+
+        buffer = pack(tensors, self.wire_dtype)
+        dist.all_reduce(buffer, op=dist.ReduceOp.SUM, group=group)
+        unpack(buffer, tensors)
+
+    @torch.no_grad()
+    def aggregate(self, block: PhysicalMeasurements | TimeDependentMeasurements) -> bool:
+        """Reduce the bins of a measurement block and fill its average and error bins on the root
+
+        Returns whether this process holds the averages.
+        """
+        self.reduce(block.bin_data())
+        if not self.pqmc.is_root(self.channel):
+            return False
+        block.get_err()
+        return True
@@ -0,0 +1,130 @@
+# src/binstore.py
+import json
+import os
+import struct
+from dataclasses import dataclass
+from dataclasses import field as dataclass_field
+from pathlib import Path
+
+import numpy as np
+import torch
+
+MAGIC = b"QUESTBIN"
+VERSION = 1
+ALIGN = 64  # records start on this byte boundary
+
+
+def _jsonable(value: object) -> object:
+    """Convert tensors in header metadata to lists"""
+    if isinstance(value, torch.Tensor):
+        return value.tolist()
+    if isinstance(value, dict):
+        return {k: _jsonable(v) for k, v in value.items()}
+    if isinstance(value, list | tuple):
+        return [_jsonable(v) for v in value]
+    return value
+
+
+def read_header(path: Path) -> tuple[dict, int]:
+    """Header of a bin file and the byte offset of its first record"""
+    with Path(path).open("rb") as f:
+        if f.read(len(MAGIC)) != MAGIC:
+            raise ValueError(f"{path} is not a bin file")
+        (size,) = struct.unpack("<Q", f.read(8))
+        header = json.loads(f.read(size).rstrip(b" ").decode())
+    return header, len(MAGIC) + 8 + size
+
+
+def load_bins(path: Path) -> tuple[dict, dict[str, np.ndarray]]:
+    """Memory-map the bins of a file, also while it is being appended
+
+    Returns the header and one read-only (nbins, *shape) view per block.
+    Only the records complete at the time of the call are mapped.
+    """
+    header, offset = read_header(path)
+    dtype = np.dtype(header["dtype"])
+    record = header["record_size"]
+    nbins = (Path(path).stat().st_size - offset) // (record * dtype.itemsize)
+    if nbins == 0:
+        return header, {name: np.empty((0, *shape), dtype) for name, shape in header["blocks"].items()}
+
+    data = np.memmap(path, dtype=dtype, mode="r", offset=offset, shape=(nbins, record))
+    blocks = {}
+    start = 0
+    for name, shape in header["blocks"].items():
+        size = int(np.prod(shape, dtype=np.int64))
+        blocks[name] = data[:, start : start + size].reshape(nbins, *shape)
+        start += size
+    return header, blocks
+
+
+@dataclass
+class BinStore:
+    """Append-only binary file with one record per completed bin
+
+    The file starts with MAGIC, the length of a JSON header and the header
+    itself, padded so that the records are aligned. The header names the
+    blocks of a record with their shapes, plus any metadata such as class
+    labels, k-points and observable names. Every record is appended and
+    flushed with the file opened only for that write, so load_bins can map
+    the file while the run goes on.
+
+    An existing file with the same blocks is continued, a partly written
+    last record is dropped.
+    """
+
+    path: Path
+    blocks: dict[str, tuple[int, ...]]  # shape of every block in one bin
+    meta: dict = dataclass_field(default_factory=dict)  # extra header fields
+    dtype: torch.dtype = torch.float64
+    fsync: bool = False  # also sync to disk after every bin
+
+    def __post_init__(self):
+        self.path = Path(self.path)
+        self.blocks = {name: tuple(int(s) for s in shape) for name, shape in self.blocks.items()}
+        self.record_size = sum(int(np.prod(shape, dtype=np.int64)) for shape in self.blocks.values())
+        self.record_bytes = self.record_size * self.dtype.itemsize
+
+        header = {
+            "version": VERSION,
+            "dtype": str(self.dtype).removeprefix("torch."),
+            "record_size": self.record_size,
+            "blocks": {name: list(shape) for name, shape in self.blocks.items()},
+            **_jsonable(self.meta),
+        }
+
+        if self.path.exists() and self.path.stat().st_size > 0:
+            old, self.offset = read_header(self.path)
+            if old["blocks"] != header["blocks"] or old["dtype"] != header["dtype"]:
+                raise ValueError(f"{self.path} holds bins of a different layout")
+            self.n_bins = (self.path.stat().st_size - self.offset) // self.record_bytes
+            self.truncate(self.n_bins)
+        else:
+            text = json.dumps(header).encode()
+            text += b" " * (-(len(MAGIC) + 8 + len(text)) % ALIGN)
+            self.offset = len(MAGIC) + 8 + len(text)
+            self.n_bins = 0
+            with self.path.open("wb") as f:
+                f.write(MAGIC + struct.pack("<Q", len(text)) + text)
+
+    @torch.no_grad()
+    def append(self, record: dict[str, torch.Tensor]) -> int:
+        """Write one bin and flush it, returns its index in the file"""
+        if record.keys() != self.blocks.keys():
+            raise ValueError(f"Expected blocks {', '.join(self.blocks)}, got {', '.join(record)}")
+
+        data = torch.cat([record[name].reshape(-1).to("cpu", self.dtype) for name in self.blocks])
+        with self.path.open("ab") as f:
+            f.write(data.numpy().tobytes())
+            f.flush()
+            if self.fsync:
+                os.fsync(f.fileno())
+
+        self.n_bins += 1
+        return self.n_bins - 1
+
+    def truncate(self, n_bins: int) -> None:
+        """Drop the bins from n_bins on, e.g. those written after a checkpoint"""
+        self.n_bins = min(self.n_bins, n_bins)
+        with self.path.open("r+b") as f:
+            f.truncate(self.offset + self.n_bins * self.record_bytes)
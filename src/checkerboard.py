@@ -3,23 +3,156 @@ from dataclasses import dataclass
 
 import torch
 
+from structure import CompressedColumnStorage
+
 DEVICE = torch.get_default_device()
 
 
 @dataclass
 class MatB:
-    """Checkerboard decomposition matrix B"""
+    """Checkerboard decomposition matrix B
+
+    B_l = diag(exptaumu * V_l) * P_c ... P_1 P_1 ... P_c, where P_k is the
+    product of the 2x2 bond rotations [[cosh, sinh], [sinh, cosh]] of colour
+    k. Bonds of one colour share no site, so every colour is a pairing of
+    the sites: with the rows (or columns) of M permuted so that the bonds of
+    the colour sit next to each other, P_k is a batch of 2x2 rotations on a
+    (pairs, 2) view. The permutation of one colour to the next is a single
+    index_select into a buffer, so a multiplication costs O(N^2) per colour
+    and does not allocate. The dense GEMMs of DenseB stay faster up to
+    N ~ 2000 (bench_checkerboard.py), so DQMC only uses MatB with
+    b_engine = "checkerboard".
+    """
 
     n: int  # dim of B
     m: int  # number of neighbors of lattice
-    A: torch.Tensor  # Adjacency info (3, m)
+    A: torch.Tensor  # Adjacency info (3, m): sites i < j and hopping type
     sinht: torch.Tensor  # sinh(t)
     cosht: torch.Tensor  # cosh(t)
     exptaumu: torch.Tensor  # parameters for checkerboard method
     work: torch.Tensor  # work array
+    color: torch.Tensor | None = None  # checkerboard colour of every bond (m)
     name: str = "Checkerboard"
     device: torch.device = DEVICE
 
+    def __post_init__(self):
+        if self.color is None:
+            self.color = color_bonds(self.n, self.A[0], self.A[1]).to(self.device)
+
+        # Site order and rotation parameters of every colour, the bonds first
+        orders, self.groups = [], []
+        for c in range(int(self.color.max()) + 1 if self.m > 0 else 0):
+            i, j, h = self.A[:, self.color == c]
+            paired = torch.zeros(self.n, dtype=torch.bool, device=self.device)
+            paired[i] = paired[j] = True
+            single = torch.nonzero(~paired).squeeze(-1)
+            orders.append(torch.cat([torch.stack([i, j], -1).flatten(), single]))
+            self.groups.append((self.cosht[h], self.sinht[h], -self.sinht[h]))
+
+        # Gathers from one colour order to the next along P_c ... P_1 P_1 ... P_c, and back
+        self.sequence = list(range(len(orders)))[::-1] + list(range(len(orders)))
+        identity = torch.arange(self.n, device=self.device)
+        self.steps = []
+        previous = identity
+        for c in self.sequence:
+            self.steps.append(torch.argsort(previous)[orders[c]])
+            previous = orders[c]
+        self.final = torch.argsort(previous)
+
+        self.buffers = {}
+
+    def _buffer(self, M: torch.Tensor, slot: int) -> torch.Tensor:
+        """Scratch of the shape and dtype of M, several per shape"""
+        key = (M.shape, M.dtype, slot)
+        if key not in self.buffers:
+            self.buffers[key] = torch.empty(M.shape, dtype=M.dtype, device=M.device)
+        return self.buffers[key]
+
+    def _scale(self, V_i: torch.Tensor) -> torch.Tensor:
+        """Diagonal exptaumu * V_i of B_i, in a buffer"""
+        return torch.mul(self.exptaumu, V_i, out=self._buffer(V_i, 0))
+
+    def _rotate(self, M: torch.Tensor, rows: bool, inverse: bool) -> None:
+        """Apply P_c ... P_1 P_1 ... P_c (or its inverse) to the rows or columns of M"""
+        if not self.groups:
+            return
+
+        dim = -2 if rows else -1
+        src, dst, tmp = M, self._buffer(M, 1), self._buffer(M, 2)
+        for c, step in zip(self.sequence, self.steps, strict=True):
+            torch.index_select(src, dim, step, out=dst)
+            src, dst = dst, (self._buffer(M, 3) if dst is self._buffer(M, 1) else self._buffer(M, 1))
+
+            # Bonds of colour c are the pairs of consecutive rows (columns) of src
+            cosh, sinh, msinh = self.groups[c]
+            s = msinh if inverse else sinh
+            p = cosh.numel()
+            if rows:
+                pairs = src[..., : 2 * p, :].unflatten(-2, (p, 2))
+                x, y, t = pairs[..., 0, :], pairs[..., 1, :], tmp[..., :p, :]
+                cosh, s = cosh.unsqueeze(-1), s.unsqueeze(-1)
+            else:
+                pairs = src[..., : 2 * p].unflatten(-1, (p, 2))
+                x, y, t = pairs[..., 0], pairs[..., 1], tmp[..., :p]
+            torch.mul(x, s, out=t)
+            x.mul_(cosh).addcmul_(y, s)
+            y.mul_(cosh).add_(t)
+
+        torch.index_select(src, dim, self.final, out=M)
+
+    @torch.no_grad()
+    def mult_left(self, M: torch.Tensor, V_i: torch.Tensor) -> None:
+        """M = B_i * M"""
+        self._rotate(M, rows=True, inverse=False)
+        M.mul_(self._scale(V_i).unsqueeze(-1))
+
+    @torch.no_grad()
+    def mult_right(self, M: torch.Tensor, V_i: torch.Tensor) -> None:
+        """M = M * B_i"""
+        M.mul_(self._scale(V_i).unsqueeze(-2))
+        self._rotate(M, rows=False, inverse=False)
+
+    @torch.no_grad()
+    def mult_left_inv(self, M: torch.Tensor, V_i: torch.Tensor) -> None:
+        """M = B_i^-1 * M"""
+        M.div_(self._scale(V_i).unsqueeze(-1))
+        self._rotate(M, rows=True, inverse=True)
+
+    @torch.no_grad()
+    def mult_right_inv(self, M: torch.Tensor, V_i: torch.Tensor) -> None:
+        """M = M * B_i^-1"""
+        self._rotate(M, rows=False, inverse=True)
+        M.div_(self._scale(V_i).unsqueeze(-2))
+
+
+def color_bonds(n: int, i: torch.Tensor, j: torch.Tensor) -> torch.Tensor:
+    """Edge colouring by rounds of matchings: bonds of the same colour share no site
+
+    Every round colours a maximal matching of the uncoloured bonds. It is
+    grown by taking, all at once, every candidate bond that is the lowest
+    numbered candidate at both of its sites, so the lowest candidate is
+    always taken and the matching grows until no candidate is left.
+    """
+    m = i.numel()
+    ids = torch.arange(m, device=i.device)
+    color = torch.full((m,), -1, dtype=torch.int64, device=i.device)
+
+    c = 0
+    while bool((color < 0).any()):
+        busy = torch.zeros(n, dtype=torch.bool, device=i.device)
+        candidate = color < 0
+        while bool(candidate.any()):
+            ci, cj, cid = i[candidate], j[candidate], ids[candidate]
+            lowest = torch.full((n,), m, dtype=torch.int64, device=i.device)
+            lowest.scatter_reduce_(0, ci, cid, "amin").scatter_reduce_(0, cj, cid, "amin")
+            take = cid[(lowest[ci] == cid) & (lowest[cj] == cid)]
+
+            color[take] = c
+            busy[i[take]] = busy[j[take]] = True
+            candidate = (color < 0) & ~busy[i] & ~busy[j]
+        c += 1
+    return color
+
 
 class CheckerBoard:
     def __init__(self, config: dict):
@@ -29,27 +162,26 @@ class CheckerBoard:
     def init_B(
         self,
         n: int,
-        adj: torch.Tensor,
-        ckb: torch.Tensor,
+        adj: CompressedColumnStorage,
+        ckb: CompressedColumnStorage,
         t: torch.Tensor,
         mu: torch.Tensor,
         dtau: float,
     ) -> MatB:
         """Initialize MatB structure"""
-        if not torch.all(ckb.row == adj.row) or not torch.all(ckb.cstart == adj.cstart):
+        if not torch.equal(ckb.row_indices, adj.row_indices) or not torch.equal(ckb.col_ptrs, adj.col_ptrs):
             raise ValueError("ckb and adj do not conform")
 
         m = ckb.nnz // 2
-        nckb = ckb.max()
-        nt = adj.max()
+        nt = int(adj.values.max())  # noqa: PD011
 
         # Initialize parameters
         sinht = torch.sinh(dtau * 0.5 * t[:nt])
         cosht = torch.cosh(dtau * 0.5 * t[:nt])
-        exptaumu = torch.exp(dtau * mu)
+        exptaumu = torch.exp(dtau * mu) * torch.ones(n)
 
         # Build adjacency info
-        A = self._build_adjacency(n, ckb, adj, nckb)
+        A, color = self._build_adjacency(n, ckb, adj)
 
         return MatB(
             n=n,
@@ -59,4 +191,46 @@ class CheckerBoard:
             cosht=cosht.to(self.device),
             exptaumu=exptaumu.to(self.device),
             work=torch.zeros(n, device=self.device),
+            color=color.to(self.device),
+            device=self.device,
         )
+
+    def init_B_from_hopping(self, hopping: torch.Tensor, mu: torch.Tensor | float, dtau: float) -> MatB:
+        """Initialize MatB from a dense hopping matrix K, B = exp(-dtau * (K - mu))"""
+        n = hopping.shape[0]
+        i, j = torch.nonzero(torch.triu(hopping, diagonal=1), as_tuple=True)
+
+        # Every bond is its own hopping type
+        t = -hopping[i, j]
+        A = torch.stack([i, j, torch.arange(len(i), device=i.device)])
+        exptaumu = torch.exp(dtau * (torch.as_tensor(mu) - torch.diagonal(hopping)))
+
+        return MatB(
+            n=n,
+            m=len(i),
+            A=A.to(self.device),
+            sinht=torch.sinh(dtau * 0.5 * t).to(self.device),
+            cosht=torch.cosh(dtau * 0.5 * t).to(self.device),
+            exptaumu=exptaumu.to(self.device),
+            work=torch.zeros(n, device=self.device),
+            device=self.device,
+        )
+
+    def _build_adjacency(
+        self,
+        n: int,
+        ckb: CompressedColumnStorage,
+        adj: CompressedColumnStorage,
+    ) -> tuple[torch.Tensor, torch.Tensor]:
+        """Bonds (i < j, hopping type) ordered by checkerboard colour"""
+        # Column index of every stored entry
+        counts = ckb.col_ptrs[1:] - ckb.col_ptrs[:-1]
+        cols = torch.repeat_interleave(torch.arange(n, device=counts.device), counts)
+        rows = ckb.row_indices
+
+        # Keep the upper triangle, sorted by colour as in DQMC_B_Init
+        upper = rows < cols
+        color = ckb.values[upper].long() - 1  # noqa: PD011
+        order = torch.argsort(color, stable=True)
+        A = torch.stack([rows[upper], cols[upper], adj.values[upper].long() - 1])[:, order]  # noqa: PD011
+        return A, color[order]
@@ -0,0 +1,110 @@
+# src/checkpoint.py
+import hashlib
+import os
+from pathlib import Path
+
+import torch
+
+from dqmc import DQMC
+from hsf import pack_hsf, unpack_hsf
+
+VERSION = 2
+
+# Adaptive wrapping state of GreenFunction
+WRAP_STATE = ("n_wrap", "wps", "max_wrap", "last_wrap", "redo", "no_redo")
+
+
+def fingerprint(qmc: DQMC) -> str:
+    """Hash of the Hamiltonian, the B matrices and the parameters defining them"""
+    h = hashlib.sha256()
+    config = qmc.config
+    h.update(repr((config.L_sites, config.n_slices, config.dt, config.U, config.mu)).encode())
+    for B in (qmc.B_up, qmc.B_dn):
+        h.update(B.detach().to("cpu", torch.float64).contiguous().numpy().tobytes())
+    return h.hexdigest()
+
+
+def _rng_state() -> dict:
+    """States of the CPU and CUDA generators"""
+    state = {"cpu": torch.get_rng_state()}
+    if torch.cuda.is_available():
+        state["cuda"] = torch.cuda.get_rng_state_all()
+    return state
+
+
+def _set_rng_state(state: dict) -> None:
+    torch.set_rng_state(state["cpu"])
+    if "cuda" in state and torch.cuda.is_available():
+        torch.cuda.set_rng_state_all(state["cuda"])
+
+
+def save_checkpoint(qmc: DQMC, path: Path) -> None:
+    """Write the simulation state to path
+
+    The file is written next to path and renamed over it, so a job killed
+    while saving leaves the previous checkpoint intact.
+    """
+    path = Path(path)
+    state = {
+        "version": VERSION,
+        "fingerprint": fingerprint(qmc),
+        "hsf_shape": tuple(qmc.hsf.shape),
+        "hsf": pack_hsf(qmc.hsf).cpu(),
+        "rng": _rng_state(),
+        "n_sweeps": qmc.n_sweeps,
+        "warm": qmc.warm,
+        "current_bin": qmc.config.current_bin,
+        "mixed": qmc.mixed,
+        "wrap": {name: int(getattr(qmc.gf_up, name)) for name in WRAP_STATE},
+        "measurements": qmc.phy0.measurements,
+        "phy0": [t.cpu() for t in qmc.phy0.bin_data()],
+        "tdm": [t.cpu() for t in qmc.measurements.bin_data()],
+        "stored_bins": qmc.bin_store.n_bins if qmc.bin_store is not None else 0,
+    }
+
+    tmp = path.with_name(path.name + ".tmp")
+    with tmp.open("wb") as f:
+        torch.save(state, f)
+        f.flush()
+        os.fsync(f.fileno())
+    tmp.replace(path)
+
+
+@torch.no_grad()
+def load_checkpoint(qmc: DQMC, path: Path) -> None:
+    """Restore the simulation state saved by save_checkpoint
+
+    qmc must be built from the same configuration. G is recomputed from
+    the restored field at the next slice, a warm run skips its warmup and
+    measurements go on in the bin that was being filled.
+    """
+    state = torch.load(path, map_location="cpu", weights_only=True)
+    if state["version"] != VERSION:
+        raise ValueError(f"Checkpoint version {state['version']}, expected {VERSION}")
+    if state["fingerprint"] != fingerprint(qmc):
+        raise ValueError("Checkpoint was written for a different Hamiltonian")
+    if tuple(state["hsf_shape"]) != tuple(qmc.hsf.shape):
+        raise ValueError(f"Checkpoint HSF has shape {state['hsf_shape']}, expected {tuple(qmc.hsf.shape)}")
+
+    qmc.set_hsf(unpack_hsf(state["hsf"], state["hsf_shape"], qmc.hsf.dtype).to(qmc.device))
+    _set_rng_state(state["rng"])
+
+    qmc.n_sweeps = state["n_sweeps"]
+    qmc.warm = state["warm"]
+    qmc.config.current_bin = state["current_bin"]
+    if qmc.mixed and not state["mixed"]:
+        # The run had fallen back to double
+        qmc.leave_mixed()
+    for gf in (qmc.gf_up, qmc.gf_dn):
+        for name, value in state["wrap"].items():
+            setattr(gf, name, value)
+
+    # Partially filled bins, bins appended to a bin file after the checkpoint are measured again
+    qmc.phy0.measurements = state["measurements"]
+    for blocks, saved in ((qmc.phy0.bin_data(), state["phy0"]), (qmc.measurements.bin_data(), state["tdm"])):
+        for t, value in zip(blocks, saved, strict=True):
+            t.copy_(value)
+    if qmc.bin_store is not None:
+        if qmc.bin_store.n_bins < state["stored_bins"]:
+            raise ValueError(f"Bin file has {qmc.bin_store.n_bins} bins, checkpoint expects {state['stored_bins']}")
+        qmc.bin_store.truncate(state["stored_bins"])
@@ -5,6 +5,10 @@ from pathlib import Path
 
 import torch
 
+DEVICE = torch.get_default_device()
+
+GEOMETRIES = Path(__file__).resolve().parents[1] / "geometries"  # shipped .geom files
+
 
 class Fields(IntEnum):
     NDIM = 1
@@ -53,9 +57,12 @@ class GeomParams:
         with open(input_file) as f:
             content = f.read()
 
-        # Check which fields are present
+        self.analyze_sections(tokenize_geom(content))
+
+    def analyze_sections(self, sections: dict[str, list[list[str]]]) -> None:
+        """Record which fields a tokenized input has and check the compulsory ones"""
         for field_name in self.INPUT_FIELDS:
-            self.found_fields[field_name] = field_name in content
+            self.found_fields[field_name] = field_name in sections
 
         # Check compulsory fields using list comprehension
         missing = [field_name for field_name in self.INPUT_FIELDS[:5] if not self.found_fields[field_name]]
@@ -66,3 +73,77 @@ class GeomParams:
         # Check PAIRS dependency on BONDS
         if self.found_fields["#PAIR"] and not self.found_fields["#BONDS"]:
             raise ValueError("#PAIR requires #BONDS to be specified in input")
+
+        # Diluted lattices are not built
+        if self.found_fields["#DILUT"]:
+            raise ValueError("#DILUT is not supported, remove the diluted sites from #ORB and #HAMILT instead")
+
+
+def parse_float(token: str) -> float:
+    """Parse a number of a .geom input, which may use the Fortran double exponent (1.0d0)"""
+    return float(token.lower().replace("d", "e"))
+
+
+def tokenize_geom(content: str) -> dict[str, list[list[str]]]:
+    """Split a .geom input into the tokens of its sections in one pass
+
+    A line starting with one of GeomParams.INPUT_FIELDS opens that section,
+    anything after the field name on the same line is ignored. Any other
+    #NAME line opens a section that is skipped, "# ..." lines and the tail
+    of a data line from # on are comments. Reading stops at #END.
+    """
+    fields = set(GeomParams.INPUT_FIELDS)
+    sections: dict[str, list[list[str]]] = {}
+    rows = None
+    for line in content.splitlines():
+        stripped = line.strip()
+        if stripped.startswith("#"):
+            name = stripped.split(maxsplit=1)[0].upper()
+            if name == "#END":
+                break
+            if name in fields:
+                rows = sections.setdefault(name, [])
+            elif name != "#":
+                rows = None
+            continue
+
+        tokens = stripped.split("#", 1)[0].split()
+        if tokens and rows is not None:
+            rows.append(tokens)
+
+    return sections
+
+
+@dataclass
+class DQMCConfig:
+    """Simulation parameters for DQMC"""
+
+    L_sites: int  # number of lattice sites
+    n_slices: int  # number of imaginary time slices
+    dt: float  # imaginary time step
+    U: float  # Hubbard U
+    mu: float = 0.0  # chemical potential
+    t: float = 1.0  # hopping amplitude, scales the hopping matrix of the lattice
+    geometry: Path = GEOMETRIES / "square.geom"  # .geom file of the lattice, its sites must number L_sites
+    supercell: int | list[list[int]] | None = None  # overrides #SUPER of the geometry file
+    n_warm: int = 1000  # number of warmup sweeps
+    n_bins: int = 10  # number of measurement bins
+    n_delay: int = 10  # initial number of wraps between Green's function recomputations
+    fix_wrap: bool = False  # keep n_delay fixed instead of adapting it
+    diff_lim: float = 1e-5  # largest tolerated difference between wrapped and recomputed G
+    err_rate: float = 1e-3  # tolerated fraction of recomputations exceeding diff_lim
+    n_measure: int = 10  # slices between measurements within a measured sweep
+    measure_stride: int = 1  # DQMC.run measures every measure_stride-th sweep (tausk)
+    tdm: bool = False  # time-dependent measurements at the end of every measured sweep
+    n_orth: int = 10  # slices per block of the stratified B product cache
+    n_blk: int = 0  # delayed update block size (0 = tune to the L2 cache)
+    precision: str = "double"  # double, or mixed: float32 wraps, updates and block products, float64 stabilization
+    mixed_fallback: float = 1e-3  # wrap error at which a mixed run switches to double for the rest of the run
+    b_engine: str = "dense"  # B matrix engine: dense exponential, or checkerboard (MatB, faster past N ~ 2000)
+    update_backend: str = "eager"  # site update loop: eager, compile or the per-site python reference
+    n_walkers: int = 1  # independent Markov chains advanced together by BatchedDQMC
+    current_bin: int = 0  # bin currently being filled
+    bin_file: Path | None = None  # stream completed bins to this file, keeping one bin in memory
+    geom_cache: Path | None = None  # directory of the geometry cache shared by runs (None = build every run)
+    geom_cache_max_bytes: int = 1 << 30  # size limit of the geometry cache
+    device: torch.device = DEVICE
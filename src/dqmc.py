@@ -1,63 +1,303 @@
 # src/dqmc.py
 
+import logging
+import math
+from pathlib import Path
+
 import torch
 
+from binstore import BinStore
+from checkerboard import CheckerBoard
 from config import DQMCConfig
-from lattice import SquareLattice
-from measurements import TimeDependentMeasurements
+from geomcache import GeometryCache
+from geometry import GeometryWrapper
+from green import GreenFunction, tune_block_size
+from gtau import TAU_DN, TAU_UP, GTau
+from hsf import HSField
+from kernels import scalerowadd_
+from matb import DenseB
+from measurements import CORRELATIONS, Observable, PhysicalMeasurements
+from metropolis import SiteBuffers, get_update_kernel
+from profiler import profiled
+from seqb import SeqB
+from tdm import TDM_PROPERTIES, TimeDependentMeasurements
 from workspace import Workspace
 
+# Precision policies, mixed keeps G, its delayed updates, the wraps and the
+# cached block products in float32 while the UDT stabilization, the
+# recomputation of G and the signs stay in float64
+PRECISIONS = ("double", "mixed")
+
+# B matrix engines, the dense exponential or the checkerboard bond rotations of MatB
+B_ENGINES = ("dense", "checkerboard")
+
+logger = logging.getLogger(__name__)
+
 
 class DQMC:
+    batch_shape: tuple[int, ...] = ()  # leading walker dimensions of hsf, V and G
+
     def __init__(self, config: DQMCConfig):
         self.config = config
         self.device = config.device
-        self.lattice = SquareLattice(config)
-
-        # Initialize HSF fields
-        self.hsf = torch.randint(2, (self.config.n_slices, self.config.L_sites), device=self.device) * 2 - 1
-
-        # Initialize Green's functions
-        self.G_up = torch.zeros((self.config.L_sites, self.config.L_sites), device=self.device)
-        self.G_dn = torch.zeros((self.config.L_sites, self.config.L_sites), device=self.device)
+        self._init_lattice()
+
+        # Compute dtype of G and the B products, stabilization in the default dtype
+        if config.precision not in PRECISIONS:
+            raise ValueError(f"Unknown precision {config.precision}, expected one of {', '.join(PRECISIONS)}")
+        self.mixed = config.precision == "mixed"
+        if self.mixed and torch.get_default_dtype() != torch.float64:
+            raise ValueError("Mixed precision stabilizes in the default dtype, which must be torch.float64")
+        self.stab_dtype = torch.get_default_dtype()
+        self.dtype = torch.float32 if self.mixed else self.stab_dtype
+
+        # Initialize int8 HSF fields with the diagonals of the V matrices, exp(+lambda h)
+        # for spin up and exp(-lambda h) for spin down, or exp(+lambda h) for both if U < 0,
+        # with cosh(lambda) = exp(dtau |U| / 2)
+        self.coupling = math.acosh(math.exp(config.dt * abs(config.U) / 2))
+        self.attractive = config.U < 0
+        hsf_shape = (*self.batch_shape, self.config.n_slices, self.config.L_sites)
+        self.field = HSField(hsf_shape, self.coupling, attractive=self.attractive, device=self.device)
+        self.hsf = self.field.h
+        self.V_up = self.field.V_up
+        self.V_dn = self.field.V_dn
+
+        # Initialize Green's functions with buffers for delayed updates
+        self._init_greens()
+
+        # Compiled slice update kernel (None runs the per-site Python loop) and its operands
+        self.update_kernel = get_update_kernel(config.update_backend)
+        self._init_site_buffers()
 
         # Initialize workspace for matrix operations
-        self.workspace = Workspace(config.L_sites)
-
-        # Initialize measurements
+        self.workspace = Workspace(config.L_sites, batch_shape=self.batch_shape, dtype=self.dtype)
+
+        # Initialize measurements, a bin file leaves only the current bin in memory
+        n_bins = 1 if config.bin_file is not None else config.n_bins
+        self.phy0 = PhysicalMeasurements(
+            n=config.L_sites,
+            n_bins=n_bins,
+            n_class=self.lattice.nclass,
+            myclass=self.lattice.myclass,
+            phase=self.lattice.phase if "#PHASE" in self.geometry.sections else None,
+            gf_phase=self.lattice.gf_phase,
+            U=config.U,
+            device=self.device,
+        )
         self.measurements = TimeDependentMeasurements(
             nsites=config.L_sites,
             ntau=config.n_slices,
-            nbins=config.n_bins,
+            nbins=n_bins,
             nclass=self.lattice.nclass,
+            myclass=self.lattice.myclass,
+            device=self.device,
         )
+        self.bin_store = None
+        if config.bin_file is not None:
+            self.bin_store = BinStore(config.bin_file, self._bin_shapes(), meta=self._bin_meta())
 
         # Initialize B matrices for propagation
         self.B_up = torch.zeros((self.config.L_sites, self.config.L_sites), device=self.device)
         self.B_dn = torch.zeros((self.config.L_sites, self.config.L_sites), device=self.device)
+        self.Bi_up = torch.zeros_like(self.B_up)
+        self.Bi_dn = torch.zeros_like(self.B_dn)
         self._init_B_matrices()
 
+        # Stratified B-matrix product caches, one per spin
+        self.seqb_up = SeqB(
+            n=config.L_sites,
+            L=config.n_slices,
+            n_orth=config.n_orth,
+            B=self.matb_up,
+            device=self.device,
+            batch_shape=self.batch_shape,
+            dtype=self.dtype,
+            workspace=self.workspace,
+        )
+        self.seqb_dn = SeqB(
+            n=config.L_sites,
+            L=config.n_slices,
+            n_orth=config.n_orth,
+            B=self.matb_dn,
+            device=self.device,
+            batch_shape=self.batch_shape,
+            dtype=self.dtype,
+            workspace=self.workspace,
+        )
+
+        # Unequal-time Green's functions on the blocks of the SeqB caches
+        nb = self.seqb_up.nblocks
+        self.gtau = GTau(
+            n=config.L_sites,
+            L=config.n_slices,
+            nb=nb,
+            nnb=nb * config.L_sites,
+            it_up=0,
+            i0_up=0,
+            it_dn=0,
+            i0_dn=0,
+            north=config.n_orth,
+            device=self.device,
+        )
+        self.gtau.set_g0(self.B_up, self.B_dn)
+
+        # Progress, restored from a checkpoint on restart
+        self.n_sweeps = 0
+        self.warm = False
+
+    def _init_lattice(self) -> None:
+        """Lattice, pair classes and hopping matrix K from the geometry file
+
+        K is the matrix of the kinetic energy sum_ij K_ij c_i^+ c_j, -t times
+        the t_up of #HAMILT. With geom_cache the geometry is read from the
+        cache when an earlier run built it.
+        """
+        config = self.config
+        params = {"device": self.device, "mu_up": config.mu, "mu_dn": config.mu}
+        if config.supercell is not None:
+            params["supercell"] = config.supercell
+        self.geom_cache = None
+        if config.geom_cache is not None:
+            self.geom_cache = GeometryCache(config.geom_cache, max_bytes=config.geom_cache_max_bytes)
+        self.geometry = GeometryWrapper(params)
+        self.geometry.init_from_file(Path(config.geometry), cache=self.geom_cache)
+        self.lattice = self.geometry.lattice
+
+        if self.lattice.nsites != config.L_sites:
+            raise ValueError(f"{config.geometry} has {self.lattice.nsites} sites, L_sites is {config.L_sites}")
+        t_up = self.geometry.hamiltonian.t_up
+        if t_up.is_complex():
+            raise ValueError("Twisted boundary conditions give a complex hopping, DQMC needs a real one")
+        self.hopping = -config.t * t_up.to_dense().to(self.device, torch.get_default_dtype())
+        self.hop_t = -self.hopping  # hopping amplitudes t_ij of the kinetic energy
+
+    def _init_greens(self) -> None:
+        """Green's functions of both spins with their delayed update and wrap settings"""
+        config = self.config
+        n_blk = config.n_blk if config.n_blk > 0 else tune_block_size(config.L_sites, self.dtype)
+        g_shape = (*self.batch_shape, config.L_sites, config.L_sites)
+        self.G_up = torch.zeros(g_shape, dtype=self.dtype, device=self.device)
+        self.G_dn = torch.zeros(g_shape, dtype=self.dtype, device=self.device)
+        wrap_params = {
+            "n_wrap": config.n_delay,
+            "wps": config.n_delay,
+            "max_wrap": 3 * config.n_delay,
+            "fix_wrap": 1 if config.fix_wrap else -1,
+            "diff_lim": config.diff_lim,
+            "err_rate": config.err_rate,
+        }
+        self.gf_up = GreenFunction(
+            n=config.L_sites,
+            L=config.n_slices,
+            G=self.G_up,
+            V=self.V_up,
+            ilb=-1,
+            det=0.0,
+            sign=torch.ones(self.batch_shape, device=self.device),
+            n_blk=n_blk,
+            device=self.device,
+            **wrap_params,
+        )
+        self.gf_dn = GreenFunction(
+            n=config.L_sites,
+            L=config.n_slices,
+            G=self.G_dn,
+            V=self.V_dn,
+            ilb=-1,
+            det=0.0,
+            sign=torch.ones(self.batch_shape, device=self.device),
+            n_blk=n_blk,
+            device=self.device,
+            **wrap_params,
+        )
+
+    def _init_site_buffers(self) -> None:
+        """Operands and temporaries of the slice update kernel, in the dtype of G"""
+        self.site_buffers = SiteBuffers(
+            self.batch_shape,
+            self.config.L_sites,
+            self.gf_up.n_blk,
+            dtype=self.dtype,
+            device=self.device,
+        )
+        self.flip_scale = torch.tensor(-2 * self.coupling, device=self.device)
+
     def _init_B_matrices(self) -> None:
-        """Initialize B matrices for propagation"""
+        """B matrices for propagation and the engines applying them
+
+        The dense engine multiplies by the matrix exponentials. MatB applies
+        the checkerboard bond rotations instead and only wins past N ~ 2000
+        (bench_checkerboard.py). B_up/B_dn are then its dense form, so that
+        G0 and the weights belong to the chain that is sampled.
+        """
+        config = self.config
+        if config.b_engine not in B_ENGINES:
+            raise ValueError(f"Unknown B engine {config.b_engine}, expected one of {', '.join(B_ENGINES)}")
+
         # Kinetic energy part
-        self.B_up = -self.config.dt * self.lattice.hopping
+        self.B_up = -self.config.dt * self.hopping
         self.B_dn = self.B_up.clone()
 
         # Add chemical potential
         mu_mat = torch.eye(self.config.L_sites, device=self.device) * self.config.mu
-        self.B_up -= mu_mat
-        self.B_dn -= mu_mat
+        self.B_up += self.config.dt * mu_mat
+        self.B_dn += self.config.dt * mu_mat
 
-        # Exponentiate
+        # Exponentiate, the inverses are used to wrap G between slices
+        self.Bi_up = torch.matrix_exp(-self.B_up)
+        self.Bi_dn = torch.matrix_exp(-self.B_dn)
         self.B_up = torch.matrix_exp(self.B_up)
         self.B_dn = torch.matrix_exp(self.B_dn)
 
+        if config.b_engine == "dense":
+            self.matb_up = DenseB(config.L_sites, self.B_up, self.Bi_up, device=self.device)
+            self.matb_dn = DenseB(config.L_sites, self.B_dn, self.Bi_dn, device=self.device)
+            return
+
+        # Both spins share the hopping and mu, so one MatB serves both
+        ckb = CheckerBoard({"device": self.device})
+        self.matb_up = self.matb_dn = ckb.init_B_from_hopping(self.hopping, config.mu, config.dt)
+        ones = torch.ones(config.L_sites, device=self.device)
+        for B in (self.B_up, self.Bi_up):
+            B.copy_(torch.eye(config.L_sites, device=self.device))
+        self.matb_up.mult_left(self.B_up, ones)
+        self.matb_up.mult_left_inv(self.Bi_up, ones)
+        self.B_dn.copy_(self.B_up)
+        self.Bi_dn.copy_(self.Bi_up)
+
     @torch.no_grad()
     def warmup(self) -> None:
-        """Perform warmup sweeps"""
-        for _ in range(self.config.n_warm):
+        """Perform warmup sweeps, a restarted run only does the ones it had not done"""
+        if self.warm:
+            return
+        for _ in range(self.n_sweeps, self.config.n_warm):
             self.sweep(measure=False)
+        self.warm = True
 
+    @torch.no_grad()
+    def run(self, n_sweeps: int) -> None:
+        """Warm up, then fill every bin with n_sweeps // n_bins sweeps, measuring every measure_stride-th (tausk)
+
+        Every bin gets at least one measured sweep. The errors are left to
+        the caller, which may first combine the bins of several processes.
+        """
+        stride = self.config.measure_stride
+        if stride < 1:
+            raise ValueError("measure_stride must be positive")
+
+        self.warmup()
+        n_meas = max(1, n_sweeps // (self.config.n_bins * stride))
+        for _ in range(self.config.n_bins):
+            for _ in range(n_meas):
+                for _ in range(stride - 1):
+                    self.sweep(measure=False)
+                self.sweep(measure=True)
+            self.end_bin()
+
+        if self.geom_cache is not None:
+            logger.info("%s", self.geom_cache.report())
+
+    @profiled("sweep")
     @torch.no_grad()
     def sweep(self, measure: bool = True) -> None:
         """Perform one sweep through all HSF fields"""
@@ -68,102 +308,378 @@ class DQMC:
 
         # Loop over all time slices
         for slice_idx in range(self.config.n_slices):
+            # Wrap or recompute Green's functions for this slice
+            self._get_greens(slice_idx, U, D, T)
+
             # Update HSF fields
             self._update_slice(slice_idx, U, D, T)
 
-            # Compute Green's functions if needed
-            if slice_idx % self.config.n_delay == 0:
-                self._compute_greens(slice_idx, U, D, T)
+            # Perform measurements if requested
+            if measure and slice_idx % self.config.n_measure == 0:
+                self._measure(slice_idx)
 
-                # Perform measurements if requested
-                if measure and slice_idx % self.config.n_measure == 0:
-                    self._measure(slice_idx)
+        # Adapt the wrap interval, both spins share the bookkeeping of G_up
+        self.gf_up.update_wraps()
 
-    def _update_slice(self, slice_idx: int, U: torch.Tensor, D: torch.Tensor, T: torch.Tensor) -> None:
-        """Update HSF fields for a given time slice"""
-        # Local updates using Metropolis algorithm
-        for site in range(self.config.L_sites):
-            # Compute acceptance ratio
-            delta_s = self._compute_delta_s(slice_idx, site)
+        if measure and self.config.tdm:
+            self._measure_tdm()
 
-            # Accept/reject update
-            if torch.rand(1, device=self.device) < torch.min(torch.exp(-delta_s), torch.ones_like(delta_s)):
-                self.hsf[slice_idx, site] *= -1
-                self._update_greens(slice_idx, site, U, D, T)
+        self.n_sweeps += 1
 
-    def _compute_delta_s(self, slice_idx: int, site: int) -> torch.Tensor:
-        """Compute change in action for proposed update"""
-        # Get current HSF value and its proposed flip
-        hsf_old = self.hsf[slice_idx, site]
-        hsf_new = -hsf_old
+    @profiled("get_greens")
+    def _get_greens(self, slice_idx: int, U: torch.Tensor, D: torch.Tensor, T: torch.Tensor) -> None:
+        """Bring G to slice_idx by wrapping, recomputing it every n_wrap slices"""
+        gf = self.gf_up
 
-        # Compute change in interaction term
-        delta_v = self.config.U * (hsf_new - hsf_old)
+        if gf.ilb != (slice_idx - 1) % self.config.n_slices:
+            # No G of the previous slice to wrap from
+            self._compute_greens(slice_idx, U, D, T)
+            gf.wps = gf.n_wrap
+        else:
+            self._wrap_greens(slice_idx)
+            gf.wps -= 1
 
-        # Compute determinant ratio using Green's functions
-        det_ratio_up = 1 + (1 - self.G_up[site, site]) * (torch.exp(delta_v) - 1)
-        det_ratio_dn = 1 + (1 - self.G_dn[site, site]) * (torch.exp(-delta_v) - 1)
+            if gf.wps <= 0:
+                # Recompute and measure how far the wrapped G drifted
+                G_up_wrapped = self.workspace.R3
+                G_dn_wrapped = self.workspace.R4
+                G_up_wrapped.copy_(self.G_up)
+                G_dn_wrapped.copy_(self.G_dn)
 
-        # Return change in action
-        return -torch.log(det_ratio_up * det_ratio_dn)
+                self._compute_greens(slice_idx, U, D, T)
 
-    def _update_greens(self, slice_idx: int, site: int, U: torch.Tensor, D: torch.Tensor, T: torch.Tensor) -> None:
-        """Update Green's functions after accepted update using Sherman-Morrison formula"""
-        # Get interaction change
-        delta_v = 2 * self.config.U * self.hsf[slice_idx, site]
+                diff = self.workspace.diff
+                torch.amax(G_up_wrapped.sub_(self.G_up).abs_().view(-1), 0, out=diff[0])
+                torch.amax(G_dn_wrapped.sub_(self.G_dn).abs_().view(-1), 0, out=diff[1])
+                diff = max(diff.tolist())
+                gf.record_wrap_error(diff)
+
+                if self.mixed and diff > self.config.mixed_fallback:
+                    self._use_double(slice_idx, U, D, T)
+
+        gf.ilb = slice_idx
+        self.gf_dn.ilb = slice_idx
+
+    def _use_double(self, slice_idx: int, U: torch.Tensor, D: torch.Tensor, T: torch.Tensor) -> None:
+        """Leave mixed precision for the rest of the run, G is recomputed in float64"""
+        logger.warning("Wrap error above %g in mixed precision, continuing in double", self.config.mixed_fallback)
+        self.leave_mixed()
+        self._compute_greens(slice_idx, U, D, T)
+
+    def leave_mixed(self) -> None:
+        """Run in the stabilization dtype from now on, G has to be recomputed"""
+        self.mixed = False
+        self.dtype = self.stab_dtype
+
+        self.gf_up.set_dtype(self.dtype)
+        self.gf_dn.set_dtype(self.dtype)
+        self.G_up = self.gf_up.G
+        self.G_dn = self.gf_dn.G
+        self.workspace.set_dtype(self.dtype)
+        self.seqb_up.set_dtype(self.dtype)
+        self.seqb_dn.set_dtype(self.dtype)
+        self._init_site_buffers()
+
+    @profiled("wrap_greens")
+    def _wrap_greens(self, slice_idx: int) -> None:
+        """Wrap G to the next slice: G(l) = B_l G(l-1) B_l^-1"""
+        for G, matb, V in ((self.G_up, self.matb_up, self.V_up), (self.G_dn, self.matb_dn, self.V_dn)):
+            matb.mult_left(G, V[..., slice_idx, :])
+            matb.mult_right_inv(G, V[..., slice_idx, :])
+
+    @profiled("update_slice")
+    def _update_slice(self, slice_idx: int, U: torch.Tensor, D: torch.Tensor, T: torch.Tensor) -> None:
+        """Update HSF fields for a given time slice"""
+        if self.update_kernel is not None:
+            self._update_slice_fast(slice_idx)
+            return
 
-        # Update up spin Green's function
-        x = (torch.exp(delta_v) - 1) * (1 - self.G_up[site, site])
-        self.G_up -= torch.ger(self.G_up[:, site], self.G_up[site, :]) * x / (1 + x)
+        # Local updates using Metropolis algorithm
+        for site in range(self.config.L_sites):
+            # Compute determinant ratios
+            alpha_up, r_up, alpha_dn, r_dn, ratio = self._compute_ratios(slice_idx, site)
 
-        # Update down spin Green's function
-        x = (torch.exp(-delta_v) - 1) * (1 - self.G_dn[site, site])
-        self.G_dn -= torch.ger(self.G_dn[:, site], self.G_dn[site, :]) * x / (1 + x)
+            # Accept/reject update
+            if torch.rand(1, device=self.device) < torch.clamp(torch.abs(ratio), max=1.0):
+                self._update_greens(slice_idx, site, alpha_up, r_up, alpha_dn, r_dn)
+
+                # The cached block product containing this slice is now stale
+                self.seqb_up.invalidate(slice_idx)
+                self.seqb_dn.invalidate(slice_idx)
+
+        # Flush the delayed updates still pending
+        self.gf_up.apply_update(forced=True)
+        self.gf_dn.apply_update(forced=True)
+
+    def _update_slice_fast(self, slice_idx: int) -> None:
+        """Update HSF fields for a given time slice with the compiled kernel"""
+        # Relative changes of V and random numbers for the whole slice at once
+        buffers = self.site_buffers
+        self._slice_flip_factors(slice_idx, buffers)
+        buffers.rand.uniform_()
+
+        accepted = self.update_kernel(
+            self.G_up,
+            self.gf_up.U,
+            self.gf_up.W,
+            self.G_dn,
+            self.gf_dn.U,
+            self.gf_dn.W,
+            buffers.alpha_up,
+            buffers.alpha_dn,
+            buffers.boson,
+            buffers.rand,
+            self.gf_up.sign,
+            self.gf_dn.sign,
+            buffers,
+        )
 
+        # Apply the accepted flips to the fields in one pass
+        self.field.flip(slice_idx, accept=accepted)
+
+        self.seqb_up.invalidate(slice_idx)
+        self.seqb_dn.invalidate(slice_idx)
+
+    def _flip_factors(self, h: torch.Tensor) -> tuple[torch.Tensor, torch.Tensor, torch.Tensor]:
+        """Relative changes of V_up and V_dn and ratio of the bosonic weight for flipping h
+
+        The charge decoupling of an attractive U carries a factor exp(-lambda h)
+        per field next to the determinants, a flip changes it by exp(2 lambda h).
+        """
+        delta_v = -2 * self.coupling * h.to(torch.get_default_dtype())
+        alpha_up = torch.expm1(delta_v)
+        if self.attractive:
+            return alpha_up, alpha_up, torch.exp(-delta_v)
+        return alpha_up, torch.expm1(-delta_v), torch.ones_like(alpha_up)
+
+    def _slice_flip_factors(self, slice_idx: int, buffers: SiteBuffers) -> None:
+        """_flip_factors of every site of a slice, written into buffers"""
+        delta_v = buffers.delta.copy_(self.hsf[..., slice_idx, :]).mul_(self.flip_scale)
+        torch.expm1(delta_v, out=buffers.alpha_up)
+        if self.attractive:
+            buffers.alpha_dn.copy_(buffers.alpha_up)
+            torch.exp(delta_v.neg_(), out=buffers.boson)
+        else:
+            torch.expm1(delta_v.neg_(), out=buffers.alpha_dn)
+
+    def _compute_ratios(self, slice_idx: int, site: int) -> tuple[torch.Tensor, ...]:
+        """Determinant ratios and total weight ratio for flipping the HSF at (slice_idx, site)"""
+        alpha_up, alpha_dn, boson = self._flip_factors(self.hsf[..., slice_idx, site])
+
+        # Diagonal of G including the updates not yet applied
+        r_up = 1 + (1 - self.gf_up.get_jj(site)) * alpha_up
+        r_dn = 1 + (1 - self.gf_dn.get_jj(site)) * alpha_dn
+        return alpha_up, r_up, alpha_dn, r_dn, r_up * r_dn * boson
+
+    def _update_greens(
+        self,
+        slice_idx: int,
+        site: int,
+        alpha_up: torch.Tensor,
+        r_up: torch.Tensor,
+        alpha_dn: torch.Tensor,
+        r_dn: torch.Tensor,
+        accept: torch.Tensor | None = None,
+    ) -> None:
+        """Flip the field and queue the rank-1 Sherman-Morrison updates of an accepted flip
+
+        accept masks the flip per walker, rejected walkers get an empty
+        column in the update panels.
+        """
+        if accept is not None:
+            alpha_up = alpha_up * accept
+            alpha_dn = alpha_dn * accept
+            r_up = torch.where(accept, r_up, 1.0)
+            r_dn = torch.where(accept, r_dn, 1.0)
+
+        # det G^-1 changes by the ratio r
+        self.gf_up.sign *= torch.sign(r_up)
+        self.gf_dn.sign *= torch.sign(r_dn)
+
+        self.gf_up.update_G(site, alpha_up / r_up)
+        self.gf_dn.update_G(site, alpha_dn / r_dn)
+        self.field.flip(slice_idx, site, accept)
+
+    @profiled("compute_greens")
     def _compute_greens(self, slice_idx: int, U: torch.Tensor, D: torch.Tensor, T: torch.Tensor) -> None:
-        """Compute Green's functions using UDV decomposition"""
-        # Initialize UDV decomposition
-        U.copy_(torch.eye(self.config.L_sites, device=self.device))
-        D.copy_(torch.ones(self.config.L_sites, device=self.device))
-        T.copy_(torch.eye(self.config.L_sites, device=self.device))
-
-        # Multiply B matrices and interaction terms
-        for i in range(slice_idx, -1, -1):
-            # Multiply by B matrix
-            self._multiply_B(U, D, T, up_spin=True)
-            self._multiply_B(U, D, T, up_spin=False)
-
-            # Multiply by interaction term
-            self._multiply_V(i, U, D, T)
-
-        # Compute Green's functions
-        self.G_up = torch.inverse(U + T)
-        self.G_dn = self.G_up.clone()
-
-    def _multiply_B(self, U: torch.Tensor, D: torch.Tensor, T: torch.Tensor, up_spin: bool) -> None:
-        """Multiply UDT decomposition by B matrix"""
-        B = self.B_up if up_spin else self.B_dn
-        U.copy_(torch.mm(B, U))
-        T.copy_(torch.mm(T, B.t()))
-
-    def _multiply_V(self, slice_idx: int, U: torch.Tensor, D: torch.Tensor, T: torch.Tensor) -> None:
-        """Multiply UDT decomposition by interaction term"""
-        V = torch.diag(torch.exp(self.config.U * self.hsf[slice_idx]))
-        U.copy_(torch.mm(V, U))
-        T.copy_(torch.mm(T, V))
+        """Compute Green's functions from the stratified B-matrix products"""
+        self.seqb_up.multiply(slice_idx, self.V_up, U, D, T)
+        self._greens_from_udt(U, D, T, self.G_up, self.seqb_up.t_sign, self.gf_up.sign)
+
+        self.seqb_dn.multiply(slice_idx, self.V_dn, U, D, T)
+        self._greens_from_udt(U, D, T, self.G_dn, self.seqb_dn.t_sign, self.gf_dn.sign)
+
+    @torch.no_grad()
+    def log_weight(self, hsf: torch.Tensor | None = None) -> torch.Tensor:
+        """Log weight of the current HSF or of hsf
+
+        log |det(I + B_{L-1} ... B_0)| summed over both spins, plus the
+        -lambda sum(h) of the charge decoupling for an attractive U.
+        """
+        U = self.workspace.R1
+        D = self.workspace.R5
+        T = self.workspace.R2
 
+        if hsf is None:
+            V_up, V_dn = self.V_up, self.V_dn
+        else:
+            V_up, V_dn = self.field.exp(hsf)
+            self.seqb_up.invalidate()
+            self.seqb_dn.invalidate()
+
+        logw = torch.zeros(self.batch_shape, device=self.device)
+        if self.attractive:
+            h = self.hsf if hsf is None else hsf
+            logw -= self.coupling * h.to(logw.dtype).sum((-2, -1))
+        for seqb, V in ((self.seqb_up, V_up), (self.seqb_dn, V_dn)):
+            seqb.multiply(self.config.n_slices - 1, V, U, D, T)
+            logw += self._log_det_udt(U, D, T)
+
+        if hsf is not None:
+            # The caches hold the block products of hsf now
+            self.seqb_up.invalidate()
+            self.seqb_dn.invalidate()
+        return logw
+
+    def set_hsf(self, hsf: torch.Tensor) -> None:
+        """Replace the HSF configuration, G is recomputed from scratch at the next slice"""
+        self.field.set(hsf)
+
+        self.seqb_up.invalidate()
+        self.seqb_dn.invalidate()
+        self.gf_up.ilb = -1
+        self.gf_dn.ilb = -1
+
+    def _factor_udt(self, U: torch.Tensor, D: torch.Tensor, T: torch.Tensor) -> torch.Tensor:
+        """LU factors of A = Db^-1 U^t + Ds T with D = Db Ds, returns Db
+
+        Works in the workspace: the factors are left column-major in LU, Ds
+        replaces D, A replaces T and Db^-1 U^t is left in R8.
+        """
+        ws = self.workspace
+        Db = ws.R6
+        torch.abs(D, out=Db)
+        torch.le(Db, ws.one, out=ws.mask)
+        Db.copy_(D).masked_fill_(ws.mask, 1.0)
+        D.div_(Db)
+        scalerowadd_(Db, U, D, T, ws.R8)
+        torch.linalg.lu_factor_ex(T, out=(ws.LU, ws.piv, ws.info))
+        return Db
+
+    def _log_det_udt(self, U: torch.Tensor, D: torch.Tensor, T: torch.Tensor) -> torch.Tensor:
+        """Log of |det(I + U D T)| = |det Db| |det(Db^-1 U^t + Ds T)| with D = Db Ds"""
+        Db = self._factor_udt(U, D, T)
+        LU = self.workspace.LU
+        return torch.log(Db.abs()).sum(-1) + torch.log(torch.diagonal(LU, 0, -2, -1).abs()).sum(-1)
+
+    def _greens_from_udt(
+        self,
+        U: torch.Tensor,
+        D: torch.Tensor,
+        T: torch.Tensor,
+        G: torch.Tensor,
+        t_sign: torch.Tensor,
+        sign: torch.Tensor,
+    ) -> None:
+        """Compute G = (I + U D T)^-1 = (Db^-1 U^t + Ds T)^-1 Db^-1 U^t with D = Db Ds, U D T are overwritten
+
+        The sign of det G^-1 = det U det Db det A is written into sign. With
+        det(U D T) > 0, sign det U = sign det D sign det T, so the signs of Db
+        cancel and it is sign det Ds sign det T sign det A, with t_sign = sign det T.
+        The solve goes through the row permutation and two triangular solves
+        on the workspace, none of which allocates.
+        """
+        self._factor_udt(U, D, T)
+        ws = self.workspace
+        torch.lu_unpack(ws.LU, ws.piv, unpack_data=False, out=(ws.P, ws.no_data, ws.no_data))
+        torch.matmul(ws.P.mT, ws.R8, out=ws.R9)
+        torch.linalg.solve_triangular(ws.LU, ws.R9, upper=False, unitriangular=True, out=ws.R10)
+        torch.linalg.solve_triangular(ws.LU, ws.R10, upper=True, out=ws.R9)
+        G.copy_(ws.R9)
+
+        # Every row swap of the LU flips the sign of det A
+        s = ws.R6
+        torch.ne(ws.piv, ws.rows, out=ws.mask)
+        torch.prod(s.fill_(1.0).masked_fill_(ws.mask, -1.0), -1, out=ws.sgn)
+        sign.copy_(ws.sgn)
+        for factor in (torch.diagonal(ws.LU, 0, -2, -1), D):
+            torch.prod(torch.sign(factor, out=s), -1, out=ws.sgn)
+            sign.mul_(ws.sgn)
+        sign.mul_(t_sign)
+
+    @profiled("measure")
     def _measure(self, slice_idx: int) -> None:
-        """Perform measurements"""
-        self.measurements.measure_tdm(
-            gtau_up=self.G_up,
-            gtau_dn=self.G_dn,
-            sign=self._compute_sign(),
-            bin_idx=self.config.current_bin,
+        """Perform measurements, measure only reads the signs so they are passed without a copy"""
+        self.phy0.curr_bin = self._bin_idx()
+        self.phy0.measure(
+            self.G_up.to(self.stab_dtype),
+            self.G_dn.to(self.stab_dtype),
+            mu=(self.config.mu, self.config.mu),
+            t=self.hop_t,
+            sign_up=self.gf_up.sign,
+            sign_dn=self.gf_dn.sign,
         )
 
-    def _compute_sign(self) -> float:
-        """Compute Monte Carlo sign"""
-        # For Hubbard model, sign is product of determinants
-        sign_up = torch.det(torch.eye(self.config.L_sites, device=self.device) + self.G_up).sign()
-        sign_dn = torch.det(torch.eye(self.config.L_sites, device=self.device) + self.G_dn).sign()
-        return float(sign_up * sign_dn)
+    @profiled("measure_tdm")
+    def _measure_tdm(self) -> None:
+        """Perform time-dependent measurements, averaged over the block start times"""
+        sign = self.gtau.load(TAU_UP, self.seqb_up, self.V_up) * self.gtau.load(TAU_DN, self.seqb_dn, self.V_dn)
+
+        for i0 in range(self.gtau.nb):
+            upt0, up0t, uptt = self.gtau.make_gtau(TAU_UP, i0)
+            dnt0, dn0t, dntt = self.gtau.make_gtau(TAU_DN, i0)
+            self.measurements.measure_tdm(
+                upt0,
+                up0t,
+                uptt,
+                dnt0,
+                dn0t,
+                dntt,
+                sign=sign / self.gtau.nb,
+                bin_idx=self._bin_idx(),
+            )
+
+    def _bin_idx(self) -> int:
+        """Bin being filled, the only resident one when streaming to a bin file"""
+        return 0 if self.bin_store is not None else self.config.current_bin
+
+    def _bin_shapes(self) -> dict[str, tuple[int, ...]]:
+        """Blocks of one bin in the bin file"""
+        shapes = {f"phy0.{name}": shape for name, shape in self.phy0.bin_shapes().items()}
+        if self.config.tdm:
+            shapes |= {f"tdm.{name}": shape for name, shape in self.measurements.bin_shapes().items()}
+        return shapes
+
+    def _bin_meta(self) -> dict:
+        """Header of the bin file"""
+        return {
+            "observables": [o.name for o in Observable],
+            "correlations": list(CORRELATIONS),
+            "tdm_properties": list(TDM_PROPERTIES) if self.config.tdm else [],
+            "nsites": self.config.L_sites,
+            "ntau": self.config.n_slices,
+            "dt": self.config.dt,
+            "U": self.config.U,
+            "mu": self.config.mu,
+            "nclass": self.lattice.nclass,
+            "class_size": self.phy0.class_size,
+            "class_label": self.lattice.class_label,
+            "kpoints": getattr(self.lattice, "klist", None),
+        }
+
+    def end_bin(self) -> None:
+        """Close the current bin
+
+        With a bin file the bin is appended to it and cleared, otherwise
+        measurements move on to the next in-memory bin.
+        """
+        if self.bin_store is None:
+            self.config.current_bin += 1
+            return
+
+        record = {f"phy0.{name}": value for name, value in self.phy0.bin_record(0).items()}
+        if self.config.tdm:
+            record |= {f"tdm.{name}": value for name, value in self.measurements.bin_record(0).items()}
+        self.bin_store.append(record)
+        self.phy0.reset_bin(0)
+        self.measurements.reset_bin(0)
@@ -0,0 +1,189 @@
+# src/geomcache.py
+import contextlib
+import hashlib
+import json
+import os
+import pickle
+from dataclasses import dataclass
+from pathlib import Path
+
+import torch
+
+from geometry import Bonds, GeometryWrapper, Hamiltonian
+from kbonds import KBonds
+from lattice import Lattice
+from reciprocal import ReciprocalLattice
+from structure import LatticeStructure
+from symmetry import SymmetryOperations
+
+VERSION = 4
+
+# Parts of GeometryWrapper kept in the cache and their classes
+COMPONENTS = {
+    "lattice": Lattice,
+    "recip_lattice": ReciprocalLattice,
+    "gamma_lattice": ReciprocalLattice,
+    "hamiltonian": Hamiltonian,
+    "symmetry": SymmetryOperations,
+    "structure": LatticeStructure,
+    "bonds": Bonds,
+    "kbonds": KBonds,
+}
+
+# Configuration entries that change the constructed geometry
+KEY_CONFIG = ("supercell", "kpoint")
+
+
+def _pack(value: object) -> object:
+    """Make an attribute loadable with weights_only, sparse tensors are split into indices and values"""
+    if isinstance(value, torch.Tensor) and value.is_sparse:
+        value = value.coalesce()
+        return {"__sparse__": True, "indices": value.indices(), "values": value.values(), "size": list(value.shape)}
+    if isinstance(value, torch.Tensor):
+        return value.detach().cpu()
+    if value is None or isinstance(value, torch.device):
+        return None
+    if isinstance(value, bool | int | float | str):
+        return value
+    if isinstance(value, list | tuple):
+        return type(value)(_pack(v) for v in value)
+    if isinstance(value, dict):
+        return {k: _pack(v) for k, v in value.items()}
+    raise TypeError(f"Cannot cache a {type(value).__name__}")
+
+
+def _unpack(value: object, device: torch.device) -> object:
+    """Inverse of _pack"""
+    if isinstance(value, dict) and value.get("__sparse__"):
+        indices = value["indices"].to(device)
+        values = value["values"].to(device)
+        return torch.sparse_coo_tensor(indices, values, value["size"], is_coalesced=True)
+    if isinstance(value, torch.Tensor):
+        return value if value.device == device else value.to(device)
+    if isinstance(value, list | tuple):
+        return type(value)(_unpack(v, device) for v in value)
+    if isinstance(value, dict):
+        return {k: _unpack(v, device) for k, v in value.items()}
+    return value
+
+
+@dataclass
+class GeometryCache:
+    """On-disk cache of constructed and analyzed geometries
+
+    Entries are keyed by the hash of the .geom content and of the config
+    entries that change the geometry (supercell, k-point), so a parameter
+    sweep over U and mu on one lattice builds it once, mu is set on the
+    Hamiltonian of every loaded entry. Entries hold
+    only tensors, containers and plain values and are read with
+    torch.load(mmap=True, weights_only=True), their tensors stay on disk
+    until touched.
+    When the cache grows beyond max_bytes the least recently used entries
+    are dropped.
+    """
+
+    root: Path
+    max_bytes: int = 1 << 30  # size limit of all entries together
+    verbose: bool = False  # print every hit and miss
+
+    def __post_init__(self):
+        self.root = Path(self.root)
+        self.root.mkdir(parents=True, exist_ok=True)
+        self.hits = 0
+        self.misses = 0
+        self.evicted = 0
+
+    def key(self, content: str, config: dict) -> str:
+        """Cache key of a .geom content and a GeometryWrapper config"""
+        h = hashlib.sha256()
+        h.update(f"v{VERSION}\n".encode())
+        h.update(content.encode())
+        params = {name: config[name] for name in KEY_CONFIG if name in config}
+        h.update(json.dumps(params, sort_keys=True, default=lambda v: torch.as_tensor(v).tolist()).encode())
+        return h.hexdigest()
+
+    def path(self, key: str) -> Path:
+        """File of the entry of key"""
+        return self.root / f"{key}.pt"
+
+    def load(self, wrapper: GeometryWrapper, key: str) -> bool:
+        """Fill wrapper from the entry of key, returns whether there was one"""
+        path = self.path(key)
+        try:
+            state = torch.load(path, mmap=True, weights_only=True, map_location="cpu")
+        except FileNotFoundError:
+            self._count(hit=False, key=key)
+            return False
+        except (RuntimeError, EOFError, pickle.UnpicklingError):
+            # Truncated entry of a killed job
+            path.unlink(missing_ok=True)
+            self._count(hit=False, key=key)
+            return False
+
+        for name, attrs in state["components"].items():
+            obj = object.__new__(COMPONENTS[name])
+            obj.__dict__.update({k: _unpack(v, wrapper.device) for k, v in attrs.items()})
+            obj.device = wrapper.device
+            setattr(wrapper, name, obj)
+        wrapper.sections = state["sections"]
+
+        # Mark as recently used for the eviction
+        with contextlib.suppress(FileNotFoundError):
+            os.utime(path)
+        self._count(hit=True, key=key)
+        return True
+
+    def store(self, wrapper: GeometryWrapper, key: str) -> None:
+        """Write the components of wrapper as the entry of key, then evict down to max_bytes"""
+        components = {}
+        for name in COMPONENTS:
+            obj = getattr(wrapper, name, None)
+            if obj is not None:
+                components[name] = _pack(vars(obj))
+        state = {"version": VERSION, "sections": _pack(wrapper.sections), "components": components}
+
+        # Several jobs may store the same entry, the rename makes that harmless
+        path = self.path(key)
+        tmp = path.with_name(f"{path.name}.{os.getpid()}.tmp")
+        torch.save(state, tmp)
+        tmp.replace(path)
+        self.evict(keep=path)
+
+    def entries(self) -> list[Path]:
+        """Entries from least to most recently used"""
+        return sorted(self.root.glob("*.pt"), key=lambda p: p.stat().st_mtime)
+
+    def size(self) -> int:
+        """Bytes taken by all entries"""
+        return sum(p.stat().st_size for p in self.entries())
+
+    def evict(self, keep: Path | None = None) -> None:
+        """Drop least recently used entries until the cache fits in max_bytes"""
+        entries = self.entries()
+        total = sum(p.stat().st_size for p in entries)
+        for p in entries:
+            if total <= self.max_bytes:
+                break
+            if p == keep:
+                continue
+            total -= p.stat().st_size
+            p.unlink(missing_ok=True)
+            self.evicted += 1
+
+    def _count(self, hit: bool, key: str) -> None:
+        """Book a lookup"""
+        if hit:
+            self.hits += 1
+        else:
+            self.misses += 1
+        if self.verbose:
+            print(f" Geometry cache {'hit' if hit else 'miss'}: {key[:12]}")
+
+    def report(self) -> str:
+        """Hit, miss and eviction counts with the current size"""
+        entries = self.entries()
+        size = sum(p.stat().st_size for p in entries)
+        return (
+            f" Geometry cache {self.root}: {self.hits} hits, {self.misses} misses, {self.evicted} evicted,"
+            f" {len(entries)} entries, {size / 2**20:.1f} of {self.max_bytes / 2**20:.1f} MB"
+        )
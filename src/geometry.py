@@ -1,9 +1,20 @@
 # src/geometry.py
 from dataclasses import dataclass
 from pathlib import Path
+from typing import TYPE_CHECKING
 
 import torch
 
+import reciprocal
+from config import GeomParams, parse_float, tokenize_geom
+from kbonds import KBonds
+from lattice import RDIM, Lattice
+from structure import LatticeStructure
+from symmetry import SymmetryOperations
+
+if TYPE_CHECKING:
+    from geomcache import GeometryCache
+
 DEVICE = torch.get_default_device()
 
 
@@ -29,27 +40,56 @@ class ReciprocalLattice:
 
 @dataclass
 class Hamiltonian:
-    t_up: torch.Tensor  # Hopping parameters up spin
-    t_dn: torch.Tensor  # Hopping parameters down spin
-    U: torch.Tensor  # Hubbard U values
+    t_up: torch.Tensor  # Hopping parameters up spin, sparse (nsites, nsites)
+    t_dn: torch.Tensor  # Hopping parameters down spin, sparse (nsites, nsites)
+    U: torch.Tensor  # Hubbard U values of every site pair, sparse (nsites, nsites)
     mu_up: torch.Tensor  # Chemical potential up
     mu_dn: torch.Tensor  # Chemical potential down
+    tckb: torch.Tensor | None = None  # sites i < j and primitive link of every hopping (3, nhop)
+    plink: torch.Tensor | None = None  # sites of every hopping, the first in its original cell (2, nhop)
+    tlink: torch.Tensor | None = None  # t_up, t_dn and displacement of every primitive link (5, nplink)
+    phase: torch.Tensor | None = None  # wave function phase of every site (not used in QMC)
+    device: torch.device = DEVICE
+
+
+@dataclass
+class Bonds:
+    origin: torch.Tensor  # site every bond starts from, an orbital of cell 0 (nbond)
+    target: torch.Tensor  # site every bond ends on (nbond)
+    label: torch.Tensor  # line of #BONDS of every bond from 1, negative for the reversed ones (nbond)
+    delta: torch.Tensor  # cartesian displacement of every bond (3, nbond)
+    bond_map: torch.Tensor  # bond of every pair, the columns of #PAIR (npair)
+    pair_map: torch.Tensor  # pair of every bond, -1 for bonds that are not pairs (nbond)
+    wave: torch.Tensor  # weight of every pair in every pairing wave function (nwave, npair)
+    wave_label: list[str]  # name of every wave function
     device: torch.device = DEVICE
 
 
 class GeometryWrapper:
+    """Geometry of a simulation read from a .geom file
+
+    config may hold "supercell" (rows of #SUPER or a linear size, overriding
+    the file), "kpoint" (twist in units of pi), "mu_up", "mu_dn" and "device".
+    """
+
     def __init__(self, config: dict):
         self.config = config
         self.device = config.get("device", torch.device("cuda" if torch.cuda.is_available() else "cpu"))
 
         # Initialize components
-        self.lattice: LatticeConfig | None = None
-        self.recip_lattice: ReciprocalLattice | None = None
-        self.gamma_lattice: ReciprocalLattice | None = None
+        self.params = GeomParams()
+        self.sections: dict[str, list[list[str]]] = {}
+        self.lattice: Lattice | None = None
+        self.recip_lattice: reciprocal.ReciprocalLattice | None = None
+        self.gamma_lattice: reciprocal.ReciprocalLattice | None = None
         self.hamiltonian: Hamiltonian | None = None
+        self.symmetry: SymmetryOperations | None = None
+        self.structure: LatticeStructure | None = None
+        self.bonds: Bonds | None = None
+        self.kbonds: KBonds | None = None
 
-    def init_from_file(self, geom_file: Path) -> None:
-        """Initialize geometry from input file"""
+    def init_from_file(self, geom_file: Path, cache: "GeometryCache | None" = None) -> None:
+        """Initialize geometry from input file, or from cache if it has built this one before"""
         if not geom_file.exists():
             raise FileNotFoundError(f"Cannot open geometry definition file {geom_file}")
 
@@ -57,12 +97,27 @@ class GeometryWrapper:
         with open(geom_file) as f:
             self.input_content = f.read()
 
+        if cache is not None:
+            key = cache.key(self.input_content, self.config)
+            if cache.load(self, key):
+                # mu is not part of the key, it only sets two scalars of the Hamiltonian
+                self.hamiltonian.mu_up = torch.tensor(self.config.get("mu_up", 0.0), device=self.device)
+                self.hamiltonian.mu_dn = torch.tensor(self.config.get("mu_dn", 0.0), device=self.device)
+                return
+
+        self.sections = tokenize_geom(self.input_content)
+        self.params.analyze_sections(self.sections)
+
         # Initialize lattice
         self._init_lattice()
 
         # Construct full lattice
         self._construct_lattice()
 
+        # Bonds and pairing wave functions of #BONDS and #PAIR
+        if "#BONDS" in self.sections:
+            self._construct_bonds()
+
         # Initialize and construct reciprocal lattices
         self._init_recip_lattice(include_gamma=False)  # Regular k-points
         self._init_recip_lattice(include_gamma=True)  # Including Gamma point
@@ -70,15 +125,245 @@ class GeometryWrapper:
         # Construct Hamiltonian
         self._construct_hamiltonian()
 
+        # Action of the point symmetries and translations
+        self._map_symmetries()
+
+        # Classes of equivalent site pairs and their Green's function phases
+        self._analyze_lattice()
+
+        if cache is not None:
+            cache.store(self, key)
+
     def _init_lattice(self) -> None:
         """Initialize basic lattice information"""
-        # Implementation will depend on input file format
+        rows = self.sections
+        ndim = int(rows["#NDIM"][0][0])
+
+        # Primitive vectors are the columns of ac, the frozen directions get a large one
+        ac = torch.zeros((RDIM, RDIM), dtype=torch.float64)
+        for j in range(ndim):
+            ac[:ndim, j] = torch.tensor([parse_float(tok) for tok in rows["#PRIM"][j][:ndim]], dtype=torch.float64)
+        for j in range(ndim, RDIM):
+            ac[j, j] = 1e3
+
+        # Supercell in units of the primitive vectors, also as columns
+        supercell = self.config.get("supercell", rows["#SUPER"])
+        if isinstance(supercell, int):
+            supercell = [[supercell if i == j else 0 for i in range(ndim)] for j in range(ndim)]
+        sc = torch.eye(RDIM, dtype=torch.int64)
+        for j in range(ndim):
+            sc[:ndim, j] = torch.tensor([int(tok) for tok in supercell[j][:ndim]], dtype=torch.int64)
+        ncell = round(abs(float(torch.linalg.det(sc.to(torch.float64)))))
+
+        # Orbitals of the primitive cell
+        orbitals = rows["#ORB"]
+        xat = torch.tensor([[parse_float(tok) for tok in row[1 : RDIM + 1]] for row in orbitals], dtype=torch.float64)
+        natom = len(orbitals)
+
+        self.lattice = Lattice(nsites=ncell * natom, natom=natom, ncell=ncell, ndim=ndim, device=self.device)
+        self.lattice.init_lattice(ac, sc, xat.t(), [row[0] for row in orbitals])
 
     def _construct_lattice(self) -> None:
         """Construct full lattice including neighbors"""
+        self.lattice.construct_lattice()
+        if "#PHASE" in self.sections:
+            self.lattice.assign_phase(self.sections["#PHASE"])
+
+    @torch.no_grad()
+    def _construct_bonds(self) -> None:
+        """Bonds of #BONDS and pairs of #PAIR (read_bonds, read_pairs)
+
+        Line k of #BONDS, "iat jat dx dy dz", is bond k from orbital iat of
+        cell 0 to orbital jat displaced by d; unless it is on site, its
+        reverse from jat back to iat is added as bond -k after all lines.
+        The first row of #PAIR lists the bond labels of the pairs, every
+        further row names a wave function and gives the weight of each pair.
+        """
+        lattice = self.lattice
+        natom = lattice.natom
+        lines = self.sections["#BONDS"]
+
+        forward, reverse = [], []
+        for k, line in enumerate(lines, start=1):
+            iat, jat = int(line[0]), int(line[1])
+            if iat >= natom or jat >= natom:
+                raise ValueError(f"Bond {k} connects an unspecified orbital")
+            delta = [parse_float(tok) for tok in line[2 : 2 + RDIM]]
+            forward.append((k, iat, jat, delta))
+            if iat != jat or any(abs(x) > GeomParams.TOLL for x in delta):
+                reverse.append((-k, jat, iat, [-x for x in delta]))
+
+        bonds = forward + reverse
+        label = torch.tensor([b[0] for b in bonds], dtype=torch.int64, device=self.device)
+        origin = torch.tensor([b[1] for b in bonds], dtype=torch.int64, device=self.device)
+        delta = torch.tensor([b[3] for b in bonds], dtype=torch.float64, device=self.device).t().reshape(RDIM, -1)
+        target = torch.stack([lattice.hoptowho(origin[i], delta[:, i], b[2]) for i, b in enumerate(bonds)])
+
+        # Pairs, looked up by their bond label
+        rows = self.sections.get("#PAIR", [])
+        pair_labels = [int(tok) for tok in rows[0]] if rows else []
+        index = {int(lb): i for i, lb in enumerate(label.tolist())}
+        missing = [lb for lb in pair_labels if lb not in index]
+        if missing:
+            raise ValueError(f"#PAIR refers to undefined bonds {missing}")
+        bond_map = torch.tensor([index[lb] for lb in pair_labels], dtype=torch.int64, device=self.device)
+        pair_map = torch.full((len(bonds),), -1, dtype=torch.int64, device=self.device)
+        pair_map[bond_map] = torch.arange(len(bond_map), device=self.device)
+
+        waves = rows[1:]
+        if any(len(row) != len(pair_labels) + 1 for row in waves):
+            raise ValueError(f"Every wave function of #PAIR needs a name and {len(pair_labels)} weights")
+        wave = torch.tensor([[parse_float(tok) for tok in row[1:]] for row in waves], dtype=torch.float64)
+
+        self.bonds = Bonds(
+            origin=origin,
+            target=target,
+            label=label,
+            delta=delta,
+            bond_map=bond_map,
+            pair_map=pair_map,
+            wave=wave.to(self.device).reshape(len(waves), len(pair_labels)),
+            wave_label=[row[0] for row in waves],
+            device=self.device,
+        )
+
+    def _map_symmetries(self) -> None:
+        """Read #SYMM and map the symmetries on sites, k-points once their grids are built, bonds and pairs"""
+        rows = self.sections.get("#SYMM", [])
+        self.symmetry = SymmetryOperations(
+            ntotsymm=len(rows),
+            nsymm=len(rows),
+            ntransl=self.lattice.ncell,
+            device=self.device,
+        )
+        self.symmetry.read_symmetries(rows)
+        self.symmetry.map_lattice(self.lattice, self.hamiltonian)
+        for recip, apply_twist in ((self.recip_lattice, True), (self.gamma_lattice, False)):
+            if recip.constructed:
+                self.symmetry.map_recip_lattice(recip, self.lattice, apply_twist=apply_twist)
+
+        # Bonds and pairs, after the twist has dropped the symmetries it breaks
+        if self.bonds is not None:
+            self.symmetry.map_bonds(self.bonds.origin, self.bonds.target)
+            if len(self.bonds.bond_map) > 0:
+                self.symmetry.map_pairs(self.bonds.bond_map, self.bonds.pair_map)
+
+    def _analyze_lattice(self) -> None:
+        """Classify the site pairs and the k-space bond pairs and assign the twist phases"""
+        map_symm = None
+        if self.symmetry is not None and self.symmetry.lattice_mapped:
+            map_symm = self.symmetry.map_symm
+        self.lattice.construct_classes(map_symm)
+        self.lattice.assign_gf_phase(self.recip_lattice.ktwist)
+
+        # Classes of k-space bond pairs of the pair measurements
+        if self.bonds is not None and len(self.bonds.bond_map) > 0:
+            self._construct_kbonds()
+
+    def _construct_kbonds(self) -> None:
+        """k-space bonds (a, k) - (b, q - k) of all orbitals and their classes for every momentum q
+
+        Built on the grid with Gamma, whose operations are the point
+        symmetries and time reversal, which leaves the orbitals in place.
+        The tables grow as natom^4 ncell^3, so only geometries with #PAIR
+        get them.
+        """
+        lattice, symm, recip = self.lattice, self.symmetry, self.gamma_lattice
+        natom, nk = lattice.natom, recip.nkpts
+        atom_map = symm.map_symm[:natom] % natom
+        if symm.add_time_rev:
+            atom_map = torch.cat([atom_map, torch.arange(natom, device=self.device).unsqueeze(1)], 1)
+
+        self.kbonds = KBonds(nak=natom * nk, nbonds=natom * natom * nk, nmomenta=nk, device=self.device)
+        self.kbonds.construct_kbonds(atom_map, symm.map_symm_g, recip.k_sum())
+        self.kbonds.construct_kbond_classes()
 
     def _init_recip_lattice(self, include_gamma: bool = False) -> None:
         """Initialize reciprocal lattice"""
+        recip = reciprocal.ReciprocalLattice(ndim=RDIM, nkpts=self.lattice.ncell, device=self.device)
+        if "kpoint" in self.config:
+            recip.kpoint = torch.as_tensor(self.config["kpoint"], dtype=torch.float64, device=self.device)
+        recip.init_from_lattice(self.lattice, apply_twist=not include_gamma)
+        recip.construct_recip_lattice(self.lattice)
+
+        if include_gamma:
+            self.gamma_lattice = recip
+        else:
+            self.recip_lattice = recip
+
+    @torch.no_grad()
+    def _construct_hamiltonian(self) -> None:
+        """Build the hopping and interaction matrices from #HAMILT (construct_hamilt)
+
+        Every line of #HAMILT is applied to all cells at once. The matrices
+        are sparse, entries repeated by several lines add up when they are
+        coalesced.
+        """
+        lattice = self.lattice
+        natom, ncell, n = lattice.natom, lattice.ncell, lattice.nsites
+        ktwist = self.recip_lattice.ktwist.to(self.device, torch.float64)
+        kpoint = self.recip_lattice.kpoint.to(self.device, torch.float64)
+        twisted = bool(torch.any(ktwist != 0))
+        dtype = torch.complex128 if twisted else torch.float64
+        cells = torch.arange(ncell, device=self.device)
+
+        rows, cols, t_up, t_dn, U = [], [], [], [], []
+        tckb, plink, tlink = [], [], []
+        for line in self.sections["#HAMILT"]:
+            iat, jat = int(line[0]), int(line[1])
+            if iat >= natom or jat >= natom:
+                raise ValueError("One of the atom in hopping is unspecified")
+            hop3d = torch.tensor([parse_float(tok) for tok in line[2:5]], dtype=torch.float64, device=self.device)
+            tijup, tijdn, Uij = (parse_float(tok) for tok in line[5:8])
+
+            sites = iat + natom * cells
+            js = lattice.hoptowho(sites, hop3d, jat)
+            doeshop = int(js[0]) != iat and (abs(tijup) > 1e-6 or abs(tijdn) > 1e-6)
+            if doeshop:
+                link = torch.full_like(sites, len(tlink))
+                tckb.append(torch.stack([torch.minimum(sites, js), torch.maximum(sites, js), link]))
+                plink.append(torch.stack([sites, js]))
+                tlink.append([tijup, tijdn, *hop3d.tolist()])
+
+            # Twist picked up by hoppings across the boundary
+            phase = torch.ones(ncell, dtype=dtype, device=self.device)
+            if twisted:
+                boundary = lattice.cartpos[:, js] - lattice.cartpos[:, sites] - hop3d.unsqueeze(-1)
+                phase = torch.exp(1j * (ktwist @ boundary))
+
+            # Both directions of every pair, the diagonal once
+            off = sites != js
+            rows += [sites, js[off]]
+            cols += [js, sites[off]]
+            t_up += [tijup * phase, tijup * phase[off].conj()]
+            t_dn += [tijdn * phase, tijdn * phase[off].conj()]
+            U += [torch.full_like(phase, Uij), torch.full_like(phase[off], Uij)]
+
+        indices = torch.stack([torch.cat(rows), torch.cat(cols)])
+
+        def sparse(values: list[torch.Tensor]) -> torch.Tensor:
+            values = torch.cat(values)
+            if not twisted:
+                values = values.to(torch.get_default_dtype())
+            return torch.sparse_coo_tensor(indices, values, (n, n)).coalesce()
+
+        # Wave function phase compatible with the boundary conditions
+        home = lattice.cartpos[:, torch.arange(n, device=self.device) % natom]
+        phase = torch.exp(1j * ((kpoint - ktwist) @ (lattice.cartpos - home) - ktwist @ lattice.cartpos))
+
+        empty = torch.zeros((3, 0), dtype=torch.int64, device=self.device)
+        self.hamiltonian = Hamiltonian(
+            t_up=sparse(t_up),
+            t_dn=sparse(t_dn),
+            U=sparse(U),
+            mu_up=torch.tensor(self.config.get("mu_up", 0.0), device=self.device),
+            mu_dn=torch.tensor(self.config.get("mu_dn", 0.0), device=self.device),
+            tckb=torch.cat(tckb, 1) if tckb else empty,
+            plink=torch.cat(plink, 1) if plink else empty[:2],
+            tlink=torch.tensor(tlink, dtype=torch.float64, device=self.device).t().reshape(5, -1),
+            phase=phase,
+            device=self.device,
+        )
 
     def print_header_ft(self, apply_twist: bool = True) -> None:
         """Print Fourier transform grid information"""
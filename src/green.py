@@ -1,10 +1,50 @@
 # src/green.py
 from dataclasses import dataclass
+from pathlib import Path
 
 import torch
 
 DEVICE = torch.get_default_device()
 
+L2_CACHE_FILE = Path("/sys/devices/system/cpu/cpu0/cache/index2/size")
+L2_CACHE_DEFAULT = 1024 * 1024  # bytes, used when the cache size cannot be read
+MAX_BLOCK = 64  # upper bound of the delayed update block size
+
+# Adaptive wrapping (DQMC_UpdateWraps)
+REDO_F = 10  # redos needed before shortening the wrap interval
+NOREDO_F = 100  # clean recomputations needed before lengthening it
+REDO_RATE = 0.2  # lengthen only while redo rate < REDO_RATE * err_rate
+
+
+def addmm_(C: torch.Tensor, A: torch.Tensor, B: torch.Tensor) -> None:
+    """C += A @ B in place, without a temporary for unbatched and walker-batched operands"""
+    if C.dim() == 2:
+        C.addmm_(A, B)
+    elif C.dim() == 3:
+        C.baddbmm_(A, B)
+    else:
+        C += torch.matmul(A, B)
+
+
+def l2_cache_size() -> int:
+    """Size of the L2 cache in bytes"""
+    try:
+        size = L2_CACHE_FILE.read_text().strip()
+    except OSError:
+        return L2_CACHE_DEFAULT
+
+    scale = {"K": 1024, "M": 1024 * 1024}.get(size[-1:].upper(), 1)
+    digits = size.rstrip("KMkm")
+    return int(digits) * scale if digits.isdigit() else L2_CACHE_DEFAULT
+
+
+def tune_block_size(n: int, dtype: torch.dtype | None = None, cache_size: int | None = None) -> int:
+    """Largest delayed update block whose U and W panels fit in the L2 cache"""
+    itemsize = torch.empty((), dtype=dtype).element_size()
+    if cache_size is None:
+        cache_size = l2_cache_size()
+    return max(1, min(n, MAX_BLOCK, cache_size // (2 * n * itemsize)))
+
 
 @dataclass
 class GreenFunction:
@@ -14,7 +54,7 @@ class GreenFunction:
     V: torch.Tensor  # HSF field matrices
     ilb: int  # Index of leftmost B
     det: float  # Determinant
-    sign: float  # Sign of det(G)
+    sign: float | torch.Tensor  # Sign of det(G), per walker if batched
 
     # Numerical stability parameters
     n_wrap: int = 5  # Wrapping frequency
@@ -24,6 +64,8 @@ class GreenFunction:
     fix_wrap: int = -1  # Fixed wrap point
     diff_lim: float = 0.1  # Difference limit
     err_rate: float = 0.0  # Error rate
+    redo: int = 0  # Recomputations that exceeded diff_lim
+    no_redo: int = 1  # Recomputations within diff_lim
 
     # Block update parameters
     n_blk: int = 10  # Block size for updates
@@ -35,33 +77,85 @@ class GreenFunction:
     device: torch.device = DEVICE
 
     def __post_init__(self):
+        # Leading dimensions of G are independent walkers
+        batch_shape = self.G.shape[:-2]
         if self.U is None:
-            self.U = torch.zeros((self.n, self.n_blk), device=self.device)
+            self.U = torch.zeros((*batch_shape, self.n, self.n_blk), dtype=self.G.dtype, device=self.device)
         if self.W is None:
-            self.W = torch.zeros((self.n, self.n_blk), device=self.device)
+            self.W = torch.zeros((*batch_shape, self.n, self.n_blk), dtype=self.G.dtype, device=self.device)
+
+        # Column and row of the rank-1 update being built
+        self.x = torch.zeros((*batch_shape, self.n), dtype=self.G.dtype, device=self.device)
+        self.y = torch.zeros_like(self.x)
+
+    def set_dtype(self, dtype: torch.dtype) -> None:
+        """Convert G, the update panels and vectors to dtype, no update may be pending"""
+        self.G = self.G.to(dtype)
+        self.U = self.U.to(dtype)
+        self.W = self.W.to(dtype)
+        self.x = self.x.to(dtype)
+        self.y = self.y.to(dtype)
+
+    def record_wrap_error(self, diff: float) -> None:
+        """Book a recomputation whose wrapped G differed by diff from the fresh one"""
+        if diff > self.diff_lim:
+            self.redo += 1
+        else:
+            self.no_redo += 1
+        self.wps = self.n_wrap
+
+    def update_wraps(self) -> None:
+        """Adapt n_wrap so that the redo rate stays below err_rate"""
+        if self.fix_wrap > 0:
+            return
+
+        rate = self.redo / (self.redo + self.no_redo)
+
+        if self.redo > REDO_F and rate > self.err_rate:
+            # Too many wrapped G drifted away, wrap fewer slices
+            self.n_wrap = max(1, self.n_wrap - 1)
+            self.max_wrap = self.n_wrap
+            self.redo = 0
+            self.no_redo = 1
+
+        # Comfortably accurate, try a longer interval
+        accurate = self.no_redo > NOREDO_F and rate < REDO_RATE * self.err_rate
+        if accurate and self.last_wrap <= self.n_wrap < self.max_wrap:
+            self.n_wrap += 1
+            self.redo = 0
+            self.no_redo = 1
+            self.last_wrap = self.n_wrap
+
+    @torch.no_grad()
+    def get_jj(self, j: int) -> torch.Tensor:
+        """Diagonal element G[j, j] including the pending block updates"""
+        gjj = self.G[..., j, j]
+        if self.blk_sz > 0:
+            gjj = gjj + torch.sum(self.U[..., j, : self.blk_sz] * self.W[..., j, : self.blk_sz], dim=-1)
+        return gjj
 
     @torch.no_grad()
-    def update_G(self, j: int, gamma: float) -> None:
-        """Update Green's function with rank-1 update"""
+    def update_G(self, j: int, gamma: float | torch.Tensor) -> None:
+        """Update Green's function with rank-1 update (gamma per walker if batched)"""
         blk_sz = self.blk_sz
 
         # Compute x and y vectors
-        x = self.G[:, j].clone()
-        y = self.G[j, :].clone()
-        y[j] -= 1.0
+        x = self.x.copy_(self.G[..., :, j])
+        y = self.y.copy_(self.G[..., j, :])
+        y[..., j] -= 1.0
 
         if blk_sz > 0:
             # Add effects of previous updates
-            xx = self.W[j, :blk_sz]
-            x += torch.mv(self.U[:, :blk_sz], xx)
-            xx = self.U[j, :blk_sz]
-            y += torch.mv(self.W[:, :blk_sz], xx)
+            addmm_(x.unsqueeze(-1), self.U[..., :blk_sz], self.W[..., j, :blk_sz].unsqueeze(-1))
+            addmm_(y.unsqueeze(-1), self.W[..., :blk_sz], self.U[..., j, :blk_sz].unsqueeze(-1))
 
+        if isinstance(gamma, torch.Tensor) and gamma.dim() > 0:
+            gamma = gamma.unsqueeze(-1)
         y *= gamma
 
         # Store update vectors
-        self.U[:, blk_sz] = x
-        self.W[:, blk_sz] = y
+        self.U[..., blk_sz].copy_(x)
+        self.W[..., blk_sz].copy_(y)
         self.blk_sz += 1
 
         # Apply updates if block is full
@@ -70,7 +164,7 @@ class GreenFunction:
     @torch.no_grad()
     def apply_update(self, forced: bool = False) -> None:
         """Apply blocked updates to G"""
-        if forced or self.blk_sz == self.n_blk:
+        if self.blk_sz > 0 and (forced or self.blk_sz == self.n_blk):
             blk_sz = self.blk_sz
-            self.G += torch.mm(self.U[:, :blk_sz], self.W[:, :blk_sz].t())
+            addmm_(self.G, self.U[..., :blk_sz], self.W[..., :blk_sz].transpose(-2, -1))
             self.blk_sz = 0
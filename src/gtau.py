@@ -3,12 +3,30 @@ from dataclasses import dataclass
 
 import torch
 
+from seqb import SeqB
+
 DEVICE = torch.get_default_device()
 
+TAU_UP = 1  # Spin up
+TAU_DN = -1  # Spin down
+
 
 @dataclass
 class GTau:
-    """Time-dependent Green's function"""
+    """Time-dependent Green's function
+
+    G(tau, tau') is the inverse of the space-time matrix
+
+        [  I                  P_{nb-1}]
+        [-P_0   I                     ]
+        [     -P_1   I                ]
+        [          ...   ...          ]
+        [            -P_{nb-2}      I ]
+
+    where P_i is the product of the B matrices of block i of the SeqB cache.
+    Block (i, j) of the inverse is G(t_i, t_j) at the block start times t_i,
+    the slices inside a block are reached by multiplying with single B's.
+    """
 
     n: int  # number of sites
     L: int  # number of time slices
@@ -28,36 +46,243 @@ class GTau:
         self.e0up = torch.zeros(self.n, device=self.device)
         self.e0dn = torch.zeros(self.n, device=self.device)
         self.g0_stored = False
+        self.B0: dict[int, torch.Tensor] = {}
+        self.g0_shared = False
+        self.g0_k: dict[tuple[int, int], tuple[torch.Tensor, torch.Tensor]] = {}
+
+        if self.nnb != self.n * self.nb:
+            raise ValueError("nnb must be n * nb")
+
+        # Inverse of the space-time matrix, G(tau, tau), sign and B engine per spin
+        self.A: dict[int, torch.Tensor] = {}
+        self.gtt: dict[int, torch.Tensor] = {}
+        self.sgn: dict[int, torch.Tensor] = {}
+        self.seqb: dict[int, SeqB] = {}
+        self.V: dict[int, torch.Tensor] = {}
+        self.itau = torch.zeros(self.nb, dtype=torch.int64)  # block start times
+
+    def _blk(self, i: int) -> slice:
+        """Rows or columns of block i in the space-time matrix"""
+        return slice(i * self.n, (i + 1) * self.n)
 
     @torch.no_grad()
-    def get_g0(self, tau_idx: int, spin: int = 0) -> torch.Tensor:
-        """Get non-interacting Green's function
+    def load(self, spin: int, seqb: SeqB, V: torch.Tensor) -> torch.Tensor:
+        """Invert the space-time matrix of one spin (DQMC_Gtau_LoadA)
+
+        Also wraps the equal-time G(tau, tau) through every block. Returns
+        the sign of det(I + B_{L-1} ... B_0).
+        """
+        if seqb.nblocks != self.nb:
+            raise ValueError(f"SeqB has {seqb.nblocks} blocks, expected {self.nb}")
+
+        n, nb = self.n, self.nb
+        batch = V.shape[:-2]
+
+        # Block products of the space-time matrix, promoted from a lower precision cache
+        P = [seqb.get_block(i, V).to(torch.get_default_dtype()) for i in range(nb)]
+        for i in range(nb):
+            self.itau[i] = seqb.block_range(i)[0]
+
+        A, sgn = self._invert(P, batch)
+
+        # Equal-time G(tau, tau) of every slice
+        gtt = torch.empty((*batch, self.L, n, n), device=self.device)
+        for i in range(nb):
+            start, end = seqb.block_range(i)
+            G = A[..., self._blk(i), self._blk(i)].clone()
+            gtt[..., start, :, :] = G
+            for t in range(start + 1, end):
+                seqb.B.mult_left(G, V[..., t - 1, :])
+                seqb.B.mult_right_inv(G, V[..., t - 1, :])
+                gtt[..., t, :, :] = G
+
+        self.A[spin] = A
+        self.gtt[spin] = gtt
+        self.sgn[spin] = sgn
+        self.seqb[spin] = seqb
+        self.V[spin] = V
+        return sgn
+
+    def _invert(self, P: list[torch.Tensor], batch: torch.Size) -> tuple[torch.Tensor, torch.Tensor]:
+        """Inverse and sign of the determinant of the space-time matrix of the block products P
+
+        Block structured orthogonal factorization (BSOF, Bai et al.): step k
+        takes the QR of the two blocks of column k in rows k and k + 1, so
+        A = Q R with Q the product of the 2n x 2n factors and R block upper
+        triangular with the diagonal, the superdiagonal and the last column.
+        Unlike the LU of A, whose pivots grow with the products P at low
+        temperature, every step is orthogonal and the inverse R^-1 Q^T only
+        takes triangular solves with the diagonal blocks.
+        """
+        n, nb = self.n, self.nb
+        eye = torch.eye(n, device=self.device).expand(*batch, n, n)
+        sgn = torch.ones(batch, device=self.device)
+
+        # Rows k, k + 1: Q_k [R_kk; 0] = [top; -P_k], top and the corner column are carried down
+        Qs, diag, upper, corner = [], [], [], []
+        top = eye + P[0] if nb == 1 else eye
+        last = P[nb - 1]
+        for k in range(nb - 1):
+            Q, R = torch.linalg.qr(torch.cat([top, -P[k]], -2), mode="complete")
+            Qt = Q.mT
+            Qs.append(Qt)
+            diag.append(R[..., :n, :])
+            col = torch.matmul(Qt[..., :n], last)
+            if k < nb - 2:
+                # Q_k^T [0; I] to column k + 1, Q_k^T [Y_k; 0] to the last column
+                upper.append(Qt[..., :n, n:])
+                corner.append(col[..., :n, :])
+                top, last = Qt[..., n:, n:], col[..., n:, :]
+            else:
+                # Column k + 1 is the last one, Q_k^T [Y_k; I]
+                col = col + Qt[..., n:]
+                upper.append(col[..., :n, :])
+                top = col[..., n:, :]
+        Q, R = torch.linalg.qr(top)
+        Qs.append(Q.mT)
+        diag.append(R)
+
+        # sign det A = prod sign det Q_k * prod sign det R_kk
+        for Qt, R in zip(Qs, diag, strict=True):
+            sgn *= torch.linalg.det(Qt).sign() * torch.diagonal(R, 0, -2, -1).sign().prod(-1)
+
+        # Q^T applied to the identity, two block rows at a time
+        Z = torch.eye(self.nnb, device=self.device).repeat(*batch, 1, 1)
+        for k in range(nb - 1):
+            rows = slice(k * n, (k + 2) * n)
+            Z[..., rows, :] = torch.matmul(Qs[k], Z[..., rows, :])
+        Z[..., self._blk(nb - 1), :] = torch.matmul(Qs[nb - 1], Z[..., self._blk(nb - 1), :])
+
+        # Back substitution through the block rows of R
+        X = torch.empty_like(Z)
+        tail = self._blk(nb - 1)
+        X[..., tail, :] = torch.linalg.solve_triangular(diag[nb - 1], Z[..., tail, :], upper=True)
+        for k in range(nb - 2, -1, -1):
+            rhs = Z[..., self._blk(k), :] - torch.matmul(upper[k], X[..., self._blk(k + 1), :])
+            if k < nb - 2:
+                rhs -= torch.matmul(corner[k], X[..., tail, :])
+            X[..., self._blk(k), :] = torch.linalg.solve_triangular(diag[k], rhs, upper=True)
+        return X, sgn
+
+    @torch.no_grad()
+    def make_gtau(self, spin: int, i0: int) -> tuple[torch.Tensor, torch.Tensor, torch.Tensor]:
+        """G(tau, 0), G(0, tau) and G(tau, tau) for all L slices, time 0 at the start of block i0
+
+        Each is returned as one (..., L, n, n) tensor indexed by tau. At tau = 0,
+        G(0, 0) = G(0+, 0) and G(0, tau) = G(0, 0+).
+        """
+        A = self.A[spin]
+        seqb = self.seqb[spin]
+        V = self.V[spin]
+        n = self.n
+        t0 = int(self.itau[i0])
+
+        gt0 = torch.empty_like(self.gtt[spin])
+        g0t = torch.empty_like(self.gtt[spin])
+        for i in range(self.nb):
+            start, end = seqb.block_range(i)
+            Gt0 = A[..., self._blk(i), self._blk(i0)].clone()
+            G0t = A[..., self._blk(i0), self._blk(i)].clone()
+            if i == i0:
+                G0t -= torch.eye(n, device=self.device)
+
+            gt0[..., start, :, :] = Gt0
+            g0t[..., start, :, :] = G0t
+            for t in range(start + 1, end):
+                # G(t, 0) = B_{t-1} G(t-1, 0), G(0, t) = G(0, t-1) B_{t-1}^-1
+                seqb.B.mult_left(Gt0, V[..., t - 1, :])
+                seqb.B.mult_right_inv(G0t, V[..., t - 1, :])
+                gt0[..., t, :, :] = Gt0
+                g0t[..., t, :, :] = G0t
+
+        # Shift to times relative to t0, G is antiperiodic in beta
+        gt0 = torch.roll(gt0, -t0, dims=-3)
+        g0t = torch.roll(g0t, -t0, dims=-3)
+        gt0[..., self.L - t0 :, :, :] *= -1
+        g0t[..., self.L - t0 :, :, :] *= -1
+
+        if spin == TAU_UP:
+            self.i0_up = i0
+        else:
+            self.i0_dn = i0
+
+        return gt0, g0t, torch.roll(self.gtt[spin], -t0, dims=-3)
+
+    def set_g0(self, B_up: torch.Tensor, B_dn: torch.Tensor | None = None) -> None:
+        """Set the free propagators B = exp(-dtau (K - mu)) used by get_g0
+
+        The eigendecompositions are computed on first use and kept until the
+        next call. Without B_dn, or with B_dn equal to B_up, both spins share
+        one decomposition.
+        """
+        self.B0 = {TAU_UP: B_up, TAU_DN: B_up if B_dn is None else B_dn}
+        self.g0_shared = B_dn is None or B_dn is B_up or torch.equal(B_dn, B_up)
+        self.g0_k: dict[tuple[int, int], tuple[torch.Tensor, torch.Tensor]] = {}
+        self.g0_stored = False
+
+    def _g0_spins(self, spin: int) -> list[int]:
+        """Spins whose free propagators contribute to spin (0=both, 1=up, -1=down)"""
+        spins = [TAU_UP, TAU_DN] if spin == 0 else [spin]
+        return [TAU_UP] if self.g0_shared else spins
+
+    def _g0_weights(self, e: torch.Tensor, tau: torch.Tensor) -> torch.Tensor:
+        """e^tau / (1 + e^L) for every eigenvalue e of B and every tau, without overflow"""
+        loge = torch.log(e)
+        tau = tau.view(-1, *([1] * loge.dim()))
+        return torch.exp(tau * loge - torch.nn.functional.softplus(self.L * loge))
+
+    @torch.no_grad()
+    def get_g0(self, tau_idx: int | None = None, spin: int = 0) -> torch.Tensor:
+        """Get non-interacting Green's function (DQMC_Gtau_GetG0)
 
         Args:
-            tau_idx: Time slice index
+            tau_idx: Time slice index, None returns all slices 0..L as one
+                (L + 1, n, n) tensor
             spin: Spin index (0=both, 1=up, -1=down)
         """
         if not self.g0_stored:
-            # Compute eigendecomposition of B matrices
-            self.e0up, self.U0up = torch.linalg.eigh(self.B_up)
-            self.e0dn, self.U0dn = torch.linalg.eigh(self.B_dn)
+            # Eigendecomposition of the B matrices, once per Hamiltonian
+            self.e0up, self.U0up = torch.linalg.eigh(self.B0[TAU_UP])
+            if self.g0_shared:
+                self.e0dn, self.U0dn = self.e0up, self.U0up
+            else:
+                self.e0dn, self.U0dn = torch.linalg.eigh(self.B0[TAU_DN])
             self.g0_stored = True
 
-        g0tau = torch.zeros((self.n, self.n), device=self.device)
+        taus = torch.arange(self.L + 1) if tau_idx is None else torch.tensor([tau_idx])
+        taus = taus.to(self.device, self.e0up.dtype)
+
+        spins = self._g0_spins(spin)
+        g0tau = torch.zeros((len(taus), self.n, self.n), device=self.device)
+        for s in spins:
+            e, U = (self.e0up, self.U0up) if s == TAU_UP else (self.e0dn, self.U0dn)
+            g0tau += torch.matmul(U * self._g0_weights(e, taus).unsqueeze(-2), U.t())
+        g0tau /= len(spins)
 
-        if spin in [0, 1]:  # UP or BOTH
-            g = self.e0up.pow(tau_idx) / (1.0 + self.e0up.pow(self.L))
-            W2 = self.U0up.clone()
-            W2 = W2 * g.view(1, -1)
-            g0tau += torch.mm(W2, self.U0up.t())
+        return g0tau if tau_idx is None else g0tau[0]
 
-        if spin in [0, -1]:  # DOWN or BOTH
-            g = self.e0dn.pow(tau_idx) / (1.0 + self.e0dn.pow(self.L))
-            W2 = self.U0dn.clone()
-            W2 = W2 * g.view(1, -1)
-            g0tau += torch.mm(W2, self.U0dn.t())
+    @torch.no_grad()
+    def get_g0_k(self, fourier: torch.Tensor, natom: int = 1, spin: int = 0) -> torch.Tensor:
+        """Non-interacting G0(k, tau) of a translation invariant lattice
+
+        fourier is ReciprocalLattice.fourier_c (ncell, nk) and sites are
+        numbered cell * natom + atom. B is block diagonal in k, so only the
+        (natom, natom) blocks are diagonalized. Returns all slices 0..L as
+        one (L + 1, nk, natom, natom) tensor.
+        """
+        ncell, nk = fourier.shape
+        taus = torch.arange(self.L + 1, device=self.device)
 
-        if spin == 0:  # BOTH
-            g0tau *= 0.5
+        spins = self._g0_spins(spin)
+        g0k = torch.zeros((self.L + 1, nk, natom, natom), dtype=fourier.dtype, device=self.device)
+        for s in spins:
+            if (s, natom) not in self.g0_k:
+                B = self.B0[s].view(ncell, natom, ncell, natom).to(fourier.dtype)
+                Bk = torch.einsum("ck,cadb,dk->kab", fourier.conj(), B, fourier)
+                self.g0_k[(s, natom)] = torch.linalg.eigh(Bk)
+            e, W = self.g0_k[(s, natom)]
+            g = self._g0_weights(e, taus.to(e.dtype)).to(W.dtype)
+            g0k += torch.matmul(W * g.unsqueeze(-2), W.mH)
+        g0k /= len(spins)
 
-        return g0tau
+        return g0k
@@ -0,0 +1,114 @@
+# src/hsf.py
+from dataclasses import dataclass
+
+import torch
+
+DEVICE = torch.get_default_device()
+
+
+def pack_hsf(hsf: torch.Tensor) -> torch.Tensor:
+    """Pack a +-1 field into one bit per spin, 8 spins per byte"""
+    bits = (hsf.reshape(-1) > 0).to(torch.uint8)
+    bits = torch.nn.functional.pad(bits, (0, -bits.numel() % 8)).view(-1, 8)
+    weights = 2 ** torch.arange(8, dtype=torch.uint8, device=bits.device)
+    return (bits * weights).sum(-1, dtype=torch.uint8)
+
+
+def unpack_hsf(packed: torch.Tensor, shape: tuple[int, ...], dtype: torch.dtype = torch.int8) -> torch.Tensor:
+    """Inverse of pack_hsf"""
+    weights = 2 ** torch.arange(8, dtype=torch.uint8, device=packed.device)
+    bits = (packed.unsqueeze(-1) & weights) > 0
+    numel = 1
+    for s in shape:
+        numel *= s
+    return (bits.reshape(-1)[:numel].to(dtype) * 2 - 1).view(shape)
+
+
+@dataclass
+class HSField:
+    """Ising Hubbard-Stratonovich field with its cached V diagonals
+
+    h holds one int8 +-1 per (slice, site), with optional leading walker
+    dimensions. V_up = exp(+coupling h) and V_dn = exp(-coupling h), or
+    exp(+coupling h) as well for the charge decoupling of an attractive U,
+    are kept next to it. A flip rewrites only the flipped entries, looked
+    up from the two possible values instead of multiplying by the ratio,
+    so V never drifts from h.
+    """
+
+    shape: tuple[int, ...]  # (*batch, L, n)
+    coupling: float  # lambda in V = exp(+-lambda h), cosh(lambda) = exp(dtau |U| / 2)
+    attractive: bool = False  # U < 0, V_dn = V_up
+    device: torch.device = DEVICE
+
+    def __post_init__(self):
+        self.h = torch.randint(2, self.shape, dtype=torch.int8, device=self.device) * 2 - 1
+
+        # exp(lambda s) for s = -1, +1, indexed by (s + 1) // 2
+        self.expv = torch.exp(self.coupling * torch.tensor([-1.0, 1.0], device=self.device))
+
+        self.V_up = torch.empty(self.shape, device=self.device)
+        self.V_dn = torch.empty(self.shape, device=self.device)
+        self.refresh()
+
+        # Flip factors and signs of one slice, for flips that do not allocate
+        slice_shape = (*self.shape[:-2], self.shape[-1])
+        self.slice_flip = torch.ones(slice_shape, dtype=torch.int8, device=self.device)
+        self.slice_up = torch.zeros(slice_shape, dtype=torch.bool, device=self.device)
+        self.zero = torch.zeros((), dtype=torch.int8, device=self.device)
+
+    def exp(self, h: torch.Tensor) -> tuple[torch.Tensor, torch.Tensor]:
+        """V_up and V_dn of a field h"""
+        idx = (h.to(torch.int64) + 1) // 2
+        if self.attractive:
+            return self.expv[idx], self.expv[idx]
+        return self.expv[idx], self.expv[1 - idx]
+
+    def refresh(self) -> None:
+        """Recompute V_up and V_dn from h"""
+        V_up, V_dn = self.exp(self.h)
+        self.V_up.copy_(V_up)
+        self.V_dn.copy_(V_dn)
+
+    def set(self, h: torch.Tensor) -> None:
+        """Replace the field"""
+        self.h.copy_(h)
+        self.refresh()
+
+    def flip(self, slice_idx: int, site: int | None = None, accept: torch.Tensor | None = None) -> None:
+        """Flip the spins at (slice_idx, site), or the whole slice when site is None
+
+        accept masks the flips per walker, or per walker and site for a
+        whole slice; None flips them all.
+        """
+        if site is None:
+            self._flip_slice(slice_idx, accept)
+            return
+
+        idx = (..., slice_idx, site)
+        h = self.h[idx]
+        h = -h if accept is None else torch.where(accept, -h, h)
+        self.h[idx] = h
+
+        V_up, V_dn = self.exp(h)
+        self.V_up[idx] = V_up
+        self.V_dn[idx] = V_dn
+
+    def _flip_slice(self, slice_idx: int, accept: torch.Tensor | None) -> None:
+        """Flip a whole slice in place through the slice buffers"""
+        flip = self.slice_flip.fill_(-1)
+        if accept is not None:
+            flip.fill_(1).masked_fill_(accept, -1)
+        h = self.h[..., slice_idx, :].mul_(flip)
+
+        up = torch.gt(h, self.zero, out=self.slice_up)
+        lo, hi = self.expv[0], self.expv[1]
+        torch.where(up, hi, lo, out=self.V_up[..., slice_idx, :])
+        if self.attractive:
+            torch.where(up, hi, lo, out=self.V_dn[..., slice_idx, :])
+        else:
+            torch.where(up, lo, hi, out=self.V_dn[..., slice_idx, :])
+
+    def packed(self) -> torch.Tensor:
+        """Field packed to one bit per spin"""
+        return pack_hsf(self.h)
@@ -23,7 +23,7 @@ class HubbardModel:
 
     def __post_init__(self):
         # Initialize HSF fields
-        self.HSF = torch.randint(2, (self.L, self.n), device=self.device) * 2 - 1
+        self.HSF = torch.randint(2, (self.L, self.n), dtype=torch.int8, device=self.device) * 2 - 1
         self.lambda_vec = torch.sqrt(torch.abs(self.U) * self.beta / self.L)
 
         # Initialize V matrices
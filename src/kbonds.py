@@ -3,7 +3,7 @@ from dataclasses import dataclass
 
 import torch
 
-from .lattice import Lattice
+from lattice import smallest_equivalent
 
 DEVICE = torch.get_default_device()
 
@@ -31,45 +31,78 @@ class KBonds:
         self.bmap = None  # bond mappings
         self.ksum = None  # k-space sums
 
-    def construct_kbond_classes(self, lattice: Lattice) -> None:
-        """Construct classes of k-space bonds"""
-        ntotbond = self.nbonds
-        maxclass = 0
-
-        # Initialize arrays
-        self.myclass = torch.zeros((ntotbond, ntotbond, self.nmomenta), dtype=torch.int64, device=self.device)
-
-        for im in range(self.nmomenta):
-            # Process each momentum
-            bond1 = []  # Will store bond origins
-            bond2 = []  # Will store bond targets
-            csizev = []  # Will store class sizes
-
-            mclass = 0
-            for i in range(ntotbond):
-                for j in range(ntotbond):
-                    # Process bond pairs
-                    found = False
-                    for ic in range(len(csizev)):
-                        if self._check_bond_equivalence(i, j, bond1[ic], bond2[ic]):
-                            found = True
-                            break
-
-                    if not found:
-                        # New class
-                        bond1.append(i)
-                        bond2.append(j)
-                        csizev.append(1)
-                        mclass += 1
-
-            # Store class information
-            self.nclass[im] = mclass
-            maxclass = max(maxclass, mclass)
-
-        # Allocate and fill class sizes
-        self.class_size = torch.zeros((maxclass, self.nmomenta), device=self.device)
-        for im in range(self.nmomenta):
-            for ib in range(ntotbond):
-                for jb in range(ntotbond):
-                    class_idx = self.myclass[ib, jb, im]
-                    self.class_size[class_idx, im] += 1
+    @torch.no_grad()
+    def construct_kbonds(self, atom_map: torch.Tensor, map_symm_k: torch.Tensor, ksum: torch.Tensor) -> None:
+        """Bonds (a, k) - (b, q - k) of every momentum q and their images under the symmetries
+
+        The (atom, k) pair ak is a + natom * k and bond ib of every momentum
+        is (a * natom + b) * nk + k. atom_map (natom, nop) and map_symm_k
+        (nk, nop) give the orbital and the k-point every orbital and k-point
+        goes to under each operation, ksum (nk, nk) the k-point k1 + k2. An
+        operation takes the bonds of q to those of its image of q, so only
+        the operations leaving q in place map the bonds of q, the others
+        leave them where they are.
+        """
+        nk, nb, nm = ksum.shape[0], self.nbonds, self.nmomenta
+        natom = self.nak // nk
+        ib = torch.arange(nb, device=self.device)
+        a, b, k = ib // (natom * nk), ib // nk % natom, ib % nk
+        momenta = torch.arange(nm, device=self.device)
+
+        # k' = q - k, Gamma is the k-point with 2 k = k
+        ksum = ksum.to(self.device, torch.int64)
+        gamma = torch.argmax((ksum.diagonal() == torch.arange(nk, device=self.device)).to(torch.int8))
+        kneg = torch.argmax((ksum == gamma).to(torch.int8), 1)
+        self.ksum = ksum
+        self.bond_origin = (a + natom * k).unsqueeze(1).expand(nb, nm).contiguous()
+        self.bond_target = b.unsqueeze(1) + natom * ksum[momenta, kneg[k].unsqueeze(1)]
+        self.bmap = torch.full((self.nak, self.nak, nm), -1, dtype=torch.int64, device=self.device)
+        self.bmap[self.bond_origin, self.bond_target, momenta] = ib.unsqueeze(1).expand(nb, nm)
+
+        # Images of both ends, a bond of the same momentum only if the operation leaves q in place
+        ak = torch.arange(self.nak, device=self.device)
+        atom_map = atom_map.to(self.device, torch.int64)
+        map_symm_k = map_symm_k.to(self.device, torch.int64)
+        self.map_symm_ak = atom_map[ak % natom] + natom * map_symm_k[ak // natom]
+        origin, target = self.map_symm_ak[self.bond_origin], self.map_symm_ak[self.bond_target]  # (nb, nm, nop)
+        image = self.bmap[origin, target, momenta.view(1, -1, 1)]
+        self.map_symm_bak = torch.where(image >= 0, image, ib.view(-1, 1, 1)).transpose(1, 2).contiguous()
+
+    @torch.no_grad()
+    def construct_kbond_classes(self) -> None:
+        """Classes of equivalent pairs of k-space bonds for every momentum (construct_kbond_classes)
+
+        The pair (ib, jb) is equivalent to (jb, ib), to its image under
+        every symmetry of map_symm_bak, and to the pair of reversed bonds
+        (bmap of target and origin), the exchange of up-dn-dn-up and
+        dn-up-up-dn. The classes are the connected components of these
+        links, taken for all momenta at once and numbered per momentum in
+        the order of their first pair.
+        """
+        nb, nm = self.nbonds, self.nmomenta
+        nsymm = self.map_symm_bak.shape[1]
+
+        # Pair (im, ib, jb) is element (im * nb + ib) * nb + jb of the flat index
+        idx = torch.arange(nm * nb * nb, device=self.device)
+        im, ib, jb = idx // (nb * nb), idx // nb % nb, idx % nb
+
+        def pair(bx: torch.Tensor, by: torch.Tensor) -> torch.Tensor:
+            return (im * nb + bx) * nb + by
+
+        map_symm = self.map_symm_bak.to(self.device, torch.int64)
+        origin = self.bond_origin.to(self.device, torch.int64)
+        target = self.bond_target.to(self.device, torch.int64)
+        momenta = torch.arange(nm, device=self.device)
+        reverse = self.bmap.to(self.device, torch.int64)[target, origin, momenta]
+        links = [pair(jb, ib), pair(reverse[ib, im], reverse[jb, im])]
+        links += [pair(map_symm[ib, s, im], map_symm[jb, s, im]) for s in range(nsymm)]
+
+        # Number the classes from 0 within every momentum
+        first, myclass = torch.unique(smallest_equivalent(links), return_inverse=True)
+        self.nclass = torch.bincount(first // (nb * nb), minlength=nm)
+        offset = torch.cumsum(self.nclass, 0) - self.nclass
+        myclass = myclass - offset[im]
+
+        self.myclass = myclass.view(nm, nb, nb).permute(1, 2, 0)
+        self.class_size = torch.zeros((int(self.nclass.max()), nm), dtype=torch.int64, device=self.device)
+        self.class_size.index_put_((myclass, im), torch.ones_like(myclass), accumulate=True)
@@ -3,8 +3,13 @@ from dataclasses import dataclass
 
 import torch
 
+from config import GeomParams, parse_float
+
 DEVICE = torch.get_default_device()
 
+RDIM = GeomParams.RDIM
+TOLL = GeomParams.TOLL
+
 
 @dataclass
 class Lattice:
@@ -46,43 +51,316 @@ class Lattice:
         self.constructed = False
         self.analyzed = False
 
+    def init_lattice(self, ac: torch.Tensor, sc: torch.Tensor, xat: torch.Tensor, olabel: list[str]) -> None:
+        """Set the cells and the orbitals of the primitive cell (init_lattice)
+
+        ac holds the primitive vectors and sc the supercell in units of them,
+        both as columns of (RDIM, RDIM) matrices; xat are the cartesian
+        orbital positions (RDIM, natom).
+        """
+        self.ac = ac.to(self.device, torch.float64)
+        self.sc = sc.to(self.device, torch.int64)
+        self.scc = self.ac @ self.sc.to(torch.float64)
+        self.ainv = torch.linalg.inv(self.ac)
+        self.invscc = torch.linalg.inv(self.scc)
+        self.xat = self.ainv @ xat.to(self.device, torch.float64)
+        self.olabel = list(olabel)
+        self.initialized = True
+
+    def _cell_key(self, x: torch.Tensor) -> tuple[torch.Tensor, torch.Tensor]:
+        """Key of the supercell translation class of primitive lattice vectors x (RDIM, m)
+
+        Components of a lattice vector in units of the supercell are
+        multiples of 1 / ncell, so the extended ones reduced to [0, 1) give
+        an integer key. Also returns whether x is a lattice vector at all.
+        """
+        f = self.invscc @ x
+        n = self.ainv @ x
+        ext = f[: self.ndim] * self.ncell
+        ext = ext - self.ncell * torch.floor(ext / self.ncell + TOLL)
+        digits = torch.round(ext)
+
+        valid = (torch.abs(ext - digits) < TOLL * self.ncell).all(0)
+        valid &= (torch.abs(n[: self.ndim] - torch.round(n[: self.ndim])) < TOLL).all(0)
+        valid &= (torch.abs(f[self.ndim :]) < TOLL).all(0)
+
+        return self._digits_key(digits.to(torch.int64) % self.ncell), valid
+
+    def _digits_key(self, digits: torch.Tensor) -> torch.Tensor:
+        """Integer key of supercell-fractional digits (ndim, ...) in [0, ncell)"""
+        radix = self.ncell ** torch.arange(self.ndim, device=self.device)
+        return (digits * radix.view(-1, *([1] * (digits.dim() - 1)))).sum(0)
+
+    def _translation_digits(self) -> torch.Tensor:
+        """Supercell-fractional digits of every translation (ndim, ncell)"""
+        if not self.constructed:
+            raise ValueError("Lattice must be constructed first")
+        ext = (self.invscc @ self.translation.to(torch.float64))[: self.ndim] * self.ncell
+        return torch.round(ext).to(torch.int64) % self.ncell
+
+    @torch.no_grad()
+    def cell_difference(self) -> torch.Tensor:
+        """Cell index of the translation t_j - t_i for every pair of cells (ncell, ncell)
+
+        The supercell-fractional digits of a difference are the differences
+        of the digits modulo ncell, so no vector is reduced more than once.
+        """
+        digits = self._translation_digits()
+        diff = (digits.unsqueeze(1) - digits.unsqueeze(2)) % self.ncell  # [d, i, j] = d_j - d_i
+        return self.cell_order[torch.searchsorted(self.cell_keys, self._digits_key(diff))]
+
+    @torch.no_grad()
+    def cell_sum(self) -> torch.Tensor:
+        """Cell index of the translation t_i + t_j for every pair of cells (ncell, ncell)"""
+        digits = self._translation_digits()
+        total = (digits.unsqueeze(1) + digits.unsqueeze(2)) % self.ncell
+        return self.cell_order[torch.searchsorted(self.cell_keys, self._digits_key(total))]
+
+    @torch.no_grad()
+    def site_index(self, x: torch.Tensor) -> tuple[torch.Tensor, torch.Tensor]:
+        """Sites at the cartesian positions x (RDIM, m), modulo the supercell
+
+        Every orbital is tried at once: the offset from its position must be
+        a lattice vector, whose translation class is looked up in the sorted
+        cell keys. Also returns whether x is a site at all.
+        """
+        if not self.constructed:
+            raise ValueError("Lattice must be constructed before site_index")
+
+        x = torch.as_tensor(x, device=self.device, dtype=torch.float64)
+        m = x.shape[1]
+        offset = x.unsqueeze(1) - (self.ac @ self.xat).unsqueeze(-1)  # (RDIM, natom, m)
+        keys, found = self._cell_key(offset.reshape(RDIM, -1))
+        idx = torch.searchsorted(self.cell_keys, keys).clamp(max=self.ncell - 1)
+        found = (found & (self.cell_keys[idx] == keys)).view(self.natom, m)
+
+        atom = torch.argmax(found.to(torch.int8), 0)
+        cols = torch.arange(m, device=self.device)
+        cell = self.cell_order[idx.view(self.natom, m)[atom, cols]]
+        return atom + self.natom * cell, found.any(0)
+
+    @torch.no_grad()
+    def construct_lattice(self) -> None:
+        """Place every orbital in every cell of the supercell (construct_lattice)
+
+        The translations are the primitive lattice points whose supercell
+        coordinates lie in [0, 1), taken from the bounding box of the
+        supercell in one pass. Site iat + natom * it is orbital iat
+        translated by it.
+        """
+        if not self.initialized:
+            raise ValueError("Lattice must be initialized first")
+
+        # Bounding box of the supercell in primitive units
+        corners = torch.cartesian_prod(*[torch.tensor([0, 1], device=self.device)] * RDIM).t()
+        corners = self.sc @ corners
+        xxmin = corners.amin(1).tolist()
+        xxmax = corners.amax(1).tolist()
+
+        # Lattice points of the box, x fastest as in the Fortran loops
+        bounds = zip(xxmin, xxmax, strict=True)
+        axes = [torch.arange(lo, hi, device=self.device, dtype=torch.float64) for lo, hi in bounds]
+        iz, iy, ix = torch.meshgrid(axes[2], axes[1], axes[0], indexing="ij")
+        xx = torch.stack([ix.flatten(), iy.flatten(), iz.flatten()])
+        cart = self.ac @ xx
+        proj = self.invscc @ cart
+        inside = ((proj > -TOLL) & (proj < 1 - TOLL)).all(0)
+        self.translation = cart[:, inside]
+        if self.translation.shape[1] != self.ncell:
+            raise ValueError(f"Found {self.translation.shape[1]} translations in a supercell of {self.ncell} cells")
+
+        # Sites, orbital index fastest
+        xat_cart = self.ac @ self.xat
+        self.cartpos = (xat_cart.unsqueeze(1) + self.translation.unsqueeze(2)).reshape(RDIM, self.nsites)
+        self.pos = self.ainv @ self.cartpos
+
+        # Sorted translation keys for hoptowho
+        keys, _ = self._cell_key(self.translation)
+        self.cell_keys, self.cell_order = torch.sort(keys)
+        self.constructed = True
+
+    @torch.no_grad()
+    def hoptowho(self, iat: torch.Tensor, delta: torch.Tensor, jat: int) -> torch.Tensor:
+        """Sites of orbital jat reached from the sites iat by the cartesian displacement delta (hoptowho)"""
+        if not self.constructed:
+            raise ValueError("Lattice must be constructed before hoptowho")
+
+        iat = torch.as_tensor(iat, device=self.device)
+        delta = torch.as_tensor(delta, device=self.device, dtype=torch.float64)
+
+        # Translation taking orbital jat of cell 0 onto the landing point
+        x = self.cartpos[:, iat.flatten()] + delta.unsqueeze(-1) - (self.ac @ self.xat[:, jat]).unsqueeze(-1)
+        keys, valid = self._cell_key(x)
+        idx = torch.searchsorted(self.cell_keys, keys).clamp(max=self.ncell - 1)
+        valid &= self.cell_keys[idx] == keys
+        if not valid.all():
+            bad = iat.flatten()[~valid][0]
+            raise ValueError(f"Can't find where {int(bad)} hops")
+
+        return (jat + self.natom * self.cell_order[idx]).view(iat.shape)
+
+    @torch.no_grad()
+    def assign_phase(self, rows: list[list[str]]) -> None:
+        """Phase of every site from the #PHASE section (assign_phase)
+
+        The section gives a phase cell, which must tile the supercell, and
+        the phase of every orbital inside it; translations of the phase cell
+        carry the phases to all sites. Sites matching no orbital keep 0.
+        """
+        ndim = self.ndim
+        pc = torch.eye(RDIM, dtype=torch.float64, device=self.device)
+        if ndim > 0:
+            tokens = [tok for row in rows for tok in row][: ndim * ndim]
+            values = [parse_float(tok) for tok in tokens]
+            pc[:ndim, :ndim] = torch.tensor(values, dtype=torch.float64, device=self.device).view(ndim, ndim).t()
+            rows = _rows_after(rows, ndim * ndim)
+
+        # The supercell must be a multiple of the phase cell
+        inv = torch.linalg.inv(pc)
+        projph = inv @ self.sc.to(torch.float64)
+        if torch.sqrt(torch.sum((projph - torch.round(projph)) ** 2)) > TOLL:
+            raise ValueError("Supercell frustrates the phase")
+
+        # Orbitals of the phase cell and their phases
+        natom_ph = round(abs(float(torch.linalg.det(pc))) * self.natom)
+        if len(rows) < natom_ph:
+            raise ValueError(f"#PHASE lists {len(rows)} orbitals, expected {natom_ph}")
+        data = torch.tensor(
+            [[parse_float(tok) for tok in row[1 : RDIM + 2]] for row in rows[:natom_ph]],
+            dtype=torch.float64,
+            device=self.device,
+        )
+        xat_ph = self.ainv @ data[:, :RDIM].t()
+
+        # First phase-cell orbital every site is a translation of
+        diff = inv @ (xat_ph.unsqueeze(-1) - self.pos.unsqueeze(1)).reshape(RDIM, -1)
+        match = (torch.sqrt(torch.sum((diff - torch.round(diff)) ** 2, 0)) < TOLL).view(natom_ph, self.nsites)
+        first = torch.argmax(match.to(torch.int8), 0)
+        phase = torch.where(match.any(0), data[first, RDIM], 0.0)
+        self.phase = phase.to(torch.get_default_dtype())
+
+    @torch.no_grad()
+    def construct_classes(self, map_symm: torch.Tensor | None = None) -> None:
+        """Group the site pairs into classes of equivalent pairs (construct_lattice_classes)
+
+        Pairs are equivalent when a supercell translation, the exchange of
+        the two sites or one of the point symmetries map_symm (nsites,
+        nsymm), applied any number of times, takes one to the other. A
+        translation brings every pair to (orbital a of cell 0, site j), so
+        the natom * nsites representatives (a, b, cell of j) label the
+        translation classes. The symmetries link representatives, and the
+        classes are the connected components of the links. Classes are
+        numbered in the order of their first representative.
+        """
+        if not self.constructed:
+            raise ValueError("Lattice must be constructed before construct_classes")
+
+        natom, ncell = self.natom, self.ncell
+        cdiff = self.cell_difference()
+        sites = torch.arange(self.nsites, device=self.device)
+        atom, cell = sites % natom, sites // natom
+
+        def representative(i: torch.Tensor, j: torch.Tensor) -> torch.Tensor:
+            return (atom[i] * natom + atom[j]) * ncell + cdiff[cell[i], cell[j]]
+
+        # Representative r = (a * natom + b) * ncell + c is the pair (a, b + natom * c)
+        rep = torch.arange(natom * natom * ncell, device=self.device)
+        i = rep // (natom * ncell)
+        j = rep // ncell % natom + natom * (rep % ncell)
+
+        links = [representative(j, i)]
+        if map_symm is not None:
+            map_symm = map_symm.to(self.device, torch.int64)
+            links += [representative(m[i], m[j]) for m in map_symm.t()]
+
+        _, rep_class = torch.unique(smallest_equivalent(links), return_inverse=True)
+        self.nclass = int(rep_class.max()) + 1
+
+        # Class of every pair through its representative
+        self.myclass = rep_class[representative(sites.unsqueeze(1), sites.unsqueeze(0))]
+        self.class_size = torch.bincount(self.myclass.flatten(), minlength=self.nclass)
+
+        # Label: separation, first and second orbital of the first pair with i in cell 0
+        order = torch.arange(natom * self.nsites, device=self.device)
+        first = torch.full((self.nclass,), order.numel(), device=self.device)
+        first = first.scatter_reduce(0, self.myclass[:natom].flatten(), order, "amin")
+        i, j = first // self.nsites, first % self.nsites
+        self.class_label = torch.cat(
+            [
+                (self.cartpos[:, j] - self.cartpos[:, i]).t(),
+                i.unsqueeze(1).to(torch.float64),
+                (j % natom).unsqueeze(1).to(torch.float64),
+            ],
+            dim=1,
+        )
+        self.analyzed = True
+
+    @torch.no_grad()
     def assign_gf_phase(self, twist: torch.Tensor) -> None:
-        """Assign phases for Green's function calculation"""
-        self.gf_phase = torch.zeros((self.nsites, self.nsites), device=self.device)
-
-        for ic in range(self.nclass):
-            csize = 0
-            for j in range(self.nsites):
-                for i in range(self.nsites):
-                    if self.myclass[i, j] != ic:
-                        continue
-
-                    d = self.translation[:, j // self.natom] - self.translation[:, i // self.natom]
-
-                    if csize == 0:
-                        d0 = d.clone()
-                        self.gf_phase[j, i] = 1
-                    else:
-                        # Calculate phases
-                        rphase = torch.cos(torch.sum(twist * (d0 - d)))
-                        iphase = torch.sin(torch.sum(twist * (d0 - d)))
-
-                        if torch.abs(iphase) < 1e-6:
-                            rounded = torch.round(rphase)
-                            if torch.abs(rphase - rounded) < 1e-6:
-                                self.gf_phase[j, i] = rounded
-                            else:
-                                # Try alternative phase
-                                rphase = torch.cos(torch.sum(twist * (d0 + d)))
-                                iphase = torch.sin(torch.sum(twist * (d0 + d)))
-                                if torch.abs(iphase) < 1e-6:
-                                    rounded = torch.round(rphase)
-                                    if torch.abs(rphase - rounded) < 1e-6:
-                                        self.gf_phase[j, i] = rounded
-                                    else:
-                                        raise ValueError("Problem with phase")
-
-                    csize += 1
-
-            if csize != self.class_size[ic]:
-                raise ValueError("Problem with classes")
+        """Phases of the Green's function entries from the twist of the boundary (assign_gf_phase)
+
+        Within a class the phase of a pair is that of its translation d
+        relative to the translation d0 of the first pair of the class, in
+        column order: cos(twist . (d0 - d)) when it is real, else
+        cos(twist . (d0 + d)). All pairs are evaluated at once; twist . t
+        is computed per cell, so the phases come from differences of
+        scalars instead of (3, N, N) displacement vectors.
+        """
+        if not self.analyzed:
+            raise ValueError("Classes must be constructed before assign_gf_phase")
+
+        n = self.nsites
+        twist = torch.as_tensor(twist, device=self.device, dtype=torch.float64)
+        tcell = twist @ self.translation.to(torch.float64)
+        t = tcell[torch.arange(n, device=self.device) // self.natom]
+        td = t.unsqueeze(0) - t.unsqueeze(1)  # [i, j] = twist . (t_j - t_i)
+
+        # First pair (i, j) of every class with j the slower index
+        myclass = self.myclass.t().flatten()
+        order = torch.arange(n * n, device=self.device)
+        first = torch.full((self.nclass,), n * n, device=self.device)
+        first = first.scatter_reduce(0, myclass, order, "amin")
+        td0 = td.t().flatten()[first][self.myclass]
+
+        def integer_phase(x: torch.Tensor) -> tuple[torch.Tensor, torch.Tensor, torch.Tensor]:
+            rphase, iphase = torch.cos(x), torch.sin(x)
+            rounded = torch.round(rphase)
+            return torch.abs(iphase) < 1e-6, torch.abs(rphase - rounded) < 1e-6, rounded
+
+        real, integer, phase = integer_phase(td0 - td)
+        real_alt, integer_alt, phase_alt = integer_phase(td0 + td)
+        if torch.any(~real & real_alt & ~integer_alt):
+            raise ValueError("Problem with phase")
+
+        gf_phase = torch.where(real & integer, phase, 0.0)
+        gf_phase = torch.where(~real & real_alt, phase_alt, gf_phase)
+        self.gf_phase = gf_phase.t().to(torch.get_default_dtype())
+
+
+def smallest_equivalent(links: list[torch.Tensor]) -> torch.Tensor:
+    """Smallest element equivalent to every element 0..n-1
+
+    links[k][i] is an element equivalent to i. The equivalence classes are
+    the connected components of all links together, found by propagating
+    the smallest index along every link at once and shortcutting chains of
+    labels.
+    """
+    label = torch.arange(links[0].numel(), device=links[0].device)
+    while True:
+        old = label
+        for link in links:
+            low = torch.minimum(label, label[link])
+            label = low.scatter_reduce(0, link, low, "amin")
+        while not torch.equal(label[label], label):
+            label = label[label]
+        if torch.equal(label, old):
+            return label
+
+
+def _rows_after(rows: list[list[str]], count: int) -> list[list[str]]:
+    """Rows left after reading count tokens list-directed, Fortran style"""
+    for i, row in enumerate(rows):
+        count -= len(row)
+        if count <= 0:
+            return rows[i + 1 :]
+    return []
@@ -0,0 +1,72 @@
+# src/matb.py
+from dataclasses import dataclass, field
+
+import torch
+
+from profiler import matmul_flops, profiled
+
+DEVICE = torch.get_default_device()
+
+
+@dataclass
+class DenseB:
+    """Dense matrix B, B_l = diag(V_l) * B with B = exp(-dtau * (K - mu))
+
+    Every product runs in the dtype of M. For an M of lower precision than B
+    (the float32 G of a mixed precision run) B and Bi are rounded once and
+    the rounded copies are kept. The intermediate product goes to a buffer
+    kept per shape and dtype of M, so repeated products allocate nothing.
+    """
+
+    n: int  # dim of B
+    B: torch.Tensor  # exp(-dtau * (K - mu))
+    Bi: torch.Tensor  # inverse of B
+    name: str = "Dense"
+    device: torch.device = DEVICE
+    casts: dict = field(default_factory=dict, repr=False)  # (inverse, dtype) -> rounded copy of B or Bi
+    buffers: dict = field(default_factory=dict, repr=False)  # (shape, dtype) -> intermediate product
+
+    def _matrix(self, inverse: bool, dtype: torch.dtype) -> torch.Tensor:
+        """B or Bi in dtype"""
+        M = self.Bi if inverse else self.B
+        if M.dtype == dtype:
+            return M
+        key = (inverse, dtype)
+        if key not in self.casts:
+            self.casts[key] = M.to(dtype)
+        return self.casts[key]
+
+    def _buffer(self, M: torch.Tensor) -> torch.Tensor:
+        """Scratch of the shape and dtype of M"""
+        key = (M.shape, M.dtype)
+        if key not in self.buffers:
+            self.buffers[key] = torch.empty(M.shape, dtype=M.dtype, device=M.device)
+        return self.buffers[key]
+
+    @profiled("mult_left", flops=lambda self, M, _V_i: matmul_flops(self.B, M))
+    @torch.no_grad()
+    def mult_left(self, M: torch.Tensor, V_i: torch.Tensor) -> None:
+        """M = B_i * M"""
+        P = torch.matmul(self._matrix(False, M.dtype), M, out=self._buffer(M))
+        torch.mul(P, V_i.unsqueeze(-1), out=M)
+
+    @profiled("mult_right", flops=lambda self, M, _V_i: matmul_flops(M, self.B))
+    @torch.no_grad()
+    def mult_right(self, M: torch.Tensor, V_i: torch.Tensor) -> None:
+        """M = M * B_i"""
+        P = torch.mul(M, V_i.unsqueeze(-2), out=self._buffer(M))
+        torch.matmul(P, self._matrix(False, M.dtype), out=M)
+
+    @profiled("mult_left_inv", flops=lambda self, M, _V_i: matmul_flops(self.Bi, M))
+    @torch.no_grad()
+    def mult_left_inv(self, M: torch.Tensor, V_i: torch.Tensor) -> None:
+        """M = B_i^-1 * M"""
+        P = torch.div(M, V_i.unsqueeze(-1), out=self._buffer(M))
+        torch.matmul(self._matrix(True, M.dtype), P, out=M)
+
+    @profiled("mult_right_inv", flops=lambda self, M, _V_i: matmul_flops(M, self.Bi))
+    @torch.no_grad()
+    def mult_right_inv(self, M: torch.Tensor, V_i: torch.Tensor) -> None:
+        """M = M * B_i^-1"""
+        P = torch.matmul(M, self._matrix(True, M.dtype), out=self._buffer(M))
+        torch.div(P, V_i.unsqueeze(-2), out=M)
@@ -1,9 +1,12 @@
 # src/measurements.py
+import math
 from dataclasses import dataclass
 from enum import IntEnum
 
 import torch
 
+from utils import sign_jackknife
+
 DEVICE = torch.get_default_device()
 
 
@@ -25,29 +28,99 @@ class Observable(IntEnum):
     DN_SIGN = 14  # Average down sign
 
 
+# Components of PhysicalMeasurements.correlations and their class normalization
+CORRELATIONS = ("green_fn", "dens_uu", "dens_ud", "spin_xx", "spin_zz")
+CORRELATION_SCALE = (0.5, 0.5, 1.0, 1.0, 1.0)
+
+
+@dataclass
+class MeasureBuffers:
+    """Intermediates of PhysicalMeasurements.measure for one shape of G"""
+
+    batch_shape: tuple[int, ...]  # leading walker dimensions
+    n: int  # number of sites
+    dtype: torch.dtype | None = None  # of G (None = default dtype)
+    device: torch.device = DEVICE
+
+    def __post_init__(self):
+        b, n = self.batch_shape, self.n
+        options = {"dtype": self.dtype, "device": self.device}
+
+        # Signs and the sample count of every call
+        self.sign_up = torch.zeros(b, **options)
+        self.sign_dn = torch.zeros(b, **options)
+        self.sgn = torch.zeros(b, **options)
+        self.samples = torch.full((1,), math.prod(b), **options)
+
+        # Occupancies and per-site terms
+        self.n_up = torch.zeros((*b, n), **options)
+        self.n_dn = torch.zeros((*b, n), **options)
+        self.onsite = torch.zeros((*b, n), **options)
+        self.site = torch.zeros((*b, n), **options)
+        self.site_dn = torch.zeros((*b, n), **options)
+
+        # Pair correlations of every sample and their sign weighted sum
+        self.pairs = torch.zeros((*b, len(CORRELATIONS), n, n), **options)
+        self.exchange = torch.zeros((*b, n, n), **options)
+        self.pair_sum = torch.zeros((1, len(CORRELATIONS) * n * n), **options)
+
+        # Scalar measurements of every sample and their sum
+        self.meas = torch.zeros((*b, len(Observable)), **options)
+        self.meas_sum = torch.zeros(len(Observable), **options)
+
+        # Constants
+        self.one = torch.ones((), **options)
+        self.half = torch.full((), 0.5, **options)
+        self.n = torch.full((), n, **options)
+
+
 @dataclass
 class PhysicalMeasurements:
-    """Physical measurements during DQMC simulation"""
+    """Physical measurements during DQMC simulation
+
+    All observables of one sample are computed from G_up/G_dn with
+    element-wise ops and GEMVs, and the per-pair correlations are reduced
+    onto the distance classes with a single index_add_ over the flattened
+    class map, as DQMC_Phy0_Meas.
+    """
 
     n: int  # Number of sites
     n_bins: int  # Number of measurement bins
     n_class: int  # Number of correlation classes
+    myclass: torch.Tensor  # Distance class of every site pair (n, n)
+    phase: torch.Tensor | None = None  # AF phase of every site, None skips the AF structure factors
+    gf_phase: torch.Tensor | None = None  # Phase of G in every site pair (n, n)
+    U: torch.Tensor | float = 0.0  # Hubbard U of every site
     device: torch.device = DEVICE
 
     def __post_init__(self):
-        # Initialize scalar measurements
-        self.scalars = torch.zeros((len(Observable), self.n_bins), device=self.device)
+        # Initialize scalar measurements, two extra bins hold average and error
+        self.scalars = torch.zeros((len(Observable), self.n_bins + 2), device=self.device)
+
+        # Initialize correlation functions, views of one (component, class, bin) tensor
+        self.correlations = torch.zeros((len(CORRELATIONS), self.n_class, self.n_bins + 2), device=self.device)
+        self.green_fn = self.correlations[0]
+        self.dens_uu = self.correlations[1]
+        self.dens_ud = self.correlations[2]
+        self.spin_xx = self.correlations[3]
+        self.spin_zz = self.correlations[4]
+
+        # Scatter index and weight of every site pair
+        self.pair_class = self.myclass.to(self.device, torch.int64).flatten()
+        self.class_size = torch.bincount(self.pair_class, minlength=self.n_class)
+        scale = torch.tensor(CORRELATION_SCALE, device=self.device).unsqueeze(-1)
+        self.pair_weight = scale / self.class_size[self.pair_class]
+        if self.gf_phase is not None:
+            self.pair_weight[0] *= self.gf_phase.to(self.device).flatten()
 
-        # Initialize correlation functions
-        self.green_fn = torch.zeros((self.n_class, self.n_bins), device=self.device)
-        self.dens_uu = torch.zeros((self.n_class, self.n_bins), device=self.device)
-        self.dens_ud = torch.zeros((self.n_class, self.n_bins), device=self.device)
-        self.spin_xx = torch.zeros((self.n_class, self.n_bins), device=self.device)
-        self.spin_zz = torch.zeros((self.n_class, self.n_bins), device=self.device)
+        # Hubbard U of every site and the buffers of measure, per shape and dtype of G
+        self.U_sites = torch.as_tensor(self.U, device=self.device)
+        self.buffers: dict[tuple[torch.Size, torch.dtype], MeasureBuffers] = {}
 
         # Statistics
         self.curr_bin = 0
         self.measurements = 0
+        self.counts = torch.zeros(self.n_bins, device=self.device)  # samples per bin
         self.avg_bin = self.n_bins
         self.err_bin = self.n_bins + 1
 
@@ -58,32 +131,127 @@ class PhysicalMeasurements:
         G_dn: torch.Tensor,
         mu: tuple[float, float],
         t: torch.Tensor,
-        sign_up: float,
-        sign_dn: float,
+        sign_up: float | torch.Tensor,
+        sign_dn: float | torch.Tensor,
     ) -> None:
-        """Perform measurements using Green's functions"""
-        # Occupancies
-        n_up = torch.diagonal(G_up).sum() / self.n
-        n_dn = torch.diagonal(G_dn).sum() / self.n
-
-        # Energies
-        pot = self.compute_potential(G_up, G_dn)
-        kin = self.compute_kinetic(G_up, G_dn, t)
-
-        # Store scalar measurements
-        self.scalars[Observable.UP_OCC, self.curr_bin] += n_up
-        self.scalars[Observable.DN_OCC, self.curr_bin] += n_dn
-        self.scalars[Observable.POT_ENERGY, self.curr_bin] += pot
-        self.scalars[Observable.KIN_ENERGY, self.curr_bin] += kin
-        self.scalars[Observable.TOT_ENERGY, self.curr_bin] += pot + kin
-        self.scalars[Observable.DENSITY, self.curr_bin] += (n_up + n_dn) / 2
-
-        # Signs
-        self.scalars[Observable.UP_SIGN, self.curr_bin] += sign_up
-        self.scalars[Observable.DN_SIGN, self.curr_bin] += sign_dn
-        self.scalars[Observable.AVG_SIGN, self.curr_bin] += sign_up * sign_dn
-
-        # Correlation functions
-        self.measure_correlations(G_up, G_dn)
-
-        self.measurements += 1
+        """Perform measurements using Green's functions
+
+        t is the matrix of hopping amplitudes t_ij. G_up/G_dn may carry
+        leading walker dimensions, every walker then adds one sample. All
+        intermediates are written into buffers kept per shape and dtype of G,
+        so a measurement does not allocate.
+        """
+        buf = self._buffers(G_up)
+        mu_up, mu_dn = mu
+        for out, sign in ((buf.sign_up, sign_up), (buf.sign_dn, sign_dn)):
+            out.copy_(sign) if isinstance(sign, torch.Tensor) else out.fill_(sign)
+        sgn = torch.mul(buf.sign_up, buf.sign_dn, out=buf.sgn)
+
+        # Site occupancies
+        g_up = torch.diagonal(G_up, 0, -2, -1)
+        g_dn = torch.diagonal(G_dn, 0, -2, -1)
+        n_up = torch.sub(buf.one, g_up, out=buf.n_up)
+        n_dn = torch.sub(buf.one, g_dn, out=buf.n_dn)
+        onsite = torch.add(g_up, g_dn, out=buf.onsite)
+
+        # Pair correlations, onsite terms from the anticommutator
+        green_fn, dens_uu, dens_ud, spin_xx, spin_zz = buf.pairs.unbind(-3)
+        exchange = torch.mul(G_up, G_up.mT, out=buf.exchange).addcmul_(G_dn, G_dn.mT)
+        torch.add(G_up, G_dn, out=green_fn)
+        torch.mul(n_up.unsqueeze(-1), n_up.unsqueeze(-2), out=dens_uu).addcmul_(n_dn.unsqueeze(-1), n_dn.unsqueeze(-2))
+        torch.mul(n_up.unsqueeze(-1), n_dn.unsqueeze(-2), out=dens_ud)
+        spin_xx.zero_().addcmul_(G_up, G_dn.mT, value=-2)
+        torch.mul(g_up.unsqueeze(-1), g_up.unsqueeze(-2), out=spin_zz).addcmul_(g_dn.unsqueeze(-1), g_dn.unsqueeze(-2))
+        spin_zz.addcmul_(g_up.unsqueeze(-1), g_dn.unsqueeze(-2), value=-2)
+        for pair in (dens_uu, spin_zz):
+            pair.sub_(exchange)
+        for pair in (dens_uu, spin_xx, spin_zz):
+            torch.diagonal(pair, 0, -2, -1).add_(onsite)
+
+        # Energies and the scalar measurements of every sample
+        meas = buf.meas.zero_()
+        up_occ, dn_occ, pot, kin, tot, density, xx_fm, zz_fm, xx_af, zz_af, rms_xx, rms_zz = meas.unbind(-1)[:12]
+        torch.sum(n_up, -1, out=up_occ)
+        torch.sum(n_dn, -1, out=dn_occ)
+        half = torch.sub(n_up, buf.half, out=buf.site).mul_(torch.sub(n_dn, buf.half, out=buf.site_dn))
+        torch.sum(half.mul_(self.U_sites), -1, out=pot)
+        torch.sum(torch.mul(green_fn, t, out=buf.exchange), (-2, -1), out=kin)
+        kin.add_(up_occ, alpha=-mu_up).add_(dn_occ, alpha=-mu_dn)
+        torch.add(kin, pot, out=tot)
+        torch.add(up_occ, dn_occ, out=density)
+        torch.sum(spin_xx, (-2, -1), out=xx_fm)
+        torch.sum(spin_zz, (-2, -1), out=zz_fm)
+        if self.phase is not None:
+            for pair, af in ((spin_xx, xx_af), (spin_zz, zz_af)):
+                torch.mul(torch.matmul(pair, self.phase, out=buf.site), self.phase, out=buf.site)
+                torch.sum(buf.site, -1, out=af)
+        meas.div_(buf.n)
+
+        # Squares of the AF structure factors, the RMS is taken on the averages
+        torch.mul(xx_af, xx_af, out=rms_xx)
+        torch.mul(zz_af, zz_af, out=rms_zz)
+
+        # Sign weighted accumulation into the current bin
+        meas.mul_(sgn.unsqueeze(-1))
+        meas[..., Observable.AVG_SIGN].copy_(sgn)
+        meas[..., Observable.UP_SIGN].copy_(buf.sign_up)
+        meas[..., Observable.DN_SIGN].copy_(buf.sign_dn)
+        self.scalars[:, self.curr_bin].add_(torch.sum(meas.view(-1, len(Observable)), 0, out=buf.meas_sum))
+
+        # Reduce all correlations onto the distance classes at once
+        pairs = torch.matmul(sgn.view(1, -1), buf.pairs.view(sgn.numel(), -1), out=buf.pair_sum)
+        pairs = pairs.view(len(CORRELATIONS), -1).mul_(self.pair_weight)
+        self.correlations[..., self.curr_bin].index_add_(1, self.pair_class, pairs)
+
+        self.counts[self.curr_bin : self.curr_bin + 1].add_(buf.samples)
+        self.measurements += sgn.numel()
+
+    def _buffers(self, G: torch.Tensor) -> MeasureBuffers:
+        """Scratch of measure for Green's functions of the shape and dtype of G"""
+        key = (G.shape, G.dtype)
+        if key not in self.buffers:
+            self.buffers[key] = MeasureBuffers(G.shape[:-2], self.n, G.dtype, G.device)
+        return self.buffers[key]
+
+    def bin_shapes(self) -> dict[str, tuple[int, ...]]:
+        """Shapes of the blocks of one bin, see BinStore"""
+        return {"scalars": (len(Observable),), "correlations": (len(CORRELATIONS), self.n_class), "counts": (1,)}
+
+    def bin_record(self, bin_idx: int) -> dict[str, torch.Tensor]:
+        """Views of one bin, keyed as bin_shapes"""
+        return {
+            "scalars": self.scalars[:, bin_idx],
+            "correlations": self.correlations[..., bin_idx],
+            "counts": self.counts[bin_idx : bin_idx + 1],
+        }
+
+    def reset_bin(self, bin_idx: int) -> None:
+        """Clear one bin for reuse"""
+        for value in self.bin_record(bin_idx).values():
+            value.zero_()
+
+    def bin_data(self) -> list[torch.Tensor]:
+        """Per-bin sums to be combined across processes, see BinAggregator"""
+        return [self.scalars[:, : self.n_bins], self.correlations[..., : self.n_bins], self.counts]
+
+    @torch.no_grad()
+    def get_err(self) -> None:
+        """Fill avg_bin and err_bin by sign jackknife over the bins (DQMC_Phy0_GetErr)"""
+        bins = slice(0, self.n_bins)
+        sgn = self.scalars[Observable.AVG_SIGN, bins]
+
+        # Observables are weighted by the sign, the signs by the sample count
+        avg, err = sign_jackknife(self.scalars[:, bins], sgn.expand(len(Observable), -1))
+        signs = [Observable.AVG_SIGN, Observable.UP_SIGN, Observable.DN_SIGN]
+        avg[signs], err[signs] = sign_jackknife(self.scalars[signs, bins], self.counts.expand(len(signs), -1))
+
+        # RMS of the AF structure factors from the averaged squares
+        rms = [Observable.RMS_XX_AF, Observable.RMS_ZZ_AF]
+        avg[rms] = avg[rms].abs().sqrt()
+        err[rms] = torch.where(avg[rms] > 0, err[rms] / (2 * avg[rms]), err[rms])
+        self.scalars[:, self.avg_bin] = avg
+        self.scalars[:, self.err_bin] = err
+
+        avg, err = sign_jackknife(self.correlations[..., bins], sgn.expand(*self.correlations.shape[:-1], -1))
+        self.correlations[..., self.avg_bin] = avg
+        self.correlations[..., self.err_bin] = err
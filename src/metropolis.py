@@ -0,0 +1,283 @@
+# src/metropolis.py
+import functools
+from collections.abc import Callable
+from dataclasses import dataclass
+
+import torch
+
+from green import addmm_
+
+DEVICE = torch.get_default_device()
+
+UPDATE_BACKENDS = ("python", "eager", "compile")
+
+
+@dataclass
+class SpinBuffers:
+    """Temporaries of site_step for one spin, shaped for one site of every walker"""
+
+    batch_shape: tuple[int, ...]  # leading walker dimensions
+    n: int  # number of sites
+    n_blk: int  # columns of the update panels
+    dtype: torch.dtype | None = None  # of G (None = default dtype)
+    device: torch.device = DEVICE
+
+    def __post_init__(self):
+        b, n, n_blk = self.batch_shape, self.n, self.n_blk
+        options = {"dtype": self.dtype, "device": self.device}
+
+        # G[j, j], alpha[j] and the rows j of the panels with their product
+        self.gjj = torch.zeros((*b, 1), **options)
+        self.alpha = torch.zeros((*b, 1), **options)
+        self.U_row = torch.zeros((*b, 1, n_blk), **options)
+        self.W_row = torch.zeros((*b, 1, n_blk), **options)
+        self.UW_row = torch.zeros((*b, 1, n_blk), **options)
+
+        # Ratio r, its sign and the update weight gamma
+        self.r = torch.zeros((*b, 1), **options)
+        self.sign = torch.zeros((*b, 1), **options)
+        self.gamma = torch.zeros((*b, 1), **options)
+
+        # Column x and row y of the update, the row of G and the panel products
+        self.x = torch.zeros((*b, n, 1), **options)
+        self.y = torch.zeros((*b, n, 1), **options)
+        self.G_row = torch.zeros((*b, 1, n), **options)
+        self.prod = torch.zeros((*b, n, 1), **options)
+
+
+@dataclass
+class SiteBuffers:
+    """Preallocated operands and temporaries of metropolis_slice, none of its ops allocates
+
+    alpha_up/alpha_dn, boson and rand are the per-site inputs of a slice,
+    filled by the engine before every call.
+    """
+
+    batch_shape: tuple[int, ...]  # leading walker dimensions
+    n: int  # number of sites
+    n_blk: int  # columns of the update panels
+    dtype: torch.dtype | None = None  # of G (None = default dtype)
+    device: torch.device = DEVICE
+
+    def __post_init__(self):
+        b, n = self.batch_shape, self.n
+        options = {"dtype": self.dtype, "device": self.device}
+        self.up = SpinBuffers(b, n, self.n_blk, self.dtype, self.device)
+        self.dn = SpinBuffers(b, n, self.n_blk, self.dtype, self.device)
+
+        # Inputs of the slice
+        self.alpha_up = torch.zeros((*b, n), **options)
+        self.alpha_dn = torch.zeros((*b, n), **options)
+        self.boson = torch.ones((*b, n), **options)
+        self.rand = torch.zeros((*b, n), **options)
+        self.delta = torch.zeros((*b, n), **options)  # change of the exponent of V_up
+
+        # Ratio and acceptance of one site, accepted flips of the slice
+        self.ratio = torch.zeros((*b, 1), **options)
+        self.boson_j = torch.zeros((*b, 1), **options)
+        self.rand_j = torch.zeros((*b, 1), **options)
+        self.accept = torch.zeros((*b, 1), dtype=torch.bool, device=self.device)
+        self.reject = torch.zeros((*b, 1), dtype=torch.bool, device=self.device)
+        self.accepted = torch.zeros((*b, n), dtype=torch.bool, device=self.device)
+
+        # Site indices and constants
+        self.sites = torch.arange(n, device=self.device)
+        self.one = torch.ones((), **options)
+        self.ones = torch.ones((*b, 1, 1), **options)
+
+
+def site_step(
+    G_up: torch.Tensor,
+    U_up: torch.Tensor,
+    W_up: torch.Tensor,
+    G_dn: torch.Tensor,
+    U_dn: torch.Tensor,
+    W_dn: torch.Tensor,
+    alpha_up: torch.Tensor,
+    alpha_dn: torch.Tensor,
+    boson: torch.Tensor,
+    rand: torch.Tensor,
+    sign_up: torch.Tensor,
+    sign_dn: torch.Tensor,
+    buffers: SiteBuffers,
+    j: torch.Tensor,
+    k: torch.Tensor,
+) -> None:
+    """Accept or reject the flip of site j and store its rank-1 updates in column k of the panels
+
+    j and k are one-element index tensors. Columns k and above of U/W are
+    zero, so the pending updates are summed over the whole panels: the ops
+    and their shapes do not depend on j or k, and a compiled step is one
+    graph for all sites of all slices. Every op writes into buffers.
+    """
+    up, dn = buffers.up, buffers.dn
+
+    # Ratios from the diagonal of G including the pending updates
+    _ratio(G_up, U_up, W_up, alpha_up, j, up, buffers.one)
+    _ratio(G_dn, U_dn, W_dn, alpha_dn, j, dn, buffers.one)
+
+    ratio = torch.mul(up.r, dn.r, out=buffers.ratio)
+    ratio.mul_(torch.index_select(boson, -1, j, out=buffers.boson_j)).abs_().clamp_(max=1.0)
+    accept = torch.lt(torch.index_select(rand, -1, j, out=buffers.rand_j), ratio, out=buffers.accept)
+    reject = torch.logical_not(accept, out=buffers.reject)
+    buffers.accepted.index_copy_(-1, j, accept)
+
+    for spin, sign in ((up, sign_up), (dn, sign_dn)):
+        sign.mul_(torch.sign(spin.r, out=spin.sign).masked_fill_(reject, 1.0).squeeze(-1))
+        torch.div(spin.alpha, spin.r, out=spin.gamma).masked_fill_(reject, 0.0)
+
+    _push_update(G_up, U_up, W_up, j, k, up, buffers.ones)
+    _push_update(G_dn, U_dn, W_dn, j, k, dn, buffers.ones)
+
+
+def _ratio(
+    G: torch.Tensor,
+    U: torch.Tensor,
+    W: torch.Tensor,
+    alpha: torch.Tensor,
+    j: torch.Tensor,
+    spin: SpinBuffers,
+    one: torch.Tensor,
+) -> None:
+    """Ratio r = 1 + (1 - G[j, j]) alpha[j] of flipping site j into spin.r, with G[j, j] including the pending updates
+
+    G[j, j] is read from column j of G, left in spin.x for _push_update.
+    """
+    torch.index_select(torch.index_select(G, -1, j, out=spin.x), -2, j, out=spin.gjj.unsqueeze(-1))
+    torch.index_select(U, -2, j, out=spin.U_row)
+    torch.index_select(W, -2, j, out=spin.W_row)
+    torch.mul(spin.U_row, spin.W_row, out=spin.UW_row)
+    pending = torch.sum(spin.UW_row, -1, out=spin.r)
+    torch.sub(one, spin.gjj.add_(pending), out=spin.gjj)
+    torch.addcmul(one, spin.gjj, torch.index_select(alpha, -1, j, out=spin.alpha), out=spin.r)
+
+
+def _push_update(
+    G: torch.Tensor,
+    U: torch.Tensor,
+    W: torch.Tensor,
+    j: torch.Tensor,
+    k: torch.Tensor,
+    spin: SpinBuffers,
+    ones: torch.Tensor,
+) -> None:
+    """Store the rank-1 update of flip j in column k of the panels U and W
+
+    spin.gamma is zero for a rejected flip, so the stored update leaves G
+    unchanged. Column j of G and the rows j of the panels are those read by
+    _ratio.
+    """
+    # Column and row of G including the pending updates, the empty columns add nothing
+    spin.x.add_(torch.matmul(U, spin.W_row.mT, out=spin.prod))
+    torch.index_select(G, -2, j, out=spin.G_row)
+    torch.add(spin.G_row.mT, torch.matmul(W, spin.U_row.mT, out=spin.prod), out=spin.y)
+    spin.y.index_add_(-2, j, ones, alpha=-1)
+
+    U.index_copy_(-1, k, spin.x)
+    W.index_copy_(-1, k, spin.y.mul_(spin.gamma.unsqueeze(-1)))
+
+
+def metropolis_slice(
+    G_up: torch.Tensor,
+    U_up: torch.Tensor,
+    W_up: torch.Tensor,
+    G_dn: torch.Tensor,
+    U_dn: torch.Tensor,
+    W_dn: torch.Tensor,
+    alpha_up: torch.Tensor,
+    alpha_dn: torch.Tensor,
+    boson: torch.Tensor,
+    rand: torch.Tensor,
+    sign_up: torch.Tensor,
+    sign_dn: torch.Tensor,
+    buffers: SiteBuffers | None = None,
+    step: Callable[..., None] = site_step,
+) -> torch.Tensor:
+    """Metropolis sweep over the sites of one slice with delayed updates
+
+    alpha_up/alpha_dn are the relative changes of V for flipping each site,
+    boson the ratio of the weight outside the determinants, rand the
+    pre-drawn uniform numbers. U/W are the (n, n_blk) update panels,
+    which are flushed into G every n_blk sites and at the end. The signs of
+    det G^-1 are carried through the accepted flips in sign_up/sign_dn. All
+    operands may carry leading walker dimensions. Returns the mask of
+    accepted flips, a view of buffers.accepted.
+
+    The acceptance stays on the device: a rejected flip stores a zero update
+    instead of branching on the outcome, so the slice runs without a host
+    synchronization. The loop over the sites stays in Python, step handles
+    one site and may be the compiled site_step. Without buffers a new set is
+    allocated for the call.
+
+    G_up/G_dn must be row-major: _ratio reads a column through index_select,
+    which copies all of a column-major G, e.g. from torch.linalg.inv, at
+    every site.
+    """
+    if not (G_up.is_contiguous() and G_dn.is_contiguous()):
+        raise ValueError("metropolis_slice needs row-major (contiguous) Green's functions")
+
+    n = G_up.shape[-1]
+    n_blk = U_up.shape[-1]
+    if buffers is None:
+        buffers = SiteBuffers(G_up.shape[:-2], n, n_blk, G_up.dtype, G_up.device)
+
+    # Start from empty panels, site_step sums over all their columns
+    for panel in (U_up, W_up, U_dn, W_dn):
+        panel.zero_()
+
+    sites = buffers.sites
+    for j in range(n):
+        k = j % n_blk
+        step(
+            G_up,
+            U_up,
+            W_up,
+            G_dn,
+            U_dn,
+            W_dn,
+            alpha_up,
+            alpha_dn,
+            boson,
+            rand,
+            sign_up,
+            sign_dn,
+            buffers,
+            sites[j : j + 1],
+            sites[k : k + 1],
+        )
+
+        if k == n_blk - 1 or j == n - 1:
+            _flush(G_up, U_up, W_up)
+            _flush(G_dn, U_dn, W_dn)
+
+    return buffers.accepted
+
+
+def _flush(G: torch.Tensor, U: torch.Tensor, W: torch.Tensor) -> None:
+    """Apply the pending updates to G and empty the panels"""
+    addmm_(G, U, W.transpose(-2, -1))
+    U.zero_()
+    W.zero_()
+
+
+def get_update_kernel(backend: str) -> Callable[..., torch.Tensor] | None:
+    """Return the slice update kernel for a backend (None for the per-site Python loop)
+
+    The compile backend compiles site_step only. Its site and column
+    indices are tensors, so one graph serves every site, and lattice sizes
+    after the first share a dynamic-shape graph.
+    """
+    if backend not in UPDATE_BACKENDS:
+        raise ValueError(f"Unknown update backend {backend}, expected one of {', '.join(UPDATE_BACKENDS)}")
+
+    if backend == "python":
+        return None
+    if backend == "eager":
+        return metropolis_slice
+    return functools.partial(metropolis_slice, step=compiled_step())
+
+
+@functools.cache
+def compiled_step() -> Callable[..., None]:
+    """site_step compiled once per process, shared by all engines"""
+    return torch.compile(site_step)
@@ -12,6 +12,16 @@ class Channel(IntEnum):
     AGGR = 1
     MEAS = 2
     GFUN = 3
+    TEMP = 4  # replica exchange between neighbouring ranks
+
+
+# Attribute holding the communicator of every channel
+COMM_ATTRS = {
+    Channel.AGGR: "aggr_comm",
+    Channel.MEAS: "meas_comm",
+    Channel.GFUN: "gfun_comm",
+    Channel.TEMP: "temp_comm",
+}
 
 
 class ParallelLevel(IntEnum):
@@ -35,22 +45,25 @@ class ParallelQMC:
         self.aggr_rank = self.rank
         self.meas_rank = self.rank
         self.gfun_rank = self.rank
+        self.temp_rank = self.rank
 
         # Initialize sizes
         self.aggr_size = self.size
         self.meas_size = self.size
         self.gfun_size = self.size
+        self.temp_size = self.size
 
         # Initialize roots
         self.aggr_root = 0
         self.meas_root = 0
         self.gfun_root = 0
+        self.temp_root = 0
 
-        # Initialize communicators
-        if dist.is_initialized():
-            self.aggr_comm = dist.group.WORLD
-            self.meas_comm = dist.group.WORLD
-            self.gfun_comm = dist.group.WORLD
+        # Communicators, resolved by comm() on first use so that a process group started later counts
+        self.aggr_comm: dist.ProcessGroup | None = None
+        self.meas_comm: dist.ProcessGroup | None = None
+        self.gfun_comm: dist.ProcessGroup | None = None
+        self.temp_comm: dist.ProcessGroup | None = None
 
     @staticmethod
     def init(level: int = ParallelLevel.LEVEL_1) -> "ParallelQMC":
@@ -64,4 +77,24 @@ class ParallelQMC:
         """Check if current process is root for given channel"""
         if channel == Channel.AGGR:
             return self.aggr_rank == self.aggr_root
+        if channel == Channel.MEAS:
+            return self.meas_rank == self.meas_root
+        if channel == Channel.GFUN:
+            return self.gfun_rank == self.gfun_root
+        if channel == Channel.TEMP:
+            return self.temp_rank == self.temp_root
         return False
+
+    def comm(self, channel: Channel) -> dist.ProcessGroup | None:
+        """Communicator of given channel, None without a process group
+
+        Channels without a communicator of their own get the world group.
+        """
+        if not dist.is_initialized():
+            return None
+        if channel not in COMM_ATTRS:
+            raise ValueError(f"Unknown channel {channel}")
+        name = COMM_ATTRS[channel]
+        if getattr(self, name) is None:
+            setattr(self, name, dist.group.WORLD)
+        return getattr(self, name)
@@ -0,0 +1,180 @@
+# src/profiler.py
+import functools
+import json
+import time
+from collections.abc import Callable
+from contextlib import contextmanager
+from dataclasses import dataclass
+from pathlib import Path
+
+import torch
+
+
+@dataclass
+class ProfileItem:
+    """Counters of one region at one place in the call tree"""
+
+    count: int = 0  # number of calls
+    time: float = 0.0  # wall time in seconds, children included
+    flops: float = 0.0  # estimated floating point operations, children included
+    child_time: float = 0.0  # wall time spent in profiled children
+
+
+class Profiler:
+    """Nested wall time, call and flop counters of the hot paths (profile.h)
+
+    Regions are keyed by their path in the call tree, "sweep/_update_slice/udtd",
+    so the same kernel is counted separately under every caller. As in
+    profile.h the flops of a region include those of its children. When
+    sync is on, CUDA is synchronized at both ends of every region so that the
+    times are those of the kernels and not of their launches. With trace on,
+    every call is also kept as an event for the Chrome trace.
+
+    Disabled, a profiled function costs one flag test per call.
+    """
+
+    def __init__(self):
+        self.enabled = False
+        self.sync = False
+        self.trace = False
+        self.items: dict[str, ProfileItem] = {}
+        self.events: list[dict] = []
+        self._stack: list[list] = []  # path, start time and flops of the children of every open region
+        self._origin = time.perf_counter()
+
+    def enable(self, sync: bool | None = None, trace: bool = False) -> None:
+        """Start counting, sync defaults to whether CUDA is in use"""
+        self.enabled = True
+        self.sync = torch.cuda.is_available() if sync is None else sync
+        self.trace = trace
+
+    def disable(self) -> None:
+        """Stop counting, the counters are kept"""
+        self.enabled = False
+
+    def reset(self) -> None:
+        """Clear all counters and events"""
+        self.items.clear()
+        self.events.clear()
+        self._stack.clear()
+        self._origin = time.perf_counter()
+
+    def _now(self) -> float:
+        if self.sync:
+            torch.cuda.synchronize()
+        return time.perf_counter()
+
+    def begin(self, name: str) -> None:
+        """Open a region nested in the current one"""
+        path = f"{self._stack[-1][0]}/{name}" if self._stack else name
+        self._stack.append([path, self._now(), 0.0])
+
+    def end(self, flops: float = 0.0) -> None:
+        """Close the current region, adding its own flops"""
+        path, start, child_flops = self._stack.pop()
+        elapsed = self._now() - start
+
+        item = self.items.get(path)
+        if item is None:
+            item = self.items[path] = ProfileItem()
+        item.count += 1
+        item.time += elapsed
+        item.flops += flops + child_flops
+
+        if self._stack:
+            parent = self._stack[-1]
+            parent[2] += flops + child_flops
+            self.items.setdefault(parent[0], ProfileItem()).child_time += elapsed
+
+        if self.trace:
+            self.events.append(
+                {
+                    "name": path.rsplit("/", 1)[-1],
+                    "cat": path,
+                    "ph": "X",
+                    "ts": (start - self._origin) * 1e6,
+                    "dur": elapsed * 1e6,
+                    "pid": 0,
+                    "tid": 0,
+                    "args": {"flops": flops + child_flops},
+                },
+            )
+
+    def summary(self) -> dict[str, dict[str, float]]:
+        """Counters of every region with its self time and GFLOP/s"""
+        return {
+            path: {
+                "count": item.count,
+                "time": item.time,
+                "self_time": item.time - item.child_time,
+                "flops": item.flops,
+                "gflops": item.flops * 1e-9 / item.time if item.time > 0 else 0.0,
+            }
+            for path, item in sorted(self.items.items())
+        }
+
+    def report(self) -> str:
+        """Table of all regions, indented by depth"""
+        lines = [f" {'Region':<40} {'Calls':>10} {'Time [s]':>12} {'Self [s]':>12} {'GFLOP/s':>10}"]
+        for path, s in self.summary().items():
+            depth = path.count("/")
+            name = "  " * depth + path.rsplit("/", 1)[-1]
+            lines.append(
+                f" {name:<40} {s['count']:>10d} {s['time']:>12.6f} {s['self_time']:>12.6f} {s['gflops']:>10.2f}",
+            )
+        return "\n".join(lines)
+
+    def to_json(self, path: Path) -> None:
+        """Write the summary as JSON"""
+        with open(path, "w") as f:
+            json.dump(self.summary(), f, indent=2)
+
+    def to_chrome_trace(self, path: Path) -> None:
+        """Write the events in the Chrome trace format (chrome://tracing, Perfetto)"""
+        with open(path, "w") as f:
+            json.dump({"traceEvents": self.events, "displayTimeUnit": "ms"}, f)
+
+
+PROFILER = Profiler()
+
+
+@contextmanager
+def profile(name: str, flops: float = 0.0):
+    """Count the enclosed block as region name"""
+    if not PROFILER.enabled:
+        yield
+        return
+    PROFILER.begin(name)
+    try:
+        yield
+    finally:
+        PROFILER.end(flops)
+
+
+def profiled(name: str | None = None, flops: Callable[..., float] | None = None) -> Callable:
+    """Count every call of the decorated function as a region
+
+    flops, if given, estimates the operation count from the call arguments.
+    """
+
+    def decorator(fn: Callable) -> Callable:
+        region = name or fn.__name__
+
+        @functools.wraps(fn)
+        def wrapper(*args: object, **kwargs: object) -> object:
+            if not PROFILER.enabled:
+                return fn(*args, **kwargs)
+            PROFILER.begin(region)
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                PROFILER.end(flops(*args, **kwargs) if flops is not None else 0.0)
+
+        return wrapper
+
+    return decorator
+
+
+def matmul_flops(A: torch.Tensor, B: torch.Tensor) -> float:
+    """Flops of A @ B with batch dimensions"""
+    return 2.0 * A.shape[-1] * A.shape[-2] * B.numel() / B.shape[-2]
@@ -4,7 +4,7 @@ from dataclasses import dataclass
 import numpy as np
 import torch
 
-from .lattice import Lattice
+from lattice import RDIM, TOLL, Lattice
 
 DEVICE = torch.get_default_device()
 
@@ -56,3 +56,48 @@ class ReciprocalLattice:
             self.ktwist = self.kpoint * np.pi
 
         self.initialized = True
+
+    @torch.no_grad()
+    def construct_recip_lattice(self, lattice: Lattice) -> None:
+        """k-points of the supercell (construct_recip_lattice)
+
+        The grid is spanned by the reciprocal supercell vectors kcs. Its
+        points in the reciprocal primitive cell are the integer combinations
+        m with sc^T f = m for f in [0, 1), taken from the bounding box of the
+        cell in one pass as construct_lattice takes the translations. The
+        twist shifts the whole grid.
+        """
+        if not self.initialized:
+            raise ValueError("Reciprocal lattice must be initialized first")
+
+        # Bounding box of the reciprocal primitive cell in units of kcs
+        sct = lattice.sc.t().to(torch.float64)
+        corners = torch.cartesian_prod(*[torch.tensor([0.0, 1.0], dtype=torch.float64, device=self.device)] * RDIM)
+        corners = sct @ corners.t()
+        bounds = zip(corners.amin(1).tolist(), corners.amax(1).tolist(), strict=True)
+        axes = [torch.arange(round(lo), round(hi), device=self.device, dtype=torch.float64) for lo, hi in bounds]
+        mz, my, mx = torch.meshgrid(axes[2], axes[1], axes[0], indexing="ij")
+        mm = torch.stack([mx.flatten(), my.flatten(), mz.flatten()])
+        frac = torch.linalg.solve(sct, mm)
+        inside = ((frac > -TOLL) & (frac < 1 - TOLL)).all(0)
+        if int(inside.sum()) != self.nkpts:
+            raise ValueError(f"Found {int(inside.sum())} k-points for {self.nkpts} cells")
+
+        grid = self.kcs.to(self.device, torch.float64) @ mm[:, inside]
+        self.klist = (grid + self.ktwist.to(self.device, torch.float64).unsqueeze(-1)).t()
+        self.constructed = True
+
+    @torch.no_grad()
+    def k_sum(self) -> torch.Tensor:
+        """k-point k_i + k_j of every pair of k-points of the grid with Gamma (nkpts, nkpts)
+
+        The components of the grid in units of kc are multiples of 1 / nkpts,
+        so sums are added as integer digits modulo nkpts and looked up by key.
+        """
+        n = self.nkpts
+        frac = torch.linalg.solve(self.kc.to(self.device, torch.float64), self.klist.t().to(torch.float64))
+        digits = torch.round(frac * n).to(torch.int64) % n
+        radix = (n ** torch.arange(RDIM, device=self.device)).unsqueeze(-1)
+        keys, order = torch.sort((digits * radix).sum(0))
+        total = (digits.unsqueeze(1) + digits.unsqueeze(2)) % n
+        return order[torch.searchsorted(keys, (total * radix.unsqueeze(-1)).sum(0))]
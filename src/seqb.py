@@ -0,0 +1,147 @@
+# src/seqb.py
+from dataclasses import dataclass
+
+import torch
+
+from checkerboard import MatB
+from kernels import udtd_
+from matb import DenseB
+from profiler import profiled
+from workspace import Workspace
+
+DEVICE = torch.get_default_device()
+
+
+@dataclass
+class SeqB:
+    """Stratified B-matrix products with a per-block cache
+
+    The L time slices are grouped into blocks of n_orth consecutive slices.
+    The product B_{end} ... B_{start} of every block is cached and only
+    rebuilt after a flip inside that block invalidated it. The products with
+    U go through preallocated buffers.
+    """
+
+    n: int  # order of the B matrices
+    L: int  # number of time slices
+    n_orth: int  # number of safe multiplications (slices per block)
+    B: DenseB | MatB  # B matrix engine, applies B_l = diag(V[l]) B
+    device: torch.device = DEVICE
+    batch_shape: tuple[int, ...] = ()  # leading walker dimensions of V, U, D, T
+    dtype: torch.dtype | None = None  # of the cached block products (None = default dtype)
+    workspace: Workspace | None = None  # scratch of the orthogonalizations (None = own workspace)
+
+    def __post_init__(self):
+        if self.n_orth < 1:
+            raise ValueError("n_orth must be positive")
+
+        self.nblocks = (self.L + self.n_orth - 1) // self.n_orth
+        if self.workspace is None:
+            self.workspace = Workspace(self.n, device=self.device, batch_shape=self.batch_shape)
+
+        # Cached block products and their validity
+        self.blocks = torch.zeros(
+            (self.nblocks, *self.batch_shape, self.n, self.n),
+            dtype=self.dtype,
+            device=self.device,
+        )
+        self.valid = [False] * self.nblocks
+
+        # Identity, product with U and, for blocks below the default dtype, the promoted block
+        self.eye = torch.eye(self.n, device=self.device)
+        self.prod = torch.zeros((*self.batch_shape, self.n, self.n), device=self.device)
+        self.promoted = torch.zeros_like(self.prod) if self.blocks.dtype != self.prod.dtype else None
+
+        # Sign of det T of the last product, with det(B_l) > 0 it fixes the sign of det U
+        self.t_sign = torch.ones(self.batch_shape, device=self.device)
+
+    def set_dtype(self, dtype: torch.dtype) -> None:
+        """Keep the block products in dtype from now on, all are rebuilt"""
+        self.dtype = dtype
+        self.blocks = torch.zeros_like(self.blocks, dtype=dtype)
+        self.promoted = torch.zeros_like(self.prod) if dtype != self.prod.dtype else None
+        self.invalidate()
+
+    def block_range(self, ib: int) -> tuple[int, int]:
+        """First and one-past-last slice of block ib"""
+        start = ib * self.n_orth
+        return start, min(start + self.n_orth, self.L)
+
+    def invalidate(self, slice_idx: int | None = None) -> None:
+        """Invalidate the block containing slice_idx (all blocks if None)"""
+        if slice_idx is None:
+            self.valid = [False] * self.nblocks
+        else:
+            self.valid[slice_idx // self.n_orth] = False
+
+    @profiled("get_block")
+    @torch.no_grad()
+    def get_block(self, ib: int, V: torch.Tensor) -> torch.Tensor:
+        """Return the cached product of block ib, rebuilding it if stale"""
+        M = self.blocks[ib]
+        if not self.valid[ib]:
+            start, end = self.block_range(ib)
+            M.copy_(self.eye)
+            for si in range(start, end):
+                self.B.mult_left(M, V[..., si, :])
+            self.valid[ib] = True
+        return M
+
+    @profiled("multiply_B")
+    @torch.no_grad()
+    def multiply(self, il: int, V: torch.Tensor, U: torch.Tensor, D: torch.Tensor, T: torch.Tensor) -> None:
+        """Compute U D T = B_il ... B_0 B_{L-1} ... B_{il+1}
+
+        Whole blocks are taken from the cache, the slices of a partially
+        covered block are multiplied one by one. The product is
+        re-orthogonalized after every block and after every n_orth single
+        slices. U, D and T keep their dtype, blocks cached in a lower
+        precision are promoted before they are multiplied in. The sign of
+        det T is left in t_sign.
+        """
+        U.copy_(self.eye)
+        D.fill_(1.0)
+        T.copy_(self.eye)
+        self.t_sign.fill_(1.0)
+
+        si = (il + 1) % self.L
+        remaining = self.L
+        pending = 0  # slices multiplied since the last orthogonalization
+
+        while remaining > 0:
+            ib, offset = divmod(si, self.n_orth)
+            start, end = self.block_range(ib)
+
+            if offset == 0 and end - start <= remaining:
+                # Whole block from the cache
+                if pending > 0:
+                    self._orthogonalize(U, D, T)
+                    pending = 0
+                block = self.get_block(ib, V)
+                if self.promoted is not None:
+                    block = self.promoted.copy_(block)
+                U.copy_(torch.matmul(block, U, out=self.prod))
+                self._orthogonalize(U, D, T)
+                step = end - start
+            else:
+                # Single slice of a partially covered block
+                self.B.mult_left(U, V[..., si, :])
+                pending += 1
+                if pending == self.n_orth:
+                    self._orthogonalize(U, D, T)
+                    pending = 0
+                step = 1
+
+            si = (si + step) % self.L
+            remaining -= step
+
+        if pending > 0:
+            self._orthogonalize(U, D, T)
+
+    @torch.no_grad()
+    def _orthogonalize(self, U: torch.Tensor, D: torch.Tensor, T: torch.Tensor) -> None:
+        """Re-factor (U D) T with the pre-pivoted QR (DQMC_UDTD), in place through the workspace"""
+        udtd_(U, D, T, self.workspace)
+
+        # D^-1 R is unit triangular, only the column pivots change the sign of det T
+        self.t_sign.mul_(self.workspace.perm_sign)
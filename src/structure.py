@@ -1,7 +1,6 @@
 # src/structure.py
 from dataclasses import dataclass
 from enum import IntEnum
-from typing import list
 
 import torch
 
@@ -1,11 +1,21 @@
 # src/symmetry.py
 from dataclasses import dataclass
+from typing import TYPE_CHECKING
 
 import numpy as np
 import torch
 
+from config import GeomParams, parse_float
+from lattice import Lattice
+from reciprocal import ReciprocalLattice
+
+if TYPE_CHECKING:
+    from geometry import Hamiltonian
+
 DEVICE = torch.get_default_device()
 
+TOLL = GeomParams.TOLL
+
 
 @dataclass
 class SymmetryOperations:
@@ -43,30 +53,220 @@ class SymmetryOperations:
         self.add_time_rev = False
 
     @torch.no_grad()
-    def read_symmetries(self, input_file: str) -> None:
-        """Read symmetry operations from input file"""
-        # Initialize arrays
-        self.symmangle = torch.zeros(self.ntotsymm, device=self.device)
-        self.symmpoint = torch.zeros((3, self.ntotsymm), device=self.device)
-        self.symmaxis = torch.zeros((3, self.ntotsymm), device=self.device)
+    def read_symmetries(self, rows: list[list[str]]) -> None:
+        """Point symmetries from the rows of #SYMM (read_symm)
+
+        Every row is a label, C<n> or S<n> for an n-fold rotation or
+        rotoreflection, D for a mirror plane or I for an inversion centre,
+        followed by a point of the operation and, except for I, its axis
+        (the plane normal for D).
+        """
+        self.ntotsymm = self.nsymm = len(rows)
+        self.symmangle = torch.zeros(self.ntotsymm, dtype=torch.float64, device=self.device)
+        self.symmpoint = torch.zeros((3, self.ntotsymm), dtype=torch.float64, device=self.device)
+        self.symmaxis = torch.zeros((3, self.ntotsymm), dtype=torch.float64, device=self.device)
         self.symmlabel = [""] * self.ntotsymm
+        self.add_time_rev = True
+
+        for i, row in enumerate(rows):
+            label = row[0][0].upper()
+            count = 3 if label == "I" else 6
+            if label not in "CSDI" or len(row) < count + 1:
+                raise ValueError(f"Cannot read symmetry {i + 1}: {' '.join(row)}")
+            values = torch.tensor([parse_float(tok) for tok in row[1 : count + 1]], dtype=torch.float64)
+
+            self.symmlabel[i] = label
+            self.symmpoint[:, i] = values[:3]
+            if label in "CS":
+                self.symmangle[i] = 2 * np.pi / int(row[0][1:])
+            if label == "I":
+                self.add_time_rev = False
+            else:
+                self.symmaxis[:, i] = values[3:] / torch.linalg.norm(values[3:])
+
+        self.initialized = True
+
+    def transforms(self) -> tuple[torch.Tensor, torch.Tensor]:
+        """Every operation as x -> R x + b with R (ntotsymm, 3, 3) and b (ntotsymm, 3) (apply_point_symm)
+
+        R is the rotation by symmangle about the z axis, followed by the
+        reflection z -> -z for S and D, in a frame whose z axis is symmaxis;
+        it is -1 for I. The operations act about symmpoint, b = (1 - R) p.
+        """
+        n = self.ntotsymm
+        axis = self.symmaxis.t()
+        d = torch.sqrt(axis[:, 0] ** 2 + axis[:, 1] ** 2)
+        tilted = d > 1e-6
+        a1 = torch.where(tilted, axis[:, 0] / torch.where(tilted, d, 1.0), 1.0)
+        a2 = torch.where(tilted, axis[:, 1] / torch.where(tilted, d, 1.0), 0.0)
+        zero, one = torch.zeros_like(d), torch.ones_like(d)
+        cost, sint = torch.cos(self.symmangle), torch.sin(self.symmangle)
+        refl = torch.tensor([-1.0 if label in "SD" else 1.0 for label in self.symmlabel], dtype=torch.float64)
+
+        def matrix(*rows: list[torch.Tensor]) -> torch.Tensor:
+            return torch.stack([torch.stack(row, -1) for row in rows], -2)
+
+        # Frame rotations taking symmaxis to z, and the operation about z
+        rot1 = matrix([a1, a2, zero], [-a2, a1, zero], [zero, zero, one])
+        rot2 = matrix([axis[:, 2], zero, -d], [zero, one, zero], [d, zero, axis[:, 2]])
+        rot3 = matrix([cost, -sint, zero], [sint, cost, zero], [zero, zero, refl.to(self.device)])
+        frame = rot2 @ rot1
+        R = frame.transpose(1, 2) @ rot3 @ frame
+
+        inversion = torch.tensor([label == "I" for label in self.symmlabel], dtype=torch.bool, device=self.device)
+        eye = torch.eye(3, dtype=torch.float64, device=self.device).expand(n, 3, 3)
+        R = torch.where(inversion.view(-1, 1, 1), -eye, R)
+        shift = ((eye - R) @ self.symmpoint.t().unsqueeze(-1)).squeeze(-1)
+        return R, shift
+
+    @torch.no_grad()
+    def map_lattice(self, lattice: Lattice, hamiltonian: "Hamiltonian") -> None:
+        """Action of the symmetries and translations on the sites (map_symm_lattice)
+
+        All operations are applied to all sites in one batched product and
+        the images are looked up by their cell key. Symmetries that do not
+        map the supercell onto itself, or that change the hopping or the
+        interaction, are dropped; map_symm holds the remaining ones.
+        translate[i, t] is the site i moves to under translation t and
+        translback[i] the translation that brings i into the primitive cell.
+        """
+        nsites, natom = lattice.nsites, lattice.natom
+        R, shift = self.transforms()
+        newpos = R @ lattice.cartpos.to(torch.float64) + shift.unsqueeze(-1)  # (ntotsymm, 3, nsites)
+        images, found = lattice.site_index(newpos.transpose(0, 1).reshape(3, -1))
+        images = images.view(self.ntotsymm, nsites)
+        found = found.view(self.ntotsymm, nsites).all(1)
+
+        # A symmetry must permute the sites and leave the Hamiltonian unchanged
+        sites = torch.arange(nsites, device=self.device)
+        permutes = found & (torch.sort(images, 1)[0] == sites).all(1)
+        matrices = (hamiltonian.t_up, hamiltonian.t_dn, hamiltonian.U)
+        valid = [i for i in range(self.ntotsymm) if permutes[i] and all(_preserves(images[i], m) for m in matrices)]
+        self.valid_symm = torch.tensor(valid, dtype=torch.int64, device=self.device)
+        self.map_symm = images[self.valid_symm].t().contiguous()
+        self.nsymm = len(valid)
+
+        # Translations
+        self.ntransl = lattice.ncell
+        csum = lattice.cell_sum()
+        atom, cell = sites % natom, sites // natom
+        self.translate = atom.unsqueeze(1) + natom * csum[cell]
+        self.translback = torch.argmax((csum[cell] == 0).to(torch.int8), 1)
+        self.lattice_mapped = True
+
+    @torch.no_grad()
+    def map_recip_lattice(self, recip: ReciprocalLattice, lattice: Lattice, apply_twist: bool = True) -> None:
+        """Action of the symmetries on the k-points (map_symm_recip_lattice)
+
+        Time reversal k -> -k is added as a last operation unless an
+        inversion is among the valid symmetries. On the twisted grid the
+        symmetries the twist breaks are dropped from the real space tables
+        as well, a broken time reversal only from map_symm_k, which is then
+        filled; on the grid with Gamma every symmetry must hold and
+        map_symm_g is filled.
+        """
+        if not self.lattice_mapped:
+            raise ValueError("Need to map lattice symmetries before recip lattice ones")
+        if not recip.constructed:
+            raise ValueError("Reciprocal lattice must be constructed before mapping symmetries")
+
+        if not any(self.symmlabel[i] == "I" for i in self.valid_symm.tolist()):
+            self.add_time_rev = True
+        R, _ = self.transforms()
+        R = R[self.valid_symm]
+        if self.add_time_rev:
+            R = torch.cat([R, -torch.eye(3, dtype=torch.float64, device=self.device).unsqueeze(0)])
+
+        # Images of all k-points under all operations, looked up by their grid key
+        klist = recip.klist.to(self.device, torch.float64)
+        kinv = torch.linalg.inv(recip.kc.to(self.device, torch.float64))
+        keys, _ = _grid_key(kinv @ (klist - klist[0]).t(), lattice.ndim, lattice.ncell)
+        keys, order = torch.sort(keys)
+        newk = (R @ klist.t()).transpose(0, 1).reshape(3, -1)
+        newkeys, found = _grid_key(kinv @ (newk - klist[0].unsqueeze(-1)), lattice.ndim, lattice.ncell)
+        idx = torch.searchsorted(keys, newkeys).clamp(max=recip.nkpts - 1)
+        found = (found & (keys[idx] == newkeys)).view(len(R), recip.nkpts).all(1)
+        images = order[idx].view(len(R), recip.nkpts)
+
+        if not apply_twist:
+            if not found.all():
+                raise ValueError("Problem with symmetry in k-space")
+            self.map_symm_g = images.t().contiguous()
+            return
+
+        # Symmetries broken by the twist no longer count in real space either
+        keep = found[: self.nsymm]
+        if not keep.all():
+            self.map_symm = self.map_symm[:, keep].contiguous()
+            self.valid_symm = self.valid_symm[keep]
+            self.nsymm = int(keep.sum())
+        if self.add_time_rev:
+            keep = torch.cat([keep, found[-1:]])
+        self.map_symm_k = images[keep].t().contiguous()
+        self.recip_lattice_mapped = True
+
+    @torch.no_grad()
+    def map_bonds(self, origin: torch.Tensor, target: torch.Tensor) -> None:
+        """Bond every bond is mapped onto by every symmetry (map_symm_bonds)
+
+        A bond is a pair of sites with its origin in the primitive cell. The
+        images of both ends are translated back so that the origin is in the
+        primitive cell again and looked up among the bonds by their pair
+        key; every image must be one of the bonds.
+        """
+        if not self.lattice_mapped:
+            raise ValueError("Need to map lattice symmetries before bonds")
+
+        nsites = self.map_symm.shape[0]
+        origin = torch.as_tensor(origin, dtype=torch.int64, device=self.device)
+        target = torch.as_tensor(target, dtype=torch.int64, device=self.device)
+        keys, order = torch.sort(origin * nsites + target)
+
+        i, j = self.map_symm[origin], self.map_symm[target]  # (nbonds, nsymm)
+        t = self.translback[i]
+        newkeys = self.translate[i, t] * nsites + self.translate[j, t]
+        idx = torch.searchsorted(keys, newkeys).clamp(max=len(keys) - 1)
+        if not torch.equal(keys[idx], newkeys):
+            raise ValueError("Symmetry analysis: cannot find equivalent bond")
+
+        self.map_symm_b = order[idx]
+        self.bonds_mapped = True
+
+    @torch.no_grad()
+    def map_pairs(self, bond_map: torch.Tensor, pair_map: torch.Tensor) -> None:
+        """Pair every pair is mapped onto by every symmetry (map_symm_pairs)
+
+        bond_map gives the bond of every pair and pair_map the pair of every
+        bond, -1 for bonds that are not pairs.
+        """
+        if not self.bonds_mapped:
+            raise ValueError("Need to map bonds before pairs")
+
+        bond_map = torch.as_tensor(bond_map, dtype=torch.int64, device=self.device)
+        pair_map = torch.as_tensor(pair_map, dtype=torch.int64, device=self.device)
+        mapped = pair_map[self.map_symm_b[bond_map]]
+        if torch.any(mapped < 0):
+            raise ValueError("Symmetry analysis: cannot find equivalent pair")
+        self.map_symm_p = mapped
+
+
+def _preserves(perm: torch.Tensor, matrix: torch.Tensor) -> bool:
+    """Check that moving the sites of a sparse matrix by perm leaves it unchanged within 1e-3"""
+    matrix = matrix.coalesce()
+    image = torch.sparse_coo_tensor(perm[matrix.indices()], matrix.values(), matrix.shape).coalesce()
+    diff = (image - matrix).coalesce().values()
+    return diff.numel() == 0 or float(diff.abs().max()) < 1e-3
+
+
+def _grid_key(frac: torch.Tensor, ndim: int, n: int) -> tuple[torch.Tensor, torch.Tensor]:
+    """Integer key of points whose fractional coordinates (3, m) lie on a grid of spacing 1 / n
 
-        # Read symmetry operations
-        with open(input_file) as f:
-            for i in range(self.ntotsymm):
-                line = f.readline().split()
-                label = line[0]
-                self.symmlabel[i] = label[0]
-
-                if label[0] in ["C", "S"]:  # Rotation/rotoreflection
-                    axis_order = int(label[1:])
-                    self.symmangle[i] = 2 * np.pi / axis_order
-                    self.symmpoint[:, i] = torch.tensor([float(x) for x in line[1:4]], device=self.device)
-                    self.symmaxis[:, i] = torch.tensor([float(x) for x in line[4:7]], device=self.device)
-
-                elif label[0] == "D":  # Mirror plane
-                    self.symmpoint[:, i] = torch.tensor([float(x) for x in line[1:4]], device=self.device)
-                    self.symmaxis[:, i] = torch.tensor([float(x) for x in line[4:7]], device=self.device)
-
-                elif label[0] == "I":  # Inversion
-                    self.symmpoint[:, i] = torch.tensor([float(x) for x in line[1:4]], device=self.device)
+    The extended coordinates are reduced modulo 1; the others must vanish.
+    Also returns whether the points are on the grid.
+    """
+    ext = frac[:ndim] * n
+    digits = torch.round(ext)
+    valid = (torch.abs(ext - digits) < TOLL * n).all(0) & (torch.abs(frac[ndim:]) < TOLL).all(0)
+    digits = digits.to(torch.int64) % n
+    radix = n ** torch.arange(ndim, device=frac.device)
+    return (digits * radix.unsqueeze(-1)).sum(0), valid
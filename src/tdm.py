@@ -3,8 +3,13 @@ from dataclasses import dataclass
 
 import torch
 
+from utils import sign_jackknife
+
 DEVICE = torch.get_default_device()
 
+# Properties of TimeDependentMeasurements.values, the conductivity would need the bond currents
+TDM_PROPERTIES = ("gfun", "gfun_up", "gfun_dn", "spxx", "spzz", "dens", "pair")
+
 
 @dataclass
 class TimeDependentMeasurements:
@@ -14,18 +19,25 @@ class TimeDependentMeasurements:
     ntau: int  # number of time slices
     nbins: int  # number of measurement bins
     nclass: int  # number of correlation classes
+    myclass: torch.Tensor  # distance class of every site pair (nsites, nsites)
     device: torch.device = DEVICE
 
     def __post_init__(self):
-        # Initialize measurement arrays
-        self.gfun = torch.zeros((self.nclass, self.ntau + 1, self.nbins + 2), device=self.device)
-        self.gfun_up = torch.zeros_like(self.gfun)
-        self.gfun_dn = torch.zeros_like(self.gfun)
-        self.spxx = torch.zeros_like(self.gfun)
-        self.spzz = torch.zeros_like(self.gfun)
-        self.dens = torch.zeros_like(self.gfun)
-        self.pair = torch.zeros_like(self.gfun)
-        self.cond = torch.zeros_like(self.gfun)
+        # Initialize measurement arrays, views of one (property, class, tau, bin) tensor
+        self.values = torch.zeros((len(TDM_PROPERTIES), self.nclass, self.ntau + 1, self.nbins + 2), device=self.device)
+        self.gfun = self.values[0]
+        self.gfun_up = self.values[1]
+        self.gfun_dn = self.values[2]
+        self.spxx = self.values[3]
+        self.spzz = self.values[4]
+        self.dens = self.values[5]
+        self.pair = self.values[6]
+        self.sgn = torch.zeros(self.nbins, device=self.device)  # sign sum of every bin
+
+        # Scatter index and class normalization of every site pair
+        self.pair_class = self.myclass.to(self.device, torch.int64).flatten()
+        class_size = torch.bincount(self.pair_class, minlength=self.nclass)
+        self.pair_weight = 1.0 / class_size[self.pair_class]
 
         # Working arrays
         self.work = torch.zeros((self.nclass, self.ntau + 1), device=self.device)
@@ -35,16 +47,96 @@ class TimeDependentMeasurements:
         self.labels = [""] * self.nclass
 
     @torch.no_grad()
-    def measure_tdm(self, gtau_up: torch.Tensor, gtau_dn: torch.Tensor, sign: float, bin_idx: int) -> None:
-        """Perform time-dependent measurements"""
-        # Single-particle Green's functions
-        self.gfun_up[..., bin_idx] += sign * gtau_up
-        self.gfun_dn[..., bin_idx] += sign * gtau_dn
-        self.gfun[..., bin_idx] += sign * (gtau_up + gtau_dn) / 2
-
-        # Spin correlations
-        self.spxx[..., bin_idx] += sign * (gtau_up * gtau_dn)
-        self.spzz[..., bin_idx] += sign * (gtau_up - gtau_dn) * (gtau_up - gtau_dn) / 4
-
-        # Density correlations
-        self.dens[..., bin_idx] += sign * (gtau_up + gtau_dn) * (gtau_up + gtau_dn) / 4
+    def measure_tdm(
+        self,
+        upt0: torch.Tensor,
+        up0t: torch.Tensor,
+        uptt: torch.Tensor,
+        dnt0: torch.Tensor,
+        dn0t: torch.Tensor,
+        dntt: torch.Tensor,
+        sign: float | torch.Tensor,
+        bin_idx: int,
+    ) -> None:
+        """Perform time-dependent measurements (DQMC_TDM1_Compute)
+
+        G(tau, 0), G(0, tau) and G(tau, tau) of all ntau slices come as
+        (..., ntau, n, n) tensors, see GTau.make_gtau. Every slice adds to
+        tau and, through G(0, tau), to beta - tau, so tau = 0 also fills
+        the beta slot. The slices are reduced onto the classes one at a
+        time, keeping the temporaries at the size of one G per property.
+        """
+        L = self.ntau
+        batch = upt0.shape[:-3]
+        sign = torch.as_tensor(sign, dtype=upt0.dtype, device=upt0.device).expand(batch).reshape(1, -1)
+        pair_weight = self.pair_weight.view(self.nsites, self.nsites)
+        nprop = len(TDM_PROPERTIES)
+        bins = self.values[..., bin_idx]
+
+        # Diagonal of G(0, 0)
+        d00_up = torch.diagonal(uptt[..., 0, :, :], 0, -2, -1).unsqueeze(-2)
+        d00_dn = torch.diagonal(dntt[..., 0, :, :], 0, -2, -1).unsqueeze(-2)
+
+        for tau in range(L):
+            # Weights of tau = 0 and of the symmetrized tau > 0
+            f = 0.5 if tau == 0 else 0.25
+            h = 2 * f
+
+            upt0_l, dnt0_l = upt0[..., tau, :, :], dnt0[..., tau, :, :]
+            up0t_l, dn0t_l = up0t[..., tau, :, :], dn0t[..., tau, :, :]
+            dtt_up = torch.diagonal(uptt[..., tau, :, :], 0, -2, -1).unsqueeze(-1)
+            dtt_dn = torch.diagonal(dntt[..., tau, :, :], 0, -2, -1).unsqueeze(-1)
+
+            # Contributions to tau
+            up0t_T = up0t_l.transpose(-2, -1)
+            dn0t_T = dn0t_l.transpose(-2, -1)
+            same = up0t_T * upt0_l + dn0t_T * dnt0_l
+            value1 = [
+                f * (upt0_l + dnt0_l),
+                2 * f * upt0_l,
+                2 * f * dnt0_l,
+                -h * (up0t_T * dnt0_l + dn0t_T * upt0_l),
+                -h * (same - (dtt_up - dtt_dn) * (d00_up - d00_dn)),
+                -h * (same - (dtt_up + dtt_dn) * (d00_up + d00_dn) - 2 * (2 - dtt_up - d00_up - dtt_dn - d00_dn)),
+                h * (upt0_l * dnt0_l + dn0t_T * up0t_T),
+            ]
+
+            # Contributions to beta - tau, the transposes of the above except for G
+            value2 = [
+                -f * (up0t_l + dn0t_l),
+                -2 * f * up0t_l,
+                -2 * f * dn0t_l,
+                *(v.transpose(-2, -1) for v in value1[3:]),
+            ]
+
+            # Sign weighted sum over walkers, then one reduction onto the classes
+            values = torch.stack([*value1, *value2], dim=-3) * pair_weight
+            values = torch.matmul(sign, values.reshape(sign.shape[-1], -1)).view(2, nprop, -1)
+            bins[:, :, tau].index_add_(1, self.pair_class, values[0])
+            bins[:, :, L - tau].index_add_(1, self.pair_class, values[1])
+
+        self.sgn[bin_idx] += sign.sum()
+
+    def bin_shapes(self) -> dict[str, tuple[int, ...]]:
+        """Shapes of the blocks of one bin, see BinStore"""
+        return {"values": (len(TDM_PROPERTIES), self.nclass, self.ntau + 1), "sgn": (1,)}
+
+    def bin_record(self, bin_idx: int) -> dict[str, torch.Tensor]:
+        """Views of one bin, keyed as bin_shapes"""
+        return {"values": self.values[..., bin_idx], "sgn": self.sgn[bin_idx : bin_idx + 1]}
+
+    def reset_bin(self, bin_idx: int) -> None:
+        """Clear one bin for reuse"""
+        for value in self.bin_record(bin_idx).values():
+            value.zero_()
+
+    def bin_data(self) -> list[torch.Tensor]:
+        """Per-bin sums to be combined across processes, see BinAggregator"""
+        return [self.values[..., : self.nbins], self.sgn]
+
+    @torch.no_grad()
+    def get_err(self) -> None:
+        """Fill the average and error bins by sign jackknife over the bins (DQMC_TDM1_GetErr)"""
+        avg, err = sign_jackknife(self.values[..., : self.nbins], self.sgn.expand(*self.values.shape[:-1], -1))
+        self.values[..., self.nbins] = avg
+        self.values[..., self.nbins + 1] = err
@@ -0,0 +1,124 @@
+# src/tempering.py
+import dataclasses
+import math
+
+import torch
+import torch.distributed as dist
+
+from config import DQMCConfig
+from dqmc import DQMC
+from hsf import pack_hsf, unpack_hsf
+from parallel import Channel, ParallelQMC
+
+LADDER_PARAMS = ("U", "beta")
+
+
+class ReplicaExchange:
+    """Parallel tempering with one DQMC replica per rank
+
+    Rank r simulates ladder[r] of U or beta. Every n_swap sweeps neighbouring
+    replicas, (0, 1), (2, 3), ... and (1, 2), (3, 4), ... in turn, propose to
+    swap their HSF configurations. Only the bit-packed HSF and the log-weights
+    log |det M_up det M_dn| travel between the ranks; both partners draw the
+    same random number from a generator seeded by the attempt, so they take
+    the same decision without another message.
+    """
+
+    def __init__(
+        self,
+        config: DQMCConfig,
+        ladder: list[float],
+        param: str = "U",
+        pqmc: ParallelQMC | None = None,
+        n_swap: int = 1,
+        seed: int = 0,
+    ):
+        if param not in LADDER_PARAMS:
+            raise ValueError(f"Unknown ladder parameter {param}, expected one of {', '.join(LADDER_PARAMS)}")
+
+        self.pqmc = pqmc if pqmc is not None else ParallelQMC.init()
+        if len(ladder) != self.pqmc.temp_size:
+            raise ValueError(f"Ladder has {len(ladder)} values for {self.pqmc.temp_size} ranks")
+
+        self.ladder = ladder
+        self.param = param
+        self.n_swap = n_swap
+        self.seed = seed
+        self.rank = self.pqmc.temp_rank
+        self.group = self.pqmc.comm(Channel.TEMP)
+
+        # Replica of this rank
+        value = ladder[self.rank]
+        if param == "U":
+            self.config = dataclasses.replace(config, U=value)
+        else:
+            self.config = dataclasses.replace(config, dt=value / config.n_slices)
+        self.qmc = DQMC(self.config)
+
+        # Swap statistics with the upper neighbour
+        self.attempted = 0
+        self.accepted = 0
+        self.n_attempts = 0
+
+    def partner(self) -> int | None:
+        """Neighbour of this rank in the current swap round, None if it sits out"""
+        offset = self.n_attempts % 2
+        peer = self.rank + 1 if (self.rank - offset) % 2 == 0 else self.rank - 1
+        return peer if 0 <= peer < len(self.ladder) else None
+
+    def _exchange(self, send: torch.Tensor, peer: int) -> torch.Tensor:
+        """Send a tensor to peer and receive its counterpart"""
+        recv = torch.empty_like(send)
+        ops = [
+            dist.P2POp(dist.isend, send, peer, self.group),
+            dist.P2POp(dist.irecv, recv, peer, self.group),
+        ]
+        for req in dist.batch_isend_irecv(ops):
+            req.wait()
+        return recv
+
+    @torch.no_grad()
+    def swap(self) -> bool:
+        """Propose a configuration swap with the partner of this round"""
+        peer = self.partner()
+        self.n_attempts += 1
+        if peer is None:
+            return False
+
+        # Configurations and log-weights of both replicas in both configurations
+        hsf = self.qmc.hsf
+        hsf_peer = unpack_hsf(self._exchange(pack_hsf(hsf), peer), hsf.shape).to(hsf.device)
+        logw = torch.tensor([float(self.qmc.log_weight()), float(self.qmc.log_weight(hsf_peer))], dtype=torch.float64)
+        logw_peer = self._exchange(logw, peer)
+
+        # W_a(h_b) W_b(h_a) / (W_a(h_a) W_b(h_b)) is symmetric in the partners
+        delta = float(logw[1] + logw_peer[1] - logw[0] - logw_peer[0])
+        generator = torch.Generator().manual_seed(self.seed + self.n_attempts * len(self.ladder) + min(self.rank, peer))
+        accept = float(torch.rand(1, generator=generator, dtype=torch.float64)) < math.exp(min(delta, 0.0))
+
+        if peer > self.rank:
+            self.attempted += 1
+            self.accepted += accept
+
+        if accept:
+            self.qmc.set_hsf(hsf_peer)
+        return accept
+
+    def run(self, n_sweeps: int, measure: bool = True) -> None:
+        """Sweep the replica, proposing a swap every n_swap sweeps"""
+        for isweep in range(1, n_sweeps + 1):
+            self.qmc.sweep(measure=measure)
+            if isweep % self.n_swap == 0:
+                self.swap()
+
+    def acceptance_rates(self) -> torch.Tensor:
+        """Swap acceptance rate of every neighbouring pair, gathered on all ranks"""
+        rates = torch.zeros(len(self.ladder) - 1, dtype=torch.float64)
+        if self.rank < len(self.ladder) - 1:
+            rates[self.rank] = self.accepted / max(self.attempted, 1)
+        dist.all_reduce(rates, group=self.group)
+        return rates
+
+    def is_root(self) -> bool:
+        """Check if this rank reports for the ladder"""
+        return self.pqmc.is_root(Channel.TEMP)
@@ -4,3 +4,25 @@ import torch
 def get_default_device() -> torch.device:
     """Get default device (CUDA if available, else CPU)"""
     return torch.device("cuda" if torch.cuda.is_available() else "cpu")
+
+
+def sign_jackknife(x: torch.Tensor, sgn: torch.Tensor) -> tuple[torch.Tensor, torch.Tensor]:
+    """Average and jackknife error of sign weighted bins (DQMC_SignJackKnife)
+
+    x holds the sign weighted sums and sgn the sign sums (or sample counts)
+    of every bin along the last dimension. The average is sum(x) / sum(sgn),
+    bin i is left out by (sum(x) - x_i) / (sum(sgn) - sgn_i).
+    """
+    nbins = x.shape[-1]
+    sum_x = x.sum(-1, keepdim=True)
+    sum_sgn = sgn.sum(-1, keepdim=True)
+    avg = (sum_x / sum_sgn).squeeze(-1)
+    if nbins < 2:
+        return avg, torch.zeros_like(avg)
+
+    y = (sum_x - x) / (sum_sgn - sgn)
+    err = torch.sqrt(torch.sum((y - y.mean(-1, keepdim=True)) ** 2, -1) * (nbins - 1) / nbins)
+
+    # Round-off noise of a constant observable
+    err = torch.where(err < 1e-12 * avg.abs(), torch.zeros_like(err), err)
+    return avg, err
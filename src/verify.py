@@ -0,0 +1,141 @@
+# src/verify.py
+import argparse
+import dataclasses
+import itertools
+import math
+import sys
+from dataclasses import dataclass
+
+import torch
+
+from config import DQMCConfig
+from dqmc import PRECISIONS
+from gtau import TAU_UP
+from measurements import Observable
+from walkers import BatchedDQMC
+
+# Parameter grid of verify.F90 on a 4x4 periodic lattice
+NX, NY = 4, 4
+DTAU = 0.125
+N_SLICES = 12
+T_VALUES = (0.3, 0.6, 1.0)
+U_VALUES = (1.0, 2.0, 4.0, 0.0, -1.0, -2.0)
+MU_VALUES = (0.5, 0.0, -0.5)
+
+
+@dataclass
+class Check:
+    """One observable of one parameter set against its exact value"""
+
+    t: float
+    U: float
+    mu: float
+    observable: Observable
+    exact: float
+    avg: float
+    err: float
+
+    @property
+    def deviation(self) -> float:
+        """Distance from the exact value in error bars, inf for a wrong zero-error result"""
+        diff = abs(self.avg - self.exact)
+        if self.err > 0:
+            return diff / self.err
+        return 0.0 if diff <= 1e-10 else math.inf
+
+
+def single_site_exact(U: float, mu: float, beta: float) -> dict[Observable, float]:
+    """Density and energies of an isolated site, U (n_up - 1/2) (n_dn - 1/2) - mu n"""
+    single = math.exp((U / 2 + mu) * beta)
+    double = math.exp(2 * mu * beta)
+    z = 1 + 2 * single + double
+    rho = 2 * (single + double) / z
+    pot = U * (double / z - rho / 2 + 0.25)
+    return {Observable.DENSITY: rho, Observable.POT_ENERGY: pot, Observable.TOT_ENERGY: pot - mu * rho}
+
+
+@torch.no_grad()
+def free_exact(qmc: BatchedDQMC) -> dict[Observable, float]:
+    """Density and energy at U = 0 from the free G0 = (1 + B^L)^-1 of GTau.get_g0"""
+    G0 = qmc.gtau.get_g0(0, spin=TAU_UP)
+    n_site = 1 - torch.diagonal(G0)
+    hop = 2 * torch.sum(-qmc.hopping * G0)
+    rho = 2 * n_site.sum()
+    n = qmc.config.L_sites
+    return {Observable.DENSITY: float(rho) / n, Observable.TOT_ENERGY: float(hop - qmc.config.mu * rho) / n}
+
+
+def run_point(config: DQMCConfig, n_sweeps: int, seed: int) -> BatchedDQMC:
+    """Warm up, then fill every bin with n_sweeps // n_bins sweeps and take the jackknife errors"""
+    torch.manual_seed(seed)
+    qmc = BatchedDQMC(config)
+    qmc.run(n_sweeps)
+    qmc.phy0.get_err()
+    return qmc
+
+
+def verify(n_warm: int = 100, n_sweeps: int = 400, n_walkers: int = 8, seed: int = 0, **options: object) -> list[Check]:
+    """Run the t = 0 and U = 0 grids of verify.F90 and compare with the exact results
+
+    Every parameter set is one short simulation of n_walkers chains
+    advanced together. options are passed on to DQMCConfig, so the checks
+    can be repeated with delayed updates, long wraps or another dtype.
+    """
+    params = {"n_measure": 4, "n_orth": 12, "n_delay": 12, "diff_lim": 1e-3, **options}
+    base = DQMCConfig(L_sites=NX * NY, n_slices=N_SLICES, dt=DTAU, U=0.0, n_warm=n_warm, n_walkers=n_walkers, **params)
+    beta = N_SLICES * DTAU
+
+    checks = []
+    # Case 1: single site, t = 0
+    for mu, U in itertools.product(MU_VALUES, U_VALUES):
+        qmc = run_point(dataclasses.replace(base, t=0.0, U=U, mu=mu), n_sweeps, seed)
+        for obs, exact in single_site_exact(U, mu, beta).items():
+            avg, err = qmc.phy0.scalars[obs, qmc.phy0.avg_bin], qmc.phy0.scalars[obs, qmc.phy0.err_bin]
+            checks.append(Check(0.0, U, mu, obs, exact, float(avg), float(err)))
+
+    # Case 2: no interaction, U = 0
+    for mu, t in itertools.product(MU_VALUES, T_VALUES):
+        qmc = run_point(dataclasses.replace(base, t=t, U=0.0, mu=mu), n_sweeps, seed)
+        for obs, exact in free_exact(qmc).items():
+            avg, err = qmc.phy0.scalars[obs, qmc.phy0.avg_bin], qmc.phy0.scalars[obs, qmc.phy0.err_bin]
+            checks.append(Check(t, 0.0, mu, obs, exact, float(avg), float(err)))
+    return checks
+
+
+def report(checks: list[Check], max_deviation: float) -> bool:
+    """Print every check and the error bar statistics, returns whether all passed"""
+    print(f" {'t':>5} {'U':>5} {'mu':>5} {'observable':>12} {'exact':>10} {'computed':>10} {'+-':>9} {'|T-C|/err':>9}")
+    for c in checks:
+        flag = "  FAIL" if c.deviation > max_deviation else ""
+        print(
+            f" {c.t:5.2f} {c.U:5.2f} {c.mu:5.2f} {c.observable.name:>12} {c.exact:10.6f} {c.avg:10.6f}"
+            f" {c.err:9.6f} {c.deviation:9.2f}{flag}",
+        )
+
+    within = [sum(c.deviation <= k for c in checks) / len(checks) for k in (1, 2)]
+    print(f" {100 * within[0]:6.2f}% within 1 error bar (Expected 68.3%)")
+    print(f" {100 * within[1]:6.2f}% within 2 error bars (Expected 95.4%)")
+    return all(c.deviation <= max_deviation for c in checks)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Check DQMC against the exact t = 0 and U = 0 results (verify.F90)")
+    parser.add_argument("--warm", type=int, default=100)
+    parser.add_argument("--sweeps", type=int, default=400)
+    parser.add_argument("--walkers", type=int, default=8)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--n-blk", type=int, default=0, help="delayed update block size")
+    parser.add_argument("--n-delay", type=int, default=12, help="wraps between recomputations")
+    parser.add_argument("--precision", default="double", choices=PRECISIONS, help="precision policy")
+    parser.add_argument("--max-deviation", type=float, default=4.0, help="failing distance in error bars")
+    args = parser.parse_args()
+
+    torch.set_default_dtype(torch.float64)
+    options = {"n_blk": args.n_blk, "n_delay": args.n_delay, "precision": args.precision}
+    checks = verify(args.warm, args.sweeps, args.walkers, args.seed, **options)
+    if not report(checks, args.max_deviation):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
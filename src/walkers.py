@@ -0,0 +1,46 @@
+# src/walkers.py
+
+import torch
+
+from config import DQMCConfig
+from dqmc import DQMC
+from profiler import profiled
+
+
+class BatchedDQMC(DQMC):
+    """DQMC over n_walkers independent Markov chains
+
+    hsf, V_up/V_dn and G_up/G_dn carry a leading walker dimension. Every
+    walker proposes a flip of the same (slice, site) at the same time, so the
+    Metropolis step, the delayed updates and the stabilized recomputation
+    run as batched kernels while the B matrices are shared by all walkers.
+    """
+
+    def __init__(self, config: DQMCConfig):
+        self.n_walkers = config.n_walkers
+        self.batch_shape = (config.n_walkers,)
+        super().__init__(config)
+
+    @profiled("update_slice")
+    def _update_slice(self, slice_idx: int, U: torch.Tensor, D: torch.Tensor, T: torch.Tensor) -> None:
+        """Update HSF fields of all walkers for a given time slice"""
+        if self.update_kernel is not None:
+            # The slice kernel takes the walker dimension as a batch dimension
+            self._update_slice_fast(slice_idx)
+            return
+
+        for site in range(self.config.L_sites):
+            # Compute determinant ratios of every walker
+            alpha_up, r_up, alpha_dn, r_dn, ratio = self._compute_ratios(slice_idx, site)
+
+            # Accept/reject update per walker
+            accept = torch.rand(self.n_walkers, device=self.device) < torch.clamp(torch.abs(ratio), max=1.0)
+            self._update_greens(slice_idx, site, alpha_up, r_up, alpha_dn, r_dn, accept)
+
+        # Flush the delayed updates still pending
+        self.gf_up.apply_update(forced=True)
+        self.gf_dn.apply_update(forced=True)
+
+        # Flips of any walker make the cached block product stale
+        self.seqb_up.invalidate(slice_idx)
+        self.seqb_dn.invalidate(slice_idx)
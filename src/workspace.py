@@ -21,22 +21,58 @@ class Workspace:
 
     n: int  # matrix dimension
     device: torch.device = DEVICE
+    batch_shape: tuple[int, ...] = ()  # leading walker dimensions
+    dtype: torch.dtype | None = None  # of R3 and R4, the copies of G (None = default dtype)
 
     def __post_init__(self):
+        b = self.batch_shape
+
         # Real matrices
-        self.R1 = torch.zeros((self.n, self.n), device=self.device)
-        self.R2 = torch.zeros((self.n, self.n), device=self.device)
-        self.R3 = torch.zeros((self.n, self.n), device=self.device)
-        self.R4 = torch.zeros((self.n, self.n), device=self.device)
-        self.R8 = torch.zeros((self.n, self.n), device=self.device)
+        self.R1 = torch.zeros((*b, self.n, self.n), device=self.device)
+        self.R2 = torch.zeros((*b, self.n, self.n), device=self.device)
+        self.R3 = torch.zeros((*b, self.n, self.n), dtype=self.dtype, device=self.device)
+        self.R4 = torch.zeros((*b, self.n, self.n), dtype=self.dtype, device=self.device)
+        self.R8 = torch.zeros((*b, self.n, self.n), device=self.device)
 
         # Real vectors
-        self.R5 = torch.zeros(self.n, device=self.device)
-        self.R6 = torch.zeros(self.n, device=self.device)
+        self.R5 = torch.zeros((*b, self.n), device=self.device)
+        self.R6 = torch.zeros((*b, self.n), device=self.device)
 
         # Integer arrays
-        self.I1 = torch.zeros(self.n, dtype=torch.int64, device=self.device)
-        self.I2 = torch.zeros(self.n, dtype=torch.int64, device=self.device)
+        self.I1 = torch.zeros((*b, self.n), dtype=torch.int64, device=self.device)
+        self.I2 = torch.zeros((*b, self.n), dtype=torch.int64, device=self.device)
+
+        # Scratch of udtd_ and of the recomputation of G
+        self.R9 = torch.zeros((*b, self.n, self.n), device=self.device)
+        self.R10 = torch.zeros((*b, self.n, self.n), device=self.device)
+
+        # Identity, mask, LU pivots and status of the recomputation of G and of the signs
+        self.eye = torch.eye(self.n, device=self.device)
+        self.mask = torch.zeros((*b, self.n), dtype=torch.bool, device=self.device)
+        self.piv = torch.zeros((*b, self.n), dtype=torch.int32, device=self.device)
+        self.info = torch.zeros(b, dtype=torch.int32, device=self.device)
+        self.rows = torch.arange(1, self.n + 1, dtype=torch.int32, device=self.device)  # pivots of no swap
+        self.one = torch.ones((), device=self.device)
+        self.sgn = torch.zeros(b, device=self.device)
+
+        # Factors as LAPACK stores them, column-major: Householder vectors and Q of the
+        # pre-pivoted QR, LU of the recomputation and its row permutation
+        self.QR = torch.zeros((*b, self.n, self.n), device=self.device).mT
+        self.Q = torch.zeros((*b, self.n, self.n), device=self.device).mT
+        self.LU = torch.zeros((*b, self.n, self.n), device=self.device).mT
+        self.P = torch.zeros((*b, self.n, self.n), device=self.device)
+        self.no_data = torch.zeros(0, device=self.device)  # L and U outputs of lu_unpack, not unpacked
+        self.tau = torch.zeros((*b, self.n), device=self.device)
+
+        # Column norms and pivots of the QR, pairwise signs of the pivots and the permutation sign
+        self.norms = torch.zeros((*b, self.n), device=self.device)
+        self.sorted_norms = torch.zeros((*b, self.n), device=self.device)
+        self.pairs = torch.zeros((*b, self.n, self.n), device=self.device)
+        self.lower = torch.ones((self.n, self.n), dtype=torch.bool, device=self.device).tril()
+        self.perm_sign = torch.zeros(b, device=self.device)
+
+        # Largest differences of the wrapped and the recomputed G of both spins
+        self.diff = torch.zeros(2, dtype=self.dtype, device=self.device)
 
         # LAPACK workspace sizes
         self.lwork = torch.zeros(len(LapackOp), dtype=torch.int64, device=self.device)
@@ -46,6 +82,13 @@ class Workspace:
         max_work = self.lwork.max().item()
         self.R7 = torch.zeros(max_work, device=self.device)
 
+    def set_dtype(self, dtype: torch.dtype) -> None:
+        """Reallocate the copies of G and their differences in dtype"""
+        self.dtype = dtype
+        self.R3 = torch.zeros_like(self.R3, dtype=dtype)
+        self.R4 = torch.zeros_like(self.R4, dtype=dtype)
+        self.diff = torch.zeros_like(self.diff, dtype=dtype)
+
     def _compute_workspace_sizes(self) -> None:
         """Compute optimal workspace sizes for LAPACK operations"""
         n = self.n
@@ -0,0 +1,20 @@
+import sys
+from pathlib import Path
+
+import pytest
+import torch
+
+ROOT = Path(__file__).resolve().parents[1]
+sys.path.insert(0, str(ROOT / "src"))
+sys.path.insert(0, str(ROOT / "benchmarks"))
+
+GEOMETRIES = ROOT / "geometries"
+
+
+@pytest.fixture(autouse=True)
+def float64():
+    """The drivers run in float64, so do the tests"""
+    dtype = torch.get_default_dtype()
+    torch.set_default_dtype(torch.float64)
+    yield
+    torch.set_default_dtype(dtype)
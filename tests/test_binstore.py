@@ -0,0 +1,31 @@
+import numpy as np
+import torch
+from binstore import BinStore, load_bins
+
+
+def test_append_continue_and_truncate(tmp_path):
+    path = tmp_path / "bins.qb"
+    blocks = {"scalars": (3,), "values": (2, 4)}
+    records = [{"scalars": torch.full((3,), float(i)), "values": torch.full((2, 4), -float(i))} for i in range(4)]
+
+    store = BinStore(path, blocks, meta={"labels": ["a", "b"], "k": torch.arange(2)})
+    for i, record in enumerate(records[:2]):
+        assert store.append(record) == i
+
+    # A restarted run continues the file, a partly written record is dropped
+    with path.open("ab") as f:
+        f.write(b"\0" * 8)
+    store = BinStore(path, blocks, meta={"labels": ["a", "b"], "k": torch.arange(2)})
+    assert store.n_bins == 2
+    for record in records[2:]:
+        store.append(record)
+
+    header, data = load_bins(path)
+    assert header["labels"] == ["a", "b"]
+    assert header["k"] == [0, 1]
+    np.testing.assert_array_equal(data["scalars"][:, 0], [0, 1, 2, 3])
+    np.testing.assert_array_equal(data["values"][:, 1, 3], [0, -1, -2, -3])
+
+    store.truncate(1)
+    _, data = load_bins(path)
+    assert data["scalars"].shape == (1, 3)
@@ -0,0 +1,84 @@
+import pytest
+import torch
+from checkerboard import CheckerBoard, MatB, color_bonds
+from config import DQMCConfig
+from conftest import GEOMETRIES
+from dqmc import DQMC
+from geometry import GeometryWrapper
+
+
+def hopping_matrix(name, size):
+    geometry = GeometryWrapper({"device": torch.device("cpu"), "supercell": size})
+    geometry.init_from_file(GEOMETRIES / f"{name}.geom")
+    return -geometry.hamiltonian.t_up.to_dense().real
+
+
+@pytest.mark.parametrize(("name", "size"), [("square", 6), ("honeycomb", 3), ("cubic", 4)])
+def test_colouring_is_a_matching_per_colour(name, size):
+    K = hopping_matrix(name, size)
+    i, j = torch.nonzero(torch.triu(K, diagonal=1), as_tuple=True)
+    color = color_bonds(K.shape[0], i, j)
+    assert (color >= 0).all()
+    for c in range(int(color.max()) + 1):
+        sites = torch.cat([i[color == c], j[color == c]])
+        assert sites.unique().numel() == sites.numel()
+
+
+@pytest.mark.parametrize("batch_shape", [(), (2,)])
+def test_rotations_match_the_dense_product(batch_shape):
+    """B_l = diag(exptaumu V_l) P_c ... P_1 P_1 ... P_c and its inverse, applied from both sides"""
+    torch.manual_seed(0)
+    K = hopping_matrix("honeycomb", 3)
+    n = K.shape[0]
+    matb = CheckerBoard({"device": torch.device("cpu")}).init_B_from_hopping(K, 0.3, 0.1)
+
+    # Dense P = P_c ... P_1 from the bonds of every colour
+    P = torch.eye(n)
+    i, j, h = matb.A
+    for c in range(int(matb.color.max()) + 1):
+        sel = matb.color == c
+        R = torch.eye(n)
+        R[i[sel], i[sel]] = R[j[sel], j[sel]] = matb.cosht[h[sel]]
+        R[i[sel], j[sel]] = R[j[sel], i[sel]] = matb.sinht[h[sel]]
+        P = R @ P
+    v = torch.rand(n) + 0.5
+    B = torch.diag(matb.exptaumu * v) @ P @ P.T
+    Bi = torch.linalg.inv(B)
+
+    M = torch.randn((*batch_shape, n, n))
+    for method, expected in (
+        ("mult_left", B @ M),
+        ("mult_right", M @ B),
+        ("mult_left_inv", Bi @ M),
+        ("mult_right_inv", M @ Bi),
+    ):
+        X = M.clone()
+        getattr(matb, method)(X, v)
+        torch.testing.assert_close(X, expected)
+
+    # Close to the exact exponential up to the Trotter error
+    torch.testing.assert_close(B, torch.diag(v) @ torch.matrix_exp(-0.1 * (K - 0.3 * torch.eye(n))), atol=1e-3, rtol=0)
+
+
+@pytest.mark.parametrize("backend", ["python", "eager"])
+def test_sweep_with_either_engine_gives_the_same_greens(backend):
+    """The checkerboard B of the square lattice is its exponential up to the splitting error"""
+    runs = []
+    for b_engine in ("dense", "checkerboard"):
+        torch.manual_seed(3)
+        config = DQMCConfig(
+            L_sites=16, n_slices=8, dt=0.125, U=4.0, mu=0.3, n_orth=4, b_engine=b_engine, update_backend=backend
+        )
+        qmc = DQMC(config)
+        qmc.sweep(measure=False)
+        runs.append(qmc)
+
+    dense, ckb = runs
+    assert isinstance(ckb.matb_up, MatB)
+    torch.testing.assert_close(ckb.B_up, dense.B_up, atol=1e-10, rtol=0)
+    assert torch.equal(ckb.hsf, dense.hsf)
+    torch.testing.assert_close(ckb.G_up, dense.G_up, atol=1e-10, rtol=0)
+    torch.testing.assert_close(ckb.G_dn, dense.G_dn, atol=1e-10, rtol=0)
+
+    with pytest.raises(ValueError, match="B engine"):
+        DQMC(DQMCConfig(L_sites=16, n_slices=8, dt=0.125, U=4.0, b_engine="sparse"))
@@ -0,0 +1,72 @@
+import dataclasses
+
+import pytest
+import torch
+from checkpoint import load_checkpoint, save_checkpoint
+from config import DQMCConfig
+from dqmc import DQMC
+
+
+def test_mixed_fallback_is_restored(tmp_path):
+    config = DQMCConfig(L_sites=16, n_slices=8, dt=0.125, U=4.0, n_orth=4, precision="mixed")
+    qmc = DQMC(config)
+    qmc.sweep(measure=True)
+    qmc.leave_mixed()
+    save_checkpoint(qmc, tmp_path / "run.ckpt")
+
+    restored = DQMC(config)
+    assert restored.mixed
+    load_checkpoint(restored, tmp_path / "run.ckpt")
+    assert not restored.mixed
+    assert restored.G_up.dtype == torch.float64
+    assert torch.equal(restored.hsf, qmc.hsf)
+    restored.sweep(measure=True)
+
+
+CONFIG = DQMCConfig(L_sites=16, n_slices=8, dt=0.125, U=4.0, mu=0.3, n_orth=4, n_measure=4, n_bins=4, n_delay=3)
+
+
+def advance(qmc, n_sweeps):
+    """Measured sweeps, a bin is closed after every second one"""
+    for _ in range(n_sweeps):
+        qmc.sweep(measure=True)
+        if qmc.n_sweeps % 2 == 0:
+            qmc.end_bin()
+
+
+def test_restart_continues_the_chain(tmp_path):
+    """N sweeps, a restart and M more sweeps give the HSF, RNG and bin counters of N + M sweeps"""
+    n, m = 3, 4
+    torch.manual_seed(7)
+    straight = DQMC(dataclasses.replace(CONFIG))
+    advance(straight, n + m)
+    rng = torch.get_rng_state()
+
+    torch.manual_seed(7)
+    first = DQMC(dataclasses.replace(CONFIG))
+    advance(first, n)
+    save_checkpoint(first, tmp_path / "run.ckpt")
+    torch.manual_seed(123)  # the restarted job starts from another generator state
+    restarted = DQMC(dataclasses.replace(CONFIG))
+    load_checkpoint(restarted, tmp_path / "run.ckpt")
+    advance(restarted, m)
+
+    assert torch.equal(restarted.hsf, straight.hsf)
+    assert torch.equal(torch.get_rng_state(), rng)
+    assert restarted.n_sweeps == straight.n_sweeps == n + m
+    assert restarted.config.current_bin == straight.config.current_bin
+    assert restarted.phy0.measurements == straight.phy0.measurements
+    for t, expected in zip(restarted.phy0.bin_data(), straight.phy0.bin_data(), strict=True):
+        torch.testing.assert_close(t, expected)
+
+
+def test_checkpoint_of_another_hamiltonian_is_rejected(tmp_path):
+    qmc = DQMC(dataclasses.replace(CONFIG))
+    qmc.sweep(measure=False)
+    save_checkpoint(qmc, tmp_path / "run.ckpt")
+
+    other = DQMC(dataclasses.replace(CONFIG, U=5.0))
+    hsf = other.hsf.clone()
+    with pytest.raises(ValueError, match="different Hamiltonian"):
+        load_checkpoint(other, tmp_path / "run.ckpt")
+    assert torch.equal(other.hsf, hsf)
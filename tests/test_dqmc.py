@@ -0,0 +1,170 @@
+import math
+
+import pytest
+import torch
+from bench_suite import allocations_per_sweep
+from config import DQMCConfig
+from dqmc import DQMC
+from green import NOREDO_F, REDO_F, GreenFunction
+from measurements import Observable
+from walkers import BatchedDQMC
+
+
+@pytest.mark.parametrize("U", [4.0, -4.0])
+def test_flip_ratio_matches_weight(U):
+    """The Metropolis ratio of one flip is the change of the full weight"""
+    torch.manual_seed(1)
+    config = DQMCConfig(L_sites=16, n_slices=8, dt=0.125, U=U, mu=0.3, n_warm=0, n_orth=4)
+    qmc = DQMC(config)
+    assert math.cosh(qmc.coupling) == pytest.approx(math.exp(config.dt * abs(U) / 2))
+
+    slice_idx, site = 3, 5
+    qmc._get_greens(slice_idx, qmc.workspace.R1, qmc.workspace.R5, qmc.workspace.R2)
+    *_, ratio = qmc._compute_ratios(slice_idx, site)
+
+    hsf = qmc.hsf.clone()
+    flipped = hsf.clone()
+    flipped[slice_idx, site] *= -1
+    log_ratio = qmc.log_weight(flipped) - qmc.log_weight(hsf)
+    assert float(log_ratio) == pytest.approx(math.log(abs(float(ratio))), abs=1e-8)
+
+
+def test_sign_carried_through_flips_matches_recomputation(monkeypatch):
+    """The signs of det G^-1 updated by the accepted ratios agree with the ones of the UDT factors"""
+    torch.manual_seed(0)
+    config = DQMCConfig(L_sites=16, n_slices=40, dt=0.125, U=6.0, mu=0.5, n_orth=5, n_delay=3, fix_wrap=True)
+    qmc = DQMC(config)
+    signs = []
+    compute_greens = qmc._compute_greens
+
+    def recompute(*args):
+        tracked = torch.stack([qmc.gf_up.sign, qmc.gf_dn.sign])
+        compute_greens(*args)
+        if qmc.n_sweeps > 0:
+            signs.append((tracked, torch.stack([qmc.gf_up.sign, qmc.gf_dn.sign])))
+
+    monkeypatch.setattr(qmc, "_compute_greens", recompute)
+    for _ in range(6):
+        qmc.sweep(measure=False)
+
+    tracked, recomputed = map(torch.stack, zip(*signs))
+    assert torch.equal(tracked, recomputed)
+    assert (recomputed < 0).any()
+
+
+def wrapping_green(**wrap_params):
+    n = 4
+    return GreenFunction(n=n, L=1, G=torch.eye(n), V=None, ilb=-1, det=0.0, sign=1.0, n_blk=1, **wrap_params)
+
+
+def test_wrap_interval_grows_until_max_wrap():
+    gf = wrapping_green(n_wrap=3, max_wrap=5, diff_lim=1e-5, err_rate=1e-3)
+    intervals = []
+    for _ in range(4):
+        for _ in range(NOREDO_F):
+            gf.record_wrap_error(0.0)
+        gf.update_wraps()
+        intervals.append(gf.n_wrap)
+
+    assert intervals == [4, 5, 5, 5]
+    assert gf.last_wrap == 5
+
+
+def test_wrap_interval_shrinks_and_caps_growth():
+    gf = wrapping_green(n_wrap=3, max_wrap=9, diff_lim=1e-5, err_rate=1e-3)
+    intervals = []
+    for _ in range(3):
+        for _ in range(REDO_F + 1):
+            gf.record_wrap_error(1.0)
+        gf.update_wraps()
+        intervals.append(gf.n_wrap)
+    assert intervals == [2, 1, 1]
+
+    # Longer intervals than the last shrunk one are not tried again
+    for _ in range(NOREDO_F):
+        gf.record_wrap_error(0.0)
+    gf.update_wraps()
+    assert gf.n_wrap == gf.max_wrap == 1
+
+    # Within diff_lim a few redos are tolerated below err_rate
+    gf = wrapping_green(n_wrap=3, max_wrap=9, diff_lim=1e-5, err_rate=0.5)
+    for _ in range(REDO_F + 1):
+        gf.record_wrap_error(1.0)
+    for _ in range(2 * REDO_F):
+        gf.record_wrap_error(0.0)
+    gf.update_wraps()
+    assert gf.n_wrap == 3
+
+
+@pytest.mark.parametrize("fix_wrap", [False, True])
+def test_sweeps_adapt_wrap_interval_unless_fixed(fix_wrap):
+    """With diff_lim = 0 every recomputation is a redo, so the interval shrinks"""
+    torch.manual_seed(4)
+    config = DQMCConfig(L_sites=16, n_slices=40, dt=0.125, U=4.0, n_orth=5, n_delay=3, diff_lim=0.0, fix_wrap=fix_wrap)
+    qmc = DQMC(config)
+    for _ in range(2):
+        qmc.sweep(measure=False)
+
+    assert qmc.gf_up.n_wrap == (3 if fix_wrap else 1)
+
+
+@pytest.mark.parametrize("backend", ["python", "eager"])
+def test_single_walker_matches_dqmc(backend):
+    """A batch of one walker draws the same random numbers and follows the same chain"""
+    runs = []
+    for cls in (DQMC, BatchedDQMC):
+        torch.manual_seed(11)
+        config = DQMCConfig(
+            L_sites=16, n_slices=8, dt=0.125, U=4.0, mu=0.3, n_orth=4, n_measure=2, tdm=True, update_backend=backend
+        )
+        qmc = cls(config)
+        for _ in range(3):
+            qmc.sweep(measure=True)
+        runs.append(qmc)
+
+    qmc, batched = runs
+    assert batched.hsf.shape == (1, *qmc.hsf.shape)
+    assert torch.equal(batched.hsf[0], qmc.hsf)
+    assert torch.equal(batched.gf_up.sign[0], qmc.gf_up.sign)
+    assert torch.equal(batched.gf_dn.sign[0], qmc.gf_dn.sign)
+    torch.testing.assert_close(batched.G_up[0], qmc.G_up, atol=1e-10, rtol=0)
+    torch.testing.assert_close(batched.G_dn[0], qmc.G_dn, atol=1e-10, rtol=0)
+    torch.testing.assert_close(batched.phy0.scalars, qmc.phy0.scalars, atol=1e-10, rtol=1e-10)
+    torch.testing.assert_close(batched.phy0.correlations, qmc.phy0.correlations, atol=1e-10, rtol=1e-10)
+    torch.testing.assert_close(batched.measurements.values, qmc.measurements.values, atol=1e-10, rtol=1e-10)
+
+
+def test_run_measures_every_stride_th_sweep():
+    torch.manual_seed(2)
+    config = DQMCConfig(L_sites=16, n_slices=8, dt=0.125, U=4.0, n_warm=2, n_bins=2, n_measure=8, measure_stride=3)
+    qmc = DQMC(config)
+    qmc.run(12)
+
+    assert qmc.n_sweeps == 2 + 12
+    assert config.current_bin == 2
+    assert qmc.phy0.counts.tolist() == [2.0, 2.0]
+
+    config.measure_stride = 0
+    with pytest.raises(ValueError, match="measure_stride"):
+        DQMC(config).run(12)
+
+
+def test_total_energy_is_kinetic_plus_potential():
+    torch.manual_seed(3)
+    config = DQMCConfig(L_sites=16, n_slices=8, dt=0.125, U=4.0, mu=0.3, n_orth=4, n_measure=2)
+    qmc = DQMC(config)
+    qmc.sweep(measure=True)
+    scalars = qmc.phy0.scalars[:, qmc.phy0.curr_bin]
+    total = scalars[Observable.KIN_ENERGY] + scalars[Observable.POT_ENERGY]
+    assert float(scalars[Observable.TOT_ENERGY]) == pytest.approx(float(total))
+
+
+@pytest.mark.parametrize("n_walkers", [1, 3])
+def test_sweep_does_not_allocate(n_walkers):
+    """A measured sweep runs on preallocated buffers, only LAPACK allocates its work arrays"""
+    torch.manual_seed(0)
+    config = DQMCConfig(L_sites=16, n_slices=8, dt=0.125, U=4.0, mu=0.3, n_orth=4, n_measure=4, n_walkers=n_walkers)
+    qmc = BatchedDQMC(config) if n_walkers > 1 else DQMC(config)
+    allocs, lapack_allocs = allocations_per_sweep(qmc)
+    assert allocs == 0
+    assert lapack_allocs > 0
@@ -0,0 +1,119 @@
+import logging
+import os
+
+import pytest
+import torch
+from config import DQMCConfig
+from conftest import GEOMETRIES
+from dqmc import DQMC
+from geomcache import COMPONENTS, GeometryCache
+from geometry import GeometryWrapper
+
+
+def dense(value):
+    return value.to_dense() if value.is_sparse else value
+
+
+@pytest.mark.parametrize("geom", sorted(GEOMETRIES.glob("*.geom")), ids=lambda p: p.stem)
+def test_round_trip(tmp_path, geom):
+    """Entries are stored as plain data and read back with weights_only"""
+    cache = GeometryCache(tmp_path)
+    built = GeometryWrapper({"device": torch.device("cpu")})
+    built.init_from_file(geom, cache=cache)
+    loaded = GeometryWrapper({"device": torch.device("cpu")})
+    loaded.init_from_file(geom, cache=cache)
+    assert (cache.misses, cache.hits) == (1, 1)
+
+    assert loaded.sections == built.sections
+    for name in COMPONENTS:
+        expected = getattr(built, name, None)
+        if expected is None:
+            continue
+        for attr, value in vars(expected).items():
+            restored = getattr(getattr(loaded, name), attr)
+            if isinstance(value, torch.Tensor):
+                assert torch.equal(dense(restored), dense(value)), f"{name}.{attr}"
+            else:
+                assert restored == value, f"{name}.{attr}"
+
+
+def build(cache, geom="square.geom", **config):
+    wrapper = GeometryWrapper({"device": torch.device("cpu"), **config})
+    wrapper.init_from_file(GEOMETRIES / geom, cache=cache)
+    return wrapper
+
+
+def test_mu_sweep_builds_once(tmp_path):
+    cache = GeometryCache(tmp_path)
+    build(cache, mu_up=0.0, mu_dn=0.0)
+    loaded = build(cache, mu_up=0.5, mu_dn=-0.25)
+    assert (cache.misses, cache.hits) == (1, 1)
+    assert float(loaded.hamiltonian.mu_up) == 0.5
+    assert float(loaded.hamiltonian.mu_dn) == -0.25
+
+    build(cache, supercell=[[4, 0], [0, 2]])
+    assert (cache.misses, cache.hits) == (2, 1)
+
+
+def test_eviction_drops_least_recently_used(tmp_path):
+    cache = GeometryCache(tmp_path)
+    wrapper = build(None)
+    for age, key in enumerate(["b", "a", "c"]):
+        cache.store(wrapper, key)
+        os.utime(cache.path(key), (1000 + age, 1000 + age))
+    assert [p.stem for p in cache.entries()] == ["b", "a", "c"]
+
+    # Just over two entries: only the least recently used one goes
+    cache.max_bytes = cache.size() - 1
+    cache.evict()
+    assert [p.stem for p in cache.entries()] == ["a", "c"]
+
+    # A load marks the entry as recently used
+    assert cache.load(GeometryWrapper({"device": torch.device("cpu")}), "a")
+    assert [p.stem for p in cache.entries()] == ["c", "a"]
+
+    # The entry just stored survives even if it alone exceeds max_bytes
+    cache.max_bytes = 1
+    cache.store(wrapper, "d")
+    assert [p.stem for p in cache.entries()] == ["d"]
+    assert cache.evicted == 3
+
+
+@pytest.mark.parametrize("damage", ["truncated", "garbage"])
+def test_damaged_entry_is_deleted_and_missed(tmp_path, damage):
+    cache = GeometryCache(tmp_path)
+    build(cache)
+    (path,) = cache.entries()
+    data = path.read_bytes()
+    path.write_bytes(data[: len(data) // 2] if damage == "truncated" else b"not a torch file")
+
+    rebuilt = build(cache)
+    assert (cache.misses, cache.hits) == (2, 0)
+    assert rebuilt.lattice.nsites == 16
+    assert cache.entries() == [path]
+    assert cache.load(GeometryWrapper({"device": torch.device("cpu")}), path.stem)
+
+
+def test_report_counts_lookups(tmp_path):
+    cache = GeometryCache(tmp_path, max_bytes=1 << 20)
+    build(cache)
+    build(cache)
+    build(cache)
+    report = cache.report()
+    assert "2 hits, 1 misses, 0 evicted, 1 entries" in report
+    assert report.endswith(f"of {1:.1f} MB")
+
+
+def test_runs_share_the_cache(tmp_path, caplog):
+    caplog.set_level(logging.INFO, logger="dqmc")
+    for U, mu in [(2.0, 0.0), (4.0, 0.5)]:
+        config = DQMCConfig(
+            L_sites=16, n_slices=4, dt=0.125, U=U, mu=mu, n_warm=0, n_bins=1, n_orth=4, geom_cache=tmp_path / "geom"
+        )
+        qmc = DQMC(config)
+        qmc.run(1)
+        assert float(qmc.geometry.hamiltonian.mu_up) == mu
+
+    assert (qmc.geom_cache.misses, qmc.geom_cache.hits) == (0, 1)
+    assert "0 hits, 1 misses" in caplog.messages[0]
+    assert "1 hits, 0 misses" in caplog.messages[1]
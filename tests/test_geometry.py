@@ -0,0 +1,76 @@
+import pytest
+import torch
+
+from conftest import GEOMETRIES
+from geometry import GeometryWrapper
+
+
+@pytest.mark.parametrize("path", sorted(GEOMETRIES.glob("*.geom")), ids=lambda p: p.stem)
+def test_init_from_file(path):
+    geom = GeometryWrapper({"device": torch.device("cpu")})
+    geom.init_from_file(path)
+
+    lattice = geom.lattice
+    assert lattice.nsites == lattice.natom * lattice.ncell
+    assert lattice.myclass.shape == (lattice.nsites, lattice.nsites)
+    assert int(lattice.class_size.sum()) == lattice.nsites**2
+    assert geom.hamiltonian.t_up.shape == (lattice.nsites, lattice.nsites)
+    if "#PHASE" in geom.sections:
+        assert lattice.phase.shape == (lattice.nsites,)
+
+
+def test_bonds_and_pairs():
+    """#BONDS lines and their reverses land on the displaced sites, #PAIR columns refer to them"""
+    geom = GeometryWrapper({"device": torch.device("cpu")})
+    geom.init_from_file(GEOMETRIES / "square.geom")
+    bonds, lattice = geom.bonds, geom.lattice
+
+    # Five lines, the four off-site ones reversed
+    assert bonds.label.tolist() == [1, 2, 3, 4, 5, -2, -3, -4, -5]
+    assert torch.equal(bonds.origin, torch.zeros(9, dtype=torch.int64))
+    torch.testing.assert_close(bonds.delta[:, 5:], -bonds.delta[:, 1:5])
+    shift = lattice.cartpos[:, bonds.target] - lattice.cartpos[:, bonds.origin] - bonds.delta
+    frac = torch.linalg.inv(lattice.scc.to(torch.float64)) @ shift
+    torch.testing.assert_close(frac, torch.round(frac))
+
+    # Columns 1 2 -2 3 -3 4 -4 5 -5 of #PAIR
+    assert bonds.label[bonds.bond_map].tolist() == [1, 2, -2, 3, -3, 4, -4, 5, -5]
+    assert torch.equal(bonds.pair_map[bonds.bond_map], torch.arange(9))
+    assert bonds.wave_label == ["s-wave", "s*-wave", "s**-wave", "d-wave", "d*-wave"]
+    assert bonds.wave[3].tolist() == [0.0, 1.0, 1.0, 0.0, 0.0, -1.0, -1.0, 0.0, 0.0]
+
+
+@pytest.mark.parametrize(
+    ("section", "message"),
+    [("#DILUT\n0\n", "#DILUT is not supported"), ("#PAIR\n1 6\ns 1.0 1.0\n", "undefined bonds")],
+)
+def test_unsupported_bond_input_is_rejected(tmp_path, section, message):
+    content = (GEOMETRIES / "square.geom").read_text()
+    content = content[: content.index("#PAIR")] + section + "#END\n"
+    path = tmp_path / "square.geom"
+    path.write_text(content)
+    with pytest.raises(ValueError, match=message):
+        GeometryWrapper({"device": torch.device("cpu")}).init_from_file(path)
+
+
+@pytest.mark.parametrize("name", ["square", "lieb", "layers"])
+def test_symmetries_permute_bonds_and_pairs(name):
+    """Every symmetry maps the bonds, and the pairs, one to one onto bonds related by a translation"""
+    geom = GeometryWrapper({"device": torch.device("cpu")})
+    geom.init_from_file(GEOMETRIES / f"{name}.geom")
+    symm, bonds = geom.symmetry, geom.bonds
+    nbond, npair = len(bonds.origin), len(bonds.bond_map)
+    assert symm.map_symm_b.shape == (nbond, symm.nsymm)
+    assert symm.map_symm_p.shape == (npair, symm.nsymm)
+
+    for s in range(symm.nsymm):
+        images = symm.map_symm_b[:, s]
+        assert sorted(images.tolist()) == list(range(nbond))
+        for b, image in enumerate(images.tolist()):
+            i, j = symm.map_symm[bonds.origin[b], s], symm.map_symm[bonds.target[b], s]
+            ends = torch.stack([symm.translate[i], symm.translate[j]])
+            assert (ends == torch.stack([bonds.origin[image], bonds.target[image]]).unsqueeze(1)).all(0).any()
+
+        pairs = symm.map_symm_p[:, s]
+        assert sorted(pairs.tolist()) == list(range(npair))
+        assert torch.equal(bonds.bond_map[pairs], images[bonds.bond_map])
@@ -0,0 +1,55 @@
+import itertools
+
+import pytest
+import torch
+from kernels import perm_sign, udtd, udtd_
+from workspace import Workspace
+
+
+def graded(batch_shape, n):
+    """Orthogonal U, column scales D over many decades and a well conditioned T"""
+    U = torch.linalg.qr(torch.randn((*batch_shape, n, n)))[0]
+    D = torch.logspace(-8, 8, n)[torch.randperm(n)].expand(*batch_shape, n).clone()
+    T = torch.eye(n) + 0.1 * torch.randn((*batch_shape, n, n))
+    return U, D, T
+
+
+@pytest.mark.parametrize("batch_shape", [(), (3,)])
+def test_udtd_reconstructs_the_product(batch_shape):
+    torch.manual_seed(0)
+    n = 9
+    U, D, T = graded(batch_shape, n)
+    Q, D2, T2, ipiv = udtd(U, D, T)
+
+    product = (U * D.unsqueeze(-2)) @ T
+    torch.testing.assert_close((Q * D2.unsqueeze(-2)) @ T2, product, atol=1e-12 * product.abs().max(), rtol=0)
+    torch.testing.assert_close(Q.mT @ Q, torch.eye(n).expand_as(Q))
+
+    # Columns are taken by decreasing norm, so |D| decreases
+    assert torch.all(D2.abs()[..., :-1] >= D2.abs()[..., 1:])
+    assert torch.equal(ipiv.sort(-1).values, torch.arange(n).expand_as(ipiv))
+
+
+def test_perm_sign_matches_the_determinant():
+    for p in itertools.permutations(range(5)):
+        ipiv = torch.tensor(p)
+        assert int(perm_sign(ipiv)) == round(float(torch.linalg.det(torch.eye(5)[ipiv])))
+
+    batch = torch.stack([torch.randperm(7) for _ in range(6)])
+    expected = torch.linalg.det(torch.eye(7)[batch]).round().to(torch.int64)
+    assert torch.equal(perm_sign(batch), expected)
+
+
+@pytest.mark.parametrize("batch_shape", [(), (3,)])
+def test_inplace_udtd_is_bitwise_udtd(batch_shape):
+    torch.manual_seed(1)
+    n = 9
+    U, D, T = graded(batch_shape, n)
+    Q, D2, T2, ipiv = udtd(U, D, T)
+
+    ws = Workspace(n, device=torch.device("cpu"), batch_shape=batch_shape)
+    udtd_(U, D, T, ws)
+    assert torch.equal(U, Q)
+    assert torch.equal(D, D2)
+    assert torch.equal(T, T2)
+    assert torch.equal(ws.perm_sign, perm_sign(ipiv).to(ws.perm_sign.dtype))
@@ -0,0 +1,99 @@
+import torch
+
+from conftest import GEOMETRIES
+from geometry import GeometryWrapper
+
+
+def load(name: str) -> GeometryWrapper:
+    geom = GeometryWrapper({"device": torch.device("cpu")})
+    geom.init_from_file(GEOMETRIES / name)
+    return geom
+
+
+def brute_force_classes(lattice) -> list[list[int]]:
+    """Classes of site pairs under supercell translations and the exchange of the two sites"""
+    n, natom = lattice.nsites, lattice.natom
+    inv = torch.linalg.inv(lattice.scc.to(torch.float64))
+    pos = lattice.cartpos.to(torch.float64)
+
+    def key(i: int, j: int) -> tuple:
+        # Cell separation in supercell coordinates, periodic
+        shift = pos[:, j] - pos[:, i] - (pos[:, j % natom] - pos[:, i % natom])
+        f = inv @ shift
+        f = f - torch.floor(f + 1e-8)
+        return (i % natom, j % natom, *torch.round(f * 1e6).to(torch.int64).tolist())
+
+    canon = {}
+    classes = [[0] * n for _ in range(n)]
+    for i in range(n):
+        for j in range(n):
+            k = min(key(i, j), key(j, i))
+            classes[i][j] = canon.setdefault(k, len(canon))
+    return classes
+
+
+def same_partition(a: torch.Tensor, b: torch.Tensor) -> bool:
+    pairs = torch.unique(torch.stack([a.flatten(), b.flatten()]), dim=1)
+    return pairs.shape[1] == int(a.max()) + 1 == int(b.max()) + 1
+
+
+def test_translation_classes_multi_orbital():
+    for name in ("2Dinterface_small.geom", "honeycomb.geom", "lieb.geom"):
+        lattice = load(name).lattice
+        assert lattice.natom > 1
+        lattice.construct_classes(None)
+        expected = torch.tensor(brute_force_classes(lattice))
+        assert same_partition(lattice.myclass, expected), name
+
+
+def test_symmetry_classes_are_unions_of_translation_classes():
+    # The point symmetries only merge translation classes, never split them
+    lattice = load("honeycomb.geom").lattice
+    translation = torch.tensor(brute_force_classes(lattice))
+    merged = torch.zeros((int(lattice.myclass.max()) + 1, int(translation.max()) + 1), dtype=torch.int64)
+    merged[lattice.myclass.flatten(), translation.flatten()] = 1
+    assert torch.all(merged.sum(0) == 1)
+
+
+def test_kbond_classes_match_orbit_enumeration():
+    """On the square lattice every class of k-space bond pairs is one orbit of the pair operations"""
+    geom = load("square.geom")
+    kbonds, symm, recip = geom.kbonds, geom.symmetry, geom.gamma_lattice
+    nk, side = recip.nkpts, 4
+
+    # k-points as integer coordinates on the grid, one orbital so bond k of momentum q is (k, q - k)
+    def coords(k: torch.Tensor) -> list[tuple[int, ...]]:
+        frac = torch.linalg.solve(recip.kc, k.t())[:2]
+        return [tuple(c) for c in (torch.round(frac * side).to(torch.int64) % side).t().tolist()]
+
+    grid = coords(recip.klist)
+    index = {c: i for i, c in enumerate(grid)}
+    R, _ = symm.transforms()
+    R = R[symm.valid_symm]
+    if symm.add_time_rev:
+        R = torch.cat([R, -torch.eye(3).unsqueeze(0)])
+    images = [[index[c] for c in coords((op @ recip.klist.t()).t())] for op in R]
+
+    def minus(k1: int, k2: int) -> int:
+        return index[tuple((x - y) % side for x, y in zip(grid[k1], grid[k2], strict=True))]
+
+    for q in range(nk):
+        little = [image for image in images if image[q] == q]
+        orbit = {}
+        for start in ((k1, k2) for k1 in range(nk) for k2 in range(nk)):
+            if start in orbit:
+                continue
+            orbit[start], todo = len(set(orbit.values())), [start]
+            while todo:
+                k1, k2 = todo.pop()
+                moves = [(k2, k1), (minus(q, k1), minus(q, k2))] + [(m[k1], m[k2]) for m in little]
+                for move in moves:
+                    if move not in orbit:
+                        orbit[move] = orbit[start]
+                        todo.append(move)
+
+        expected = torch.tensor([[orbit[(k1, k2)] for k2 in range(nk)] for k1 in range(nk)])
+        assert same_partition(kbonds.myclass[:, :, q], expected), q
+        assert int(kbonds.nclass[q]) == int(expected.max()) + 1
+        sizes = torch.bincount(expected.flatten())
+        assert torch.equal(kbonds.class_size[: len(sizes), q].sort().values, sizes.sort().values)
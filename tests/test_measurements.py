@@ -0,0 +1,99 @@
+import itertools
+import math
+
+import pytest
+import torch
+from config import DQMCConfig
+from dqmc import DQMC
+from measurements import CORRELATIONS, Observable
+
+
+def reference_measure(phy0, G_up, G_dn, mu, t, sign_up, sign_dn):
+    """Site by site and pair by pair accumulation of one sample (DQMC_Phy0_Meas)"""
+    n = phy0.n
+    sgn = sign_up * sign_dn
+    nu = [1 - float(G_up[i, i]) for i in range(n)]
+    nd = [1 - float(G_dn[i, i]) for i in range(n)]
+
+    meas = torch.zeros(len(Observable))
+    for i in range(n):
+        meas[Observable.UP_OCC] += nu[i]
+        meas[Observable.DN_OCC] += nd[i]
+        meas[Observable.POT_ENERGY] += float(phy0.U_sites) * (nu[i] - 0.5) * (nd[i] - 0.5)
+        for j in range(n):
+            meas[Observable.KIN_ENERGY] += float(t[i, j]) * float(G_up[i, j] + G_dn[i, j])
+    meas[Observable.KIN_ENERGY] -= mu[0] * meas[Observable.UP_OCC] + mu[1] * meas[Observable.DN_OCC]
+    meas[Observable.TOT_ENERGY] = meas[Observable.KIN_ENERGY] + meas[Observable.POT_ENERGY]
+    meas[Observable.DENSITY] = meas[Observable.UP_OCC] + meas[Observable.DN_OCC]
+
+    corr = torch.zeros(len(CORRELATIONS), phy0.n_class)
+    for i in range(n):
+        for j in range(n):
+            k = int(phy0.myclass[i, j])
+            exchange = float(G_up[i, j] * G_up[j, i] + G_dn[i, j] * G_dn[j, i])
+            if i == j:
+                dens_uu = nu[i] + nd[i]
+                spin_xx = spin_zz = nu[i] + nd[i] - 2 * nu[i] * nd[i]
+            else:
+                dens_uu = nu[i] * nu[j] + nd[i] * nd[j] - exchange
+                spin_xx = -float(G_up[i, j] * G_dn[j, i] + G_dn[i, j] * G_up[j, i])
+                spin_zz = (nu[i] - nd[i]) * (nu[j] - nd[j]) - exchange
+
+            corr[0, k] += float(phy0.gf_phase[i, j]) * float(G_up[i, j] + G_dn[i, j]) / 2
+            corr[1, k] += dens_uu / 2
+            corr[2, k] += nu[i] * nd[j]
+            corr[3, k] += spin_xx
+            corr[4, k] += spin_zz
+
+            meas[Observable.XX_FM_SF] += spin_xx
+            meas[Observable.ZZ_FM_SF] += spin_zz
+            phase = float(phy0.phase[i] * phy0.phase[j])
+            meas[Observable.XX_AF_SF] += phase * spin_xx
+            meas[Observable.ZZ_AF_SF] += phase * spin_zz
+
+    meas[: Observable.RMS_XX_AF] /= n
+    meas[Observable.RMS_XX_AF] = meas[Observable.XX_AF_SF] ** 2
+    meas[Observable.RMS_ZZ_AF] = meas[Observable.ZZ_AF_SF] ** 2
+    meas *= sgn
+    meas[Observable.AVG_SIGN] = sgn
+    meas[Observable.UP_SIGN] = sign_up
+    meas[Observable.DN_SIGN] = sign_dn
+
+    size = torch.bincount(phy0.myclass.flatten().long(), minlength=phy0.n_class)
+    return meas, sgn * corr / size
+
+
+@pytest.mark.parametrize("batch_shape", [(), (3,)])
+def test_measure_matches_pair_loop(batch_shape):
+    """The vectorized measurement of every walker adds what the per-pair loop adds"""
+    torch.manual_seed(6)
+    config = DQMCConfig(L_sites=16, n_slices=8, dt=0.125, U=4.0, mu=0.3, n_orth=4)
+    qmc = DQMC(config)
+    phy0 = qmc.phy0
+    assert phy0.phase is not None
+    assert torch.equal(phy0.myclass, phy0.myclass.T)
+
+    n = config.L_sites
+    G_up = torch.eye(n) / 2 + 0.1 * torch.randn((*batch_shape, n, n))
+    G_dn = torch.eye(n) / 2 + 0.1 * torch.randn((*batch_shape, n, n))
+    sign_up = torch.ones(batch_shape)
+    sign_dn = -torch.ones(batch_shape)
+    if batch_shape:
+        sign_up[1] = -1.0
+    mu = (0.3, -0.2)
+
+    phy0.curr_bin = 1
+    phy0.measure(G_up, G_dn, mu, qmc.hop_t, sign_up, sign_dn)
+
+    meas = torch.zeros(len(Observable))
+    corr = torch.zeros(len(CORRELATIONS), phy0.n_class)
+    for w in itertools.product(*map(range, batch_shape)):
+        args = (G_up[w], G_dn[w], mu, qmc.hop_t, float(sign_up[w]), float(sign_dn[w]))
+        meas_w, corr_w = reference_measure(phy0, *args)
+        meas += meas_w
+        corr += corr_w
+
+    torch.testing.assert_close(phy0.scalars[:, 1], meas)
+    torch.testing.assert_close(phy0.correlations[..., 1], corr)
+    assert phy0.scalars[:, [0, 2]].abs().sum() == 0
+    assert phy0.counts.tolist()[:3] == [0, math.prod(batch_shape), 0]
@@ -0,0 +1,117 @@
+import pytest
+import torch
+from config import DQMCConfig
+from dqmc import DQMC
+from green import GreenFunction, tune_block_size
+from metropolis import metropolis_slice
+from walkers import BatchedDQMC
+
+
+def reference_slice(G_up, G_dn, alpha_up, alpha_dn, boson, rand, n_blk):
+    """Per-site accept/reject with the delayed updates of GreenFunction"""
+    n = G_up.shape[-1]
+    gf = [GreenFunction(n=n, L=1, G=G.clone(), V=None, ilb=-1, det=0.0, sign=1.0, n_blk=n_blk) for G in (G_up, G_dn)]
+    accepted = torch.zeros(rand.shape, dtype=torch.bool)
+    for j in range(n):
+        r_up = 1 + (1 - gf[0].get_jj(j)) * alpha_up[..., j]
+        r_dn = 1 + (1 - gf[1].get_jj(j)) * alpha_dn[..., j]
+        accepted[..., j] = rand[..., j] < torch.clamp(torch.abs(r_up * r_dn * boson[..., j]), max=1.0)
+        gf[0].update_G(j, torch.where(accepted[..., j], alpha_up[..., j] / r_up, 0.0))
+        gf[1].update_G(j, torch.where(accepted[..., j], alpha_dn[..., j] / r_dn, 0.0))
+    gf[0].apply_update(forced=True)
+    gf[1].apply_update(forced=True)
+    return gf[0].G, gf[1].G, accepted
+
+
+@pytest.mark.parametrize("batch_shape", [(), (3,)])
+def test_slice_kernel_matches_per_site_updates(batch_shape):
+    torch.manual_seed(2)
+    n, n_blk = 11, 4
+    A = torch.randn((*batch_shape, n, n)) / n**0.5
+    G_up = torch.linalg.inv(torch.eye(n) + A @ A.transpose(-2, -1)).contiguous()
+    G_dn = torch.linalg.inv(torch.eye(n) + A.transpose(-2, -1) @ A).contiguous()
+    h = torch.randint(2, (*batch_shape, n)) * 2 - 1
+    alpha_up = torch.expm1(-1.2 * h)
+    alpha_dn = torch.expm1(1.2 * h)
+    boson = torch.ones_like(alpha_up)
+    rand = torch.rand((*batch_shape, n))
+
+    G_ref_up, G_ref_dn, accepted_ref = reference_slice(G_up, G_dn, alpha_up, alpha_dn, boson, rand, n_blk)
+
+    sign_up = torch.linalg.slogdet(G_up).sign
+    sign_dn = torch.linalg.slogdet(G_dn).sign
+    panels = [torch.zeros((*batch_shape, n, n_blk)) for _ in range(4)]
+    operands = (alpha_up, alpha_dn, boson, rand, sign_up, sign_dn)
+    accepted = metropolis_slice(G_up, panels[0], panels[1], G_dn, panels[2], panels[3], *operands)
+
+    assert torch.equal(accepted, accepted_ref)
+    assert 0 < int(accepted.sum()) < accepted.numel()
+    torch.testing.assert_close(G_up, G_ref_up)
+    torch.testing.assert_close(G_dn, G_ref_dn)
+    assert torch.equal(sign_up, torch.linalg.slogdet(G_up).sign)
+    assert torch.equal(sign_dn, torch.linalg.slogdet(G_dn).sign)
+
+
+def test_slice_kernel_rejects_column_major_greens():
+    """A column-major G would be copied whole at every site"""
+    n, n_blk = 6, 2
+    G = torch.linalg.inv(torch.eye(n) + torch.rand(n, n) / n)
+    assert not G.is_contiguous()
+    panels = [torch.zeros(n, n_blk) for _ in range(4)]
+    operands = (torch.zeros(n), torch.zeros(n), torch.ones(n), torch.rand(n), torch.ones(()), torch.ones(()))
+    with pytest.raises(ValueError, match="row-major"):
+        metropolis_slice(G, panels[0], panels[1], G.contiguous(), panels[2], panels[3], *operands)
+
+
+def test_eager_sweep_matches_python_backend():
+    """Both backends draw the same random numbers and accept the same flips"""
+    results = []
+    for backend in ("python", "eager"):
+        torch.manual_seed(5)
+        qmc = DQMC(DQMCConfig(L_sites=16, n_slices=8, dt=0.125, U=4.0, n_orth=4, update_backend=backend))
+        for _ in range(2):
+            qmc.sweep(measure=False)
+        results.append((qmc.hsf, qmc.G_up, qmc.gf_up.sign))
+
+    (hsf_py, G_py, sign_py), (hsf, G, sign) = results
+    assert torch.equal(hsf, hsf_py)
+    assert torch.equal(sign, sign_py)
+    torch.testing.assert_close(G, G_py, atol=1e-10, rtol=0)
+
+
+def test_batched_sweep_uses_update_backend(monkeypatch):
+    config = DQMCConfig(L_sites=16, n_slices=8, dt=0.125, U=4.0, n_walkers=2, update_backend="eager", n_orth=4)
+    qmc = BatchedDQMC(config)
+    calls = []
+    kernel = qmc.update_kernel
+    monkeypatch.setattr(qmc, "update_kernel", lambda *args: calls.append(1) or kernel(*args))
+
+    hsf = qmc.hsf.clone()
+    qmc.sweep(measure=False)
+    assert len(calls) == config.n_slices
+    assert not torch.equal(qmc.hsf, hsf)
+
+    # G stays the Green's function of the updated fields
+    G_up = qmc.G_up.clone()
+    qmc._compute_greens(config.n_slices - 1, qmc.workspace.R1, qmc.workspace.R5, qmc.workspace.R2)
+    torch.testing.assert_close(qmc.G_up, G_up, atol=1e-8, rtol=0)
+
+
+@pytest.mark.parametrize("backend", ["python", "eager"])
+def test_delayed_updates_match_immediate_updates(backend):
+    """Flushing the accepted flips every n_blk sites, or the tuned n_blk = 0, accepts what rank-1 updates accept"""
+    results = []
+    for n_blk in (1, 4, 0):
+        torch.manual_seed(9)
+        config = DQMCConfig(L_sites=16, n_slices=8, dt=0.125, U=4.0, mu=0.3, n_orth=4, n_blk=n_blk, update_backend=backend)
+        qmc = DQMC(config)
+        for _ in range(3):
+            qmc.sweep(measure=False)
+        assert qmc.gf_up.n_blk == (n_blk or tune_block_size(16, qmc.dtype))
+        results.append((qmc.hsf, qmc.G_up, qmc.G_dn))
+
+    (hsf, G_up, G_dn), *delayed = results
+    for hsf_blk, G_up_blk, G_dn_blk in delayed:
+        assert torch.equal(hsf_blk, hsf)
+        torch.testing.assert_close(G_up_blk, G_up, atol=1e-10, rtol=0)
+        torch.testing.assert_close(G_dn_blk, G_dn, atol=1e-10, rtol=0)
@@ -0,0 +1,133 @@
+import torch
+import torch.distributed as dist
+import torch.multiprocessing as mp
+from aggregate import BinAggregator
+from config import DQMCConfig
+from dqmc import DQMC
+from hsf import pack_hsf, unpack_hsf
+from parallel import Channel, ParallelQMC
+from tempering import ReplicaExchange
+
+WORLD_SIZE = 2
+
+
+def init_rank(rank, tmp_path):
+    """Join the gloo group of the test through a file store"""
+    torch.set_default_dtype(torch.float64)
+    dist.init_process_group("gloo", init_method=f"file://{tmp_path / 'store'}", rank=rank, world_size=WORLD_SIZE)
+
+
+def swap_worker(rank, tmp_path):
+    torch.set_default_dtype(torch.float64)
+    pqmc = ParallelQMC(level=1, rank=rank, size=WORLD_SIZE)  # before the process group exists
+    init_rank(rank, tmp_path)
+    assert pqmc.comm(Channel.TEMP) is dist.group.WORLD
+
+    torch.manual_seed(rank)
+    config = DQMCConfig(L_sites=16, n_slices=8, dt=0.125, U=4.0, n_orth=4)
+    rex = ReplicaExchange(config, [4.0, 4.8], pqmc=pqmc, seed=3)
+
+    # Record every message of the swaps
+    sent, received = [], []
+    exchange = rex._exchange
+
+    def record(send, peer):
+        recv = exchange(send, peer)
+        sent.append(send.clone())
+        received.append(recv.clone())
+        return recv
+
+    rex._exchange = record
+    decisions, before, after, weights = [], [], [], []
+    for _ in range(8):
+        rex.qmc.sweep(measure=False)
+        before.append(rex.qmc.hsf.clone())
+        peer = rex.partner()
+        accept = rex.swap()
+        decisions.append(accept if peer is not None else None)
+        after.append(rex.qmc.hsf.clone())
+        if peer is not None:
+            # Log-weights of this replica in its own and in the received configuration
+            hsf_peer = unpack_hsf(received[-2], before[-1].shape)
+            weights.append(torch.tensor([float(rex.qmc.log_weight(h)) for h in (before[-1], hsf_peer)]))
+
+    state = {"decisions": decisions, "before": before, "after": after, "weights": weights}
+    torch.save({**state, "sent": sent, "received": received}, tmp_path / f"rank{rank}.pt")
+    dist.destroy_process_group()
+
+
+def test_replica_swap_on_two_ranks(tmp_path):
+    """Both partners take the same decision from the exchanged HSF and log-weights"""
+    mp.spawn(swap_worker, args=(tmp_path,), nprocs=WORLD_SIZE, join=True)
+    r0, r1 = (torch.load(tmp_path / f"rank{rank}.pt") for rank in range(WORLD_SIZE))
+
+    assert r0["decisions"] == r1["decisions"]
+    attempts = [i for i, accept in enumerate(r0["decisions"]) if accept is not None]
+    assert len(attempts) == 4
+    assert {r0["decisions"][i] for i in attempts} == {True, False}
+
+    # Packed HSF, then the log-weights of both configurations, went both ways
+    for mine, theirs in ((r0, r1), (r1, r0)):
+        assert len(mine["sent"]) == 2 * len(attempts)
+        for sent, received in zip(mine["sent"], theirs["received"], strict=True):
+            assert torch.equal(sent, received)
+        for i, hsf in zip(attempts, mine["sent"][::2], strict=True):
+            assert torch.equal(hsf, pack_hsf(mine["before"][i]))
+
+        for logw, expected in zip(mine["sent"][1::2], mine["weights"], strict=True):
+            torch.testing.assert_close(logw, expected)
+
+    # Accepted swaps trade the configurations, rejected ones keep them
+    for i in attempts:
+        if r0["decisions"][i]:
+            assert torch.equal(r0["after"][i], r1["before"][i])
+            assert torch.equal(r1["after"][i], r0["before"][i])
+        else:
+            assert torch.equal(r0["after"][i], r0["before"][i])
+            assert torch.equal(r1["after"][i], r1["before"][i])
+
+
+AGGREGATE_CONFIG = {"L_sites": 16, "n_slices": 8, "dt": 0.125, "U": 4.0, "mu": 0.3, "n_orth": 4, "n_measure": 4}
+
+
+def aggregate_worker(rank, tmp_path):
+    init_rank(rank, tmp_path)
+    torch.manual_seed(rank)
+    qmc = DQMC(DQMCConfig(**AGGREGATE_CONFIG, n_bins=3, tdm=True))
+    for _ in range(3):
+        for _ in range(2):
+            qmc.sweep(measure=True)
+        qmc.end_bin()
+
+    local = {"phy0": [t.clone() for t in qmc.phy0.bin_data()], "tdm": [t.clone() for t in qmc.measurements.bin_data()]}
+    pqmc = ParallelQMC(level=1, rank=rank, size=WORLD_SIZE)
+    roots = [BinAggregator(pqmc).aggregate(qmc.phy0), BinAggregator(pqmc, Channel.MEAS).aggregate(qmc.measurements)]
+
+    blocks = {"scalars": qmc.phy0.scalars, "correlations": qmc.phy0.correlations, "tdm": qmc.measurements.values}
+    torch.save({"local": local, "roots": roots, **blocks}, tmp_path / f"rank{rank}.pt")
+    dist.destroy_process_group()
+
+
+def test_bin_aggregation_on_two_ranks(tmp_path):
+    """The packed all-reduce and the root jackknife agree with one process holding the bins of both"""
+    mp.spawn(aggregate_worker, args=(tmp_path,), nprocs=WORLD_SIZE, join=True)
+    r0, r1 = (torch.load(tmp_path / f"rank{rank}.pt") for rank in range(WORLD_SIZE))
+    assert r0["roots"] == [True, True]
+    assert r1["roots"] == [False, False]
+
+    # Single process reference on the summed bins
+    reference = DQMC(DQMCConfig(**AGGREGATE_CONFIG, n_bins=3, tdm=True))
+    for name, block in (("phy0", reference.phy0), ("tdm", reference.measurements)):
+        for t, a, b in zip(block.bin_data(), r0["local"][name], r1["local"][name], strict=True):
+            t.copy_(a + b)
+        block.get_err()
+
+    torch.testing.assert_close(r0["scalars"], reference.phy0.scalars)
+    torch.testing.assert_close(r0["correlations"], reference.phy0.correlations)
+    torch.testing.assert_close(r0["tdm"], reference.measurements.values)
+
+    # Every rank holds the bins of the whole run, only the root the averages
+    n_bins = reference.phy0.n_bins
+    torch.testing.assert_close(r1["scalars"][:, :n_bins], reference.phy0.scalars[:, :n_bins])
+    torch.testing.assert_close(r1["tdm"][..., :n_bins], reference.measurements.values[..., :n_bins])
+    assert not torch.equal(r1["scalars"][:, n_bins:], reference.phy0.scalars[:, n_bins:])
@@ -0,0 +1,122 @@
+import json
+
+import pytest
+import torch
+from config import DQMCConfig
+from dqmc import DQMC
+from profiler import PROFILER, matmul_flops, profile, profiled
+
+
+@pytest.fixture
+def profiler():
+    PROFILER.reset()
+    PROFILER.enable(sync=False, trace=True)
+    yield PROFILER
+    PROFILER.disable()
+    PROFILER.reset()
+
+
+@profiled(flops=lambda A, B: matmul_flops(A, B))
+def product(A, B):
+    return A @ B
+
+
+@profiled("square", flops=lambda A: 1.0)
+def square(A):
+    return product(A, A)
+
+
+def run_regions(A):
+    with profile("outer", flops=10.0):
+        square(A)
+        square(A)
+        product(A, A)
+
+
+def test_nested_paths_and_flop_roll_up(profiler):
+    A = torch.ones((2, 3, 3))
+    run_regions(A)
+    product(A, A)
+
+    items = profiler.items
+    assert sorted(items) == ["outer", "outer/product", "outer/square", "outer/square/product", "product"]
+    assert [items[path].count for path in sorted(items)] == [1, 1, 2, 2, 1]
+
+    flops = matmul_flops(A, A)
+    assert flops == 2 * 2 * 3**3
+    assert items["product"].flops == flops
+    assert items["outer/square/product"].flops == 2 * flops
+    assert items["outer/square"].flops == 2 * (flops + 1.0)
+    assert items["outer"].flops == 10.0 + 3 * flops + 2.0
+
+    summary = profiler.summary()
+    for path, item in items.items():
+        assert 0.0 <= summary[path]["self_time"] <= item.time
+    assert items["outer"].child_time == pytest.approx(items["outer/square"].time + items["outer/product"].time)
+
+
+def test_sweep_regions_roll_up_their_children(profiler):
+    torch.manual_seed(8)
+    qmc = DQMC(DQMCConfig(L_sites=16, n_slices=8, dt=0.125, U=4.0, n_orth=4, update_backend="python"))
+    qmc.sweep(measure=False)
+    qmc.sweep(measure=False)
+
+    items = profiler.items
+    assert items["sweep"].count == 2
+    assert "sweep/get_greens/compute_greens/multiply_B/get_block/mult_left" in items
+    assert items["sweep/get_greens/wrap_greens/mult_left"].flops > 0
+
+    # Only the kernels at the leaves count flops of their own
+    for path, item in items.items():
+        children = [child for child in items if child.rsplit("/", 1)[0] == path and child != path]
+        if children:
+            assert item.flops == pytest.approx(sum(items[child].flops for child in children))
+
+
+def test_chrome_trace_has_one_event_per_call(profiler, tmp_path):
+    run_regions(torch.ones((3, 3)))
+    profiler.to_chrome_trace(tmp_path / "trace.json")
+    events = json.loads((tmp_path / "trace.json").read_text())["traceEvents"]
+
+    assert sorted(event["cat"] for event in events) == [
+        "outer",
+        "outer/product",
+        "outer/square",
+        "outer/square",
+        "outer/square/product",
+        "outer/square/product",
+    ]
+    assert all(event["ph"] == "X" and event["name"] == event["cat"].rsplit("/", 1)[-1] for event in events)
+
+    # Every child lies within the span of its parent, which closes after it
+    outer = events[-1]
+    assert outer["cat"] == "outer"
+    assert outer["args"]["flops"] == profiler.items["outer"].flops
+    for event in events[:-1]:
+        assert outer["ts"] <= event["ts"]
+        assert event["ts"] + event["dur"] <= outer["ts"] + outer["dur"] + 1e-3
+
+
+def test_disabled_profiler_records_nothing(monkeypatch):
+    PROFILER.reset()
+    assert not PROFILER.enabled
+
+    def fail(*args):
+        raise AssertionError("disabled regions must not be opened")
+
+    monkeypatch.setattr(PROFILER, "begin", fail)
+    monkeypatch.setattr(PROFILER, "end", fail)
+    A = torch.eye(3)
+    run_regions(A)
+    torch.testing.assert_close(square(A), A)
+    assert PROFILER.items == {}
+    assert PROFILER.events == []
+
+    # Counters survive disable, later calls are not counted
+    monkeypatch.undo()
+    PROFILER.enable(sync=False)
+    square(A)
+    PROFILER.disable()
+    square(A)
+    assert PROFILER.items["square"].count == 1
+    PROFILER.reset()
@@ -0,0 +1,28 @@
+import pytest
+import torch
+from matb import DenseB
+from seqb import SeqB
+
+
+@pytest.mark.parametrize("batch_shape", [(), (2,)])
+def test_multiply_matches_naive_product_for_every_slice(batch_shape):
+    """U D T = B_il ... B_0 B_{L-1} ... B_{il+1}, also with a partial last block"""
+    torch.manual_seed(0)
+    n, L, n_orth = 6, 11, 3
+    K = torch.randn(n, n)
+    B = torch.matrix_exp(-0.1 * (K + K.t()))
+    V = torch.exp(0.3 * (torch.randint(2, (*batch_shape, L, n)) * 2 - 1))
+    seqb = SeqB(n, L, n_orth, DenseB(n, B, torch.linalg.inv(B)), batch_shape=batch_shape)
+    assert seqb.nblocks == 4
+
+    U, T = torch.empty((*batch_shape, n, n)), torch.empty((*batch_shape, n, n))
+    D = torch.empty((*batch_shape, n))
+    for il in range(L):
+        naive = torch.eye(n).repeat(*batch_shape, 1, 1)
+        for si in [(il + 1 + k) % L for k in range(L)]:
+            naive = V[..., si, :].unsqueeze(-1) * (B @ naive)
+
+        seqb.multiply(il, V, U, D, T)
+        torch.testing.assert_close((U * D.unsqueeze(-2)) @ T, naive, rtol=1e-10, atol=1e-12)
+        torch.testing.assert_close(U.mT @ U, torch.eye(n).expand_as(U))
+        assert torch.equal(seqb.t_sign, torch.linalg.det(T).sign())
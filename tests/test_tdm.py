@@ -0,0 +1,59 @@
+import pytest
+import torch
+from config import DQMCConfig
+from dqmc import DQMC
+from gtau import TAU_UP, GTau
+from tdm import TDM_PROPERTIES
+
+
+def test_beta_slot_is_filled():
+    """G(beta) = delta - G(0) and the two-particle correlations are periodic in beta"""
+    torch.manual_seed(0)
+    config = DQMCConfig(L_sites=16, n_slices=8, dt=0.125, U=4.0, mu=0.3, n_orth=4, tdm=True)
+    qmc = DQMC(config)
+    qmc.sweep(measure=True)
+    tdm = qmc.measurements
+    values = tdm.values[..., qmc._bin_idx()] / tdm.sgn[qmc._bin_idx()]
+    L = config.n_slices
+
+    onsite = int(tdm.myclass[0, 0])
+    delta = torch.zeros(tdm.nclass)
+    delta[onsite] = 1.0
+    for name in ("gfun", "gfun_up", "gfun_dn"):
+        i = TDM_PROPERTIES.index(name)
+        torch.testing.assert_close(values[i, :, L], delta - values[i, :, 0])
+    for name in ("spxx", "spzz", "dens", "pair"):
+        i = TDM_PROPERTIES.index(name)
+        torch.testing.assert_close(values[i, :, L], values[i, :, 0])
+
+
+@pytest.mark.parametrize(("nb", "batch_shape"), [(1, ()), (2, ()), (5, ()), (4, (3,))])
+def test_block_inversion_matches_dense_inverse(nb, batch_shape):
+    """The BSOF inverse and sign agree with the LU of the assembled space-time matrix"""
+    torch.manual_seed(nb)
+    n = 6
+    P = [torch.matrix_exp(torch.randn((*batch_shape, n, n))) for _ in range(nb)]
+    A = torch.eye(n * nb).repeat(*batch_shape, 1, 1)
+    for i in range(nb):
+        j = (i - 1) % nb
+        A[..., i * n : (i + 1) * n, j * n : (j + 1) * n] += P[j] if i == 0 else -P[j]
+
+    gtau = GTau(n=n, L=nb, nb=nb, nnb=n * nb, it_up=0, i0_up=0, it_dn=0, i0_dn=0, north=1)
+    X, sgn = gtau._invert(P, torch.Size(batch_shape))
+    torch.testing.assert_close(X, torch.linalg.inv(A))
+    assert torch.equal(sgn, torch.linalg.slogdet(A).sign)
+
+
+def test_diagonal_blocks_are_equal_time_greens():
+    """Block (i, i) of the inverse is G at the start of block i, recomputed through UDT"""
+    torch.manual_seed(4)
+    config = DQMCConfig(L_sites=16, n_slices=24, dt=0.125, U=6.0, mu=0.5, n_orth=4)
+    qmc = DQMC(config)
+    qmc.sweep(measure=False)
+    sgn = qmc.gtau.load(TAU_UP, qmc.seqb_up, qmc.V_up)
+    for i in range(qmc.gtau.nb):
+        start, _ = qmc.seqb_up.block_range(i)
+        qmc._compute_greens((start - 1) % config.n_slices, qmc.workspace.R1, qmc.workspace.R5, qmc.workspace.R2)
+        blk = qmc.gtau._blk(i)
+        torch.testing.assert_close(qmc.gtau.A[TAU_UP][blk, blk], qmc.G_up, atol=1e-9, rtol=0)
+    assert torch.equal(sgn, qmc.gf_up.sign)